@@ -0,0 +1,126 @@
+"""Many concurrent slow folder listings: sync views on a thread pool vs the async views on one event loop.
+
+The folder-stats cache is disabled so every request lists S3 (fan-out included), and
+load shedding is off so every request in the burst is served and timed.
+
+    python -m benchmarks.bench_async --concurrency 1000 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import BUCKET, TOKEN, setup_django, summarize
+
+
+def app_threads():
+    # The stand-in runs in this process with a thread per connection; leave those out
+    return sum(1 for thread in threading.enumerate() if 'process_request_thread' not in thread.name)
+
+
+class ThreadPeak:
+    # Counts the threads a run adds, not the pools an earlier run left behind
+    def __init__(self):
+        self.baseline = self.peak = app_threads()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def _watch(self):
+        while not self._stop.wait(0.01):
+            self.peak = max(self.peak, app_threads())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def added(self):
+        return self.peak - self.baseline
+
+
+def run_sync(path, concurrency, workers):
+    from django.test import Client
+
+    # Latency runs from when the whole batch arrives, so time queued for a free thread counts
+    def request(_):
+        response = Client().get(path, HTTP_AUTHORIZATION=TOKEN)
+        assert response.status_code == 200, response.content
+        return time.perf_counter() - start
+
+    with ThreadPeak() as threads, ThreadPoolExecutor(max_workers=workers) as executor:
+        start = time.perf_counter()
+        samples = list(executor.map(request, range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return samples, elapsed, threads.added
+
+
+async def run_async(path, concurrency):
+    from django.test import AsyncClient
+    from mainApp.clients import close_async_s3_client
+
+    client = AsyncClient()
+
+    async def request():
+        # Django 4.2's AsyncClient ignores default headers, so pass them per request
+        response = await client.get(path, headers={'Authorization': TOKEN})
+        assert response.status_code == 200, response.content
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    await request()
+    with ThreadPeak() as threads:
+        start = time.perf_counter()
+        samples = await asyncio.gather(*(request() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    await close_async_s3_client()
+    return samples, elapsed, threads.added
+
+
+def report(samples, elapsed, threads_added, standin, concurrency):
+    result = summarize(samples)
+    result.update({
+        'wall_s': round(elapsed, 3),
+        'requests_per_s': round(concurrency / elapsed, 1),
+        'threads_added': threads_added,
+        's3_calls': standin.total_calls(),
+        'connections_opened': standin.connections,
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=64, help='threads serving the sync views')
+    parser.add_argument('--folders', type=int, default=8)
+    parser.add_argument('--files-per-folder', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.5, help='simulated S3 round trip (s)')
+    args = parser.parse_args()
+
+    standin = setup_django(latency=args.latency, FOLDER_STATS_CACHE_BACKEND='django.core.cache.backends.dummy.DummyCache',
+                           AWS_S3_ASYNC_MAX_POOL_CONNECTIONS=args.concurrency, S3_FANOUT_MAX_QUEUE_WAIT=3600)
+    for folder in range(args.folders):
+        standin.put_object(BUCKET, f'root/folder-{folder}/', metadata={'createdat': '2024-01-01 00:00:00+00:00'})
+        for n in range(args.files_per_folder):
+            standin.put_object(BUCKET, f'root/folder-{folder}/image-{n}.jpg', b'x' * 64)
+
+    from django.test import Client
+    Client().get('/list-files/root/', HTTP_AUTHORIZATION=TOKEN)
+
+    standin.reset_calls()
+    sync = report(*run_sync('/list-files/root/', args.concurrency, args.workers), standin, args.concurrency)
+    standin.reset_calls()
+    asynchronous = report(*asyncio.run(run_async('/async/list-files/root/', args.concurrency)),
+                          standin, args.concurrency)
+
+    print(json.dumps({'sync_thread_pool': sync, 'async_event_loop': asynchronous}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
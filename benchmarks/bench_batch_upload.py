@@ -0,0 +1,48 @@
+"""N files as N upload_file requests vs one upload_files batch request.
+
+    python -m benchmarks.bench_batch_upload --files 100 --size 65536
+"""
+import argparse
+import json
+import os
+import time
+
+from benchmarks.common import TOKEN, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated S3 round trip (s)')
+    args = parser.parse_args()
+
+    standin = setup_django(latency=args.latency)
+
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+
+    client = Client(HTTP_AUTHORIZATION=TOKEN)
+    payload = os.urandom(args.size)
+
+    standin.reset_calls()
+    start = time.perf_counter()
+    for n in range(args.files):
+        response = client.post('/upload-file/', {'folder_id': 'serial',
+                                                 'file': SimpleUploadedFile(f'img-{n}.jpg', payload)})
+        assert response.status_code == 200, response.content
+    serial = {'seconds': round(time.perf_counter() - start, 3), 's3_calls': standin.calls}
+
+    standin.reset_calls()
+    files = [SimpleUploadedFile(f'img-{n}.jpg', payload) for n in range(args.files)]
+    start = time.perf_counter()
+    response = client.post('/upload-files/', {'folder_id': 'batch', 'files': files})
+    batch = {'seconds': round(time.perf_counter() - start, 3), 's3_calls': standin.calls}
+    assert response.json()['uploaded_count'] == args.files, response.content
+
+    print(json.dumps({'files': args.files, 'size': args.size,
+                      'one_request_per_file': serial, 'batch': batch}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Per-request latency of list_folders with a fresh S3 client per call vs the shared client.
+
+The folder-stats cache is disabled so every request lists S3 through the client under test.
+
+    python -m benchmarks.bench_clients --folders 20 --requests 50
+"""
+import argparse
+import json
+import time
+
+from benchmarks.common import BUCKET, TOKEN, setup_django, summarize
+
+
+def legacy_get_s3_client():
+    import boto3
+    from django.conf import settings
+
+    return boto3.client(
+        's3',
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        region_name=settings.AWS_S3_REGION_NAME,
+        endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+    )
+
+
+def run(client, standin, requests):
+    samples = []
+    standin.reset_calls()
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get('/list-folders/', HTTP_AUTHORIZATION=TOKEN)
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.content
+    result = summarize(samples)
+    result['connections_opened'] = standin.connections
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folders', type=int, default=20)
+    parser.add_argument('--files-per-folder', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.002, help='simulated S3 round trip (s)')
+    parser.add_argument('--connect-latency', type=float, default=0.02, help='simulated TLS handshake (s)')
+    args = parser.parse_args()
+
+    standin = setup_django(latency=args.latency, connect_latency=args.connect_latency,
+                           FOLDER_STATS_CACHE_BACKEND='django.core.cache.backends.dummy.DummyCache')
+    for folder in range(args.folders):
+        standin.put_object(BUCKET, f'folder-{folder}/', metadata={'createdat': '2024-01-01 00:00:00+00:00'})
+        for n in range(args.files_per_folder):
+            standin.put_object(BUCKET, f'folder-{folder}/image-{n}.jpg', b'x' * 64)
+
+    from django.test import Client
+    from mainApp import clients, views
+
+    client = Client()
+    client.get('/list-folders/', HTTP_AUTHORIZATION=TOKEN)
+
+    views.get_s3_client = legacy_get_s3_client
+    before = run(client, standin, args.requests)
+    views.get_s3_client = clients.get_s3_client
+    after = run(client, standin, args.requests)
+
+    print(json.dumps({'per_request_client': before, 'shared_client': after}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Time-to-first-byte, total time and peak memory of buffered vs streamed responses.
+
+    python -m benchmarks.bench_streaming --keys 20000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from benchmarks.common import BUCKET, TOKEN, setup_django
+
+
+def consume(response):
+    start = time.perf_counter()
+    first_byte = None
+    size = 0
+    if response.streaming:
+        for chunk in response.streaming_content:
+            if first_byte is None:
+                first_byte = time.perf_counter()
+            size += len(chunk)
+    else:
+        size = len(response.content)
+    return first_byte, size
+
+
+def measure(client, path, params):
+    start = time.perf_counter()
+    response = client.get(path, params, HTTP_AUTHORIZATION=TOKEN)
+    assert response.status_code == 200
+    first_byte, size = consume(response)
+    total = time.perf_counter() - start
+    first_byte = (first_byte or start + total) - start
+
+    # Peak memory is measured on a separate run: tracemalloc distorts timings
+    tracemalloc.start()
+    consume(client.get(path, params, HTTP_AUTHORIZATION=TOKEN))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'ttfb_ms': round(first_byte * 1000, 2),
+        'total_ms': round(total * 1000, 2),
+        'peak_memory_kb': round(peak / 1024, 1),
+        'bytes': size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.01, help='simulated S3 round trip (s)')
+    args = parser.parse_args()
+
+    # Keep the folder stats cache out of the way so every run lists S3
+    standin = setup_django(latency=args.latency, FOLDER_STATS_CACHE_TTL=0)
+    for n in range(args.keys):
+        standin.put_object(BUCKET, f'photos/img-{n:07}.jpg', data=None, size=1024)
+
+    from django.test import Client
+
+    client = Client()
+    cases = {
+        'list_files': ('/list-files/photos/', {}),
+        'search_scan': ('/api/search/', {'q': 'img-00'}),
+    }
+    results = {}
+    for name, (path, params) in cases.items():
+        results[name] = {
+            'buffered': measure(client, path, params),
+            'json_stream': measure(client, path, dict(params, stream='json')),
+            'ndjson_stream': measure(client, path, dict(params, stream='ndjson')),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
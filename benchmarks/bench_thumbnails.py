@@ -0,0 +1,86 @@
+"""Images per second per core: naive per-size resizes vs imaging.render, serial and on a process pool.
+
+The naive baseline fully decodes the original once per size and resizes each from it.
+
+    python -m benchmarks.bench_thumbnails --images 40 --width 4000 --height 3000
+"""
+import argparse
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw
+
+from mainApp import imaging
+
+SIZES = (128, 512, 1600)
+
+
+def make_jpeg(width, height, seed):
+    image = Image.new('RGB', (width, height), (seed * 37 % 256, 90, 160))
+    draw = ImageDraw.Draw(image)
+    # Some detail so the encoder and resampler have real work to do
+    for n in range(0, width, 40):
+        draw.line((n, 0, width - n, height), fill=((n + seed) % 256, 200, 40), width=3)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def naive_render(data, sizes, fmt='WEBP', quality=80):
+    results = []
+    for size in sizes:
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        image.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, fmt, quality=quality)
+        results.append((size, buffer.getvalue(), image.width, image.height))
+    return results
+
+
+def run_serial(render, images):
+    start = time.perf_counter()
+    for data in images:
+        render(data, SIZES)
+    return time.perf_counter() - start
+
+
+def run_pool(render, images, processes):
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Spawn cost stays out of the measurement
+        list(pool.map(render, images[:processes], [SIZES] * processes))
+        start = time.perf_counter()
+        list(pool.map(render, images, [SIZES] * len(images)))
+        return time.perf_counter() - start
+
+
+def rates(elapsed, count, cores):
+    return {
+        'seconds': round(elapsed, 3),
+        'images_per_sec': round(count / elapsed, 2),
+        'images_per_sec_per_core': round(count / elapsed / cores, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    images = [make_jpeg(args.width, args.height, n) for n in range(args.images)]
+    results = {'cpus': os.cpu_count(), 'processes': args.processes, 'image_bytes': len(images[0])}
+    for name, render in (('naive', naive_render), ('render', imaging.render)):
+        results[name] = {
+            'serial': rates(run_serial(render, images), len(images), 1),
+            'pool': rates(run_pool(render, images, args.processes), len(images), args.processes),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Latency, S3 calls per request and peak memory of the main views over synthetic buckets.
+
+Each bucket size gets a fresh tree of `--fanout` folders per level, `--depth` levels deep,
+with the keys spread evenly over the leaf folders. Views are driven through the Django
+test client with token verification stubbed, against the in-process S3 stand-in.
+
+    python -m benchmarks.bench_views --keys 1000 10000 100000 --output run.json
+    python -m benchmarks.bench_views --keys 1000000 --samples 3 --compare run.json
+
+Folder stats caching is off unless --cache is given, so every listing reaches S3.
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from benchmarks.common import BUCKET, TOKEN, setup_django, summarize
+
+
+def leaf_folders(fanout, depth):
+    folders = ['']
+    for level in range(depth):
+        folders = [f'{parent}l{level}-{n:03}/' for parent in folders for n in range(fanout)]
+    return folders
+
+
+def populate(standin, keys, fanout, depth):
+    bucket = standin.bucket(BUCKET)
+    with standin.lock:
+        bucket.objects.clear()
+        bucket.keys.clear()
+    leaves = leaf_folders(fanout, depth)
+    folders = set()
+    for leaf in leaves:
+        parts = leaf.split('/')[:-1]
+        folders.update('/'.join(parts[:n]) + '/' for n in range(1, len(parts) + 1))
+    for folder in sorted(folders):
+        standin.put_object(BUCKET, folder, metadata={'createdat': '2024-01-01 00:00:00+00:00'})
+    per_leaf, extra = divmod(keys, len(leaves))
+    for i, leaf in enumerate(leaves):
+        for n in range(per_leaf + (1 if i < extra else 0)):
+            standin.put_object(BUCKET, f'{leaf}img-{n:07}.jpg', data=None, size=2048)
+    return leaves
+
+
+def reset_state():
+    from mainApp import key_index, ngram_index, stats_cache
+    from mainApp.models import S3Object
+
+    stats_cache.get_cache().clear()
+    S3Object.objects.all().delete()
+    key_index.mark_stale()
+    ngram_index.reset()
+
+
+class Case:
+    def __init__(self, name, request, setup=None):
+        self.name = name
+        self.request = request
+        self.setup = setup
+
+
+def measure(standin, case, samples, memory_samples):
+    latencies = []
+    calls = {}
+    for n in range(samples):
+        if case.setup:
+            case.setup(n)
+        standin.reset_calls()
+        start = time.perf_counter()
+        response = case.request(n)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code in (200, 207), (case.name, response.status_code, response.content[:200])
+        for operation, count in standin.calls.items():
+            calls[operation] = calls.get(operation, 0) + count
+
+    # Separate pass: tracemalloc slows allocation-heavy code enough to distort latency
+    peaks = []
+    for n in range(samples, samples + memory_samples):
+        if case.setup:
+            case.setup(n)
+        tracemalloc.start()
+        case.request(n)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    result = summarize(latencies)
+    result['s3_calls_per_request'] = round(sum(calls.values()) / samples, 2)
+    result['s3_calls_by_operation'] = {op: round(count / samples, 2) for op, count in sorted(calls.items())}
+    if peaks:
+        result['peak_memory_kb'] = round(max(peaks) / 1024, 1)
+    return result
+
+
+def cases(client, leaves, upload_size):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    top = leaves[0].split('/')[0]
+    payload = os.urandom(upload_size)
+
+    # A top-level folder, since delete-file/ takes a single path segment as the folder
+    def upload(n):
+        return client.post('/upload-file/', {'folder_id': 'uploads',
+                                             'file': SimpleUploadedFile(f'upload-{n}.bin', payload)})
+
+    def uploaded(n):
+        # Deletes remove a file uploaded just for them
+        response = upload(1_000_000 + n)
+        assert response.status_code == 200, response.content
+
+    return [
+        Case('list_folders', lambda n: client.get('/list-folders/')),
+        Case('list_files_top', lambda n: client.get(f'/list-files/{top}/')),
+        Case('list_files_top_page', lambda n: client.get(f'/list-files/{top}/', {'limit': 100})),
+        Case('list_files_leaf', lambda n: client.get(f'/list-files/{leaves[-1]}')),
+        Case('search_scan', lambda n: client.get('/api/search/', {'q': 'img-00001'})),
+        Case('upload_file', upload),
+        Case('delete_file', lambda n: client.delete(f'/delete-file/uploads/upload-{1_000_000 + n}.bin/'),
+             setup=uploaded),
+    ]
+
+
+def run_size(standin, client, keys, args):
+    leaves = populate(standin, keys, args.fanout, args.depth)
+    reset_state()
+    results = {}
+    for case in cases(client, leaves, args.upload_size):
+        results[case.name] = measure(standin, case, args.samples, args.memory_samples)
+
+    if args.index:
+        from mainApp import key_index
+        from mainApp.clients import get_s3_client
+
+        start = time.perf_counter()
+        key_index.rebuild(get_s3_client(), BUCKET)
+        results['index_rebuild_s'] = round(time.perf_counter() - start, 3)
+        case = Case('search_index', lambda n: client.get('/api/search/', {'q': 'img-00001'}))
+        results[case.name] = measure(standin, case, args.samples, args.memory_samples)
+    return results
+
+
+def compare(baseline, current):
+    # Ratios above 1 mean the current run is slower or heavier
+    ratios = {}
+    for size, cases in current['runs'].items():
+        for name, result in cases.items():
+            before = baseline.get('runs', {}).get(size, {}).get(name)
+            if not isinstance(result, dict) or not isinstance(before, dict):
+                continue
+            ratios.setdefault(size, {})[name] = {
+                metric: round(result[metric] / before[metric], 3)
+                for metric in ('p50_ms', 'p95_ms', 's3_calls_per_request', 'peak_memory_kb')
+                if before.get(metric) and metric in result
+            }
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--fanout', type=int, default=10, help='subfolders per folder')
+    parser.add_argument('--depth', type=int, default=2, help='folder levels above the files')
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--memory-samples', type=int, default=1)
+    parser.add_argument('--upload-size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated S3 round trip (s)')
+    parser.add_argument('--cache', action='store_true', help='keep the folder stats cache on')
+    parser.add_argument('--index', action='store_true', help='also build the key index and time indexed search')
+    parser.add_argument('--output', help='write the JSON here as well as to stdout')
+    parser.add_argument('--compare', help='earlier --output to report ratios against')
+    args = parser.parse_args()
+
+    env = {'JOBS_EMBEDDED_WORKERS': 0}
+    if not args.cache:
+        env['FOLDER_STATS_CACHE_BACKEND'] = 'django.core.cache.backends.dummy.DummyCache'
+    standin = setup_django(latency=args.latency, **env)
+
+    from django.test import Client
+
+    client = Client(HTTP_AUTHORIZATION=TOKEN)
+    result = {
+        'config': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+        'runs': {str(keys): run_size(standin, client, keys, args) for keys in args.keys},
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            result['ratios'] = compare(json.load(f), result)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.s3_standin import S3StandIn
+
+BUCKET = 'bench-bucket'
+CLIENT_ID = 'bench-client-id'
+TOKEN = 'bench-token'
+
+
+class TokenInfoStub:
+    """Local stand-in for Google's tokeninfo endpoint that accepts every token.
+
+    Setting ``status`` makes it answer every request with that status and an error body instead.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.status = 200
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                stub.calls += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if stub.status == 200:
+                    body = json.dumps({'aud': CLIENT_ID, 'email': 'bench@example.com',
+                                       'exp': str(int(time.time()) + 3600)}).encode()
+                else:
+                    body = json.dumps({'error': 'invalid_token' if stub.status in (400, 401) else 'backend_error'}).encode()
+                self.send_response(stub.status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/tokeninfo'
+
+
+def setup_django(latency=0.0, connect_latency=0.0, **env):
+    standin = S3StandIn(latency=latency, connect_latency=connect_latency).start()
+    tokeninfo = TokenInfoStub()
+    os.environ.update({
+        'DJANGO_SETTINGS_MODULE': 'imgUploader.settings',
+        'DJANGO_SECRET_KEY': os.getenv('DJANGO_SECRET_KEY', 'benchmark'),
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_STORAGE_BUCKET_NAME': BUCKET,
+        'AWS_S3_ENDPOINT_URL': standin.endpoint_url,
+        'GOOGLE_OAUTH2_CLIENT_ID': CLIENT_ID,
+        'GOOGLE_TOKENINFO_URL': tokeninfo.url,
+        'DB_NAME': os.path.join(tempfile.mkdtemp(prefix='bench-'), 'db.sqlite3'),
+        'AWS_S3_PREWARM': 'False',
+    })
+    os.environ.update({name: str(value) for name, value in env.items()})
+
+    import django
+    from django.core.management import call_command
+
+    django.setup()
+    call_command('migrate', verbosity=0)
+    return standin
+
+
+def summarize(samples):
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': round(percentile(50) * 1000, 3),
+        'p95_ms': round(percentile(95) * 1000, 3),
+        'p99_ms': round(percentile(99) * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
@@ -0,0 +1,508 @@
+import base64
+import bisect
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from urllib.parse import parse_qs, quote_plus, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class S3Error(Exception):
+    def __init__(self, status, code, message=''):
+        super().__init__(message or code)
+        self.status = status
+        self.code = code
+        self.message = message or code
+
+
+class StoredObject:
+    __slots__ = ('data', 'size', 'etag', 'last_modified', 'metadata', 'content_type')
+
+    def __init__(self, data, size, etag, last_modified, metadata, content_type):
+        self.data = data
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.metadata = metadata
+        self.content_type = content_type
+
+    def read(self, start=0, end=None):
+        end = self.size if end is None else end
+        if self.data is None:
+            return b'\0' * (end - start)
+        return self.data[start:end]
+
+
+def _upper_bound(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+
+class Bucket:
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.keys = []
+        self.uploads = {}
+
+    def put(self, key, obj):
+        if key not in self.objects:
+            bisect.insort(self.keys, key)
+        self.objects[key] = obj
+
+    def delete(self, key):
+        if self.objects.pop(key, None) is not None:
+            i = bisect.bisect_left(self.keys, key)
+            del self.keys[i]
+
+    def list(self, prefix='', delimiter='', max_keys=1000, start=''):
+        contents = []
+        prefixes = []
+        keys = self.keys
+        i = bisect.bisect_left(keys, max(prefix, start))
+        while i < len(keys) and keys[i].startswith(prefix):
+            if len(contents) + len(prefixes) >= max_keys:
+                return contents, prefixes, keys[i]
+            key = keys[i]
+            if delimiter:
+                cut = key.find(delimiter, len(prefix))
+                if cut >= 0:
+                    common = key[:cut + len(delimiter)]
+                    prefixes.append(common)
+                    i = bisect.bisect_left(keys, _upper_bound(common))
+                    continue
+            contents.append((key, self.objects[key]))
+            i += 1
+        return contents, prefixes, None
+
+
+class LocalQueue:
+    """In-memory stand-in for an SQS queue, with the interface s3_events.Consumer reads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.visible = deque()
+        self.in_flight = {}
+
+    def send(self, body):
+        with self.lock:
+            self.visible.append(body)
+
+    def receive(self, max_messages, wait_seconds=0):
+        with self.lock:
+            messages = []
+            while self.visible and len(messages) < max_messages:
+                receipt = uuid.uuid4().hex
+                self.in_flight[receipt] = self.visible.popleft()
+                messages.append((receipt, self.in_flight[receipt]))
+            return messages
+
+    def delete(self, receipts):
+        with self.lock:
+            for receipt in receipts:
+                self.in_flight.pop(receipt, None)
+
+    def expire(self):
+        # Received but never deleted messages become visible again, as after a visibility timeout
+        with self.lock:
+            self.visible.extend(self.in_flight.values())
+            self.in_flight.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.visible) + len(self.in_flight)
+
+
+class S3StandIn:
+    """In-process S3 emulator speaking the subset of the REST API the views use.
+
+    ``latency`` is added to every request and ``connect_latency`` to every new
+    connection, to approximate S3 round trips and TLS handshakes. A fraction
+    ``throttle_rate`` of requests is answered with 503 SlowDown. When ``events`` is a
+    queue (e.g. LocalQueue), every write through the REST API sends it an S3 event
+    notification.
+    """
+
+    def __init__(self, latency=0.0, connect_latency=0.0, throttle_rate=0.0, host='127.0.0.1', port=0, events=None):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.throttle_rate = throttle_rate
+        self.events = events
+        self._sequencer = 0
+        self.buckets = {}
+        self.lock = threading.RLock()
+        self.calls = {}
+        self.connections = 0
+        self._server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def bucket(self, name):
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = Bucket(name)
+            return self.buckets[name]
+
+    def put_object(self, bucket, key, data=b'', size=None, last_modified=None, metadata=None, content_type='binary/octet-stream'):
+        if data is None:
+            etag = hashlib.md5(f'{key}:{size}'.encode()).hexdigest()
+        else:
+            size = len(data)
+            etag = hashlib.md5(data).hexdigest()
+        obj = StoredObject(data, size, etag, last_modified or datetime.now(timezone.utc),
+                           dict(metadata or {}), content_type)
+        with self.lock:
+            self.bucket(bucket).put(key, obj)
+        return obj
+
+    def notify(self, event_name, bucket, key, obj=None):
+        if self.events is None:
+            return
+        with self.lock:
+            self._sequencer += 1
+            sequencer = f'{self._sequencer:016X}'
+        details = {'key': quote_plus(key), 'sequencer': sequencer}
+        if obj is not None:
+            details.update(size=obj.size, eTag=obj.etag)
+        self.events.send(json.dumps({'Records': [{
+            'eventVersion': '2.1',
+            'eventSource': 'aws:s3',
+            'eventTime': _iso(datetime.now(timezone.utc)),
+            'eventName': event_name,
+            's3': {'bucket': {'name': bucket}, 'object': details},
+        }]}))
+
+    def record_call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = {}
+            self.connections = 0
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+def _iso(dt):
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def _http_date(dt):
+    return dt.astimezone(timezone.utc).strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+
+def _encode_token(key):
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def _decode_token(token):
+    return base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8')
+
+
+def _make_handler(standin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            with standin.lock:
+                standin.connections += 1
+            if standin.connect_latency:
+                time.sleep(standin.connect_latency)
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_HEAD(self):
+            self._dispatch('HEAD')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_DELETE(self):
+            self._dispatch('DELETE')
+
+        def _dispatch(self, method):
+            url = urlsplit(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+            path = unquote(url.path).lstrip('/')
+            bucket_name, _, key = path.partition('/')
+            body = self._read_body()
+            if standin.latency:
+                time.sleep(standin.latency)
+            try:
+                if standin.throttle_rate and random.random() < standin.throttle_rate:
+                    standin.record_call('Throttled')
+                    raise S3Error(503, 'SlowDown', 'Please reduce your request rate.')
+                bucket = standin.bucket(bucket_name)
+                if not key:
+                    self._bucket_op(method, bucket, query, body)
+                else:
+                    self._object_op(method, bucket, key, query, body)
+            except S3Error as e:
+                payload = (f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{e.code}</Code>'
+                           f'<Message>{escape(e.message)}</Message></Error>').encode()
+                self._respond(e.status, payload if method != 'HEAD' else b'')
+
+        def _read_body(self):
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        break
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+                return b''.join(chunks)
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def _respond(self, status, body=b'', headers=None, content_length=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body) if content_length is None else content_length))
+            self.end_headers()
+            if body and self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def _xml(self, body):
+            self._respond(200, ('<?xml version="1.0" encoding="UTF-8"?>' + body).encode('utf-8'),
+                          {'Content-Type': 'application/xml'})
+
+        def _bucket_op(self, method, bucket, query, body):
+            if method == 'GET' and query.get('list-type') == '2':
+                standin.record_call('ListObjectsV2')
+                self._list_objects_v2(bucket, query)
+            elif method == 'POST' and 'delete' in query:
+                standin.record_call('DeleteObjects')
+                self._delete_objects(bucket, body)
+            elif method == 'HEAD':
+                standin.record_call('HeadBucket')
+                self._respond(200)
+            else:
+                raise S3Error(501, 'NotImplemented', f'{method} on bucket')
+
+        def _list_objects_v2(self, bucket, query):
+            prefix = query.get('prefix', '')
+            delimiter = query.get('delimiter', '')
+            max_keys = int(query.get('max-keys', 1000))
+            start = query['start-after'] + '\0' if query.get('start-after') else ''
+            if query.get('continuation-token'):
+                start = _decode_token(query['continuation-token'])
+            with standin.lock:
+                contents, prefixes, next_key = bucket.list(prefix, delimiter, max_keys, start)
+            parts = [f'<ListBucketResult xmlns="{S3_NS}"><Name>{escape(bucket.name)}</Name>',
+                     f'<Prefix>{escape(prefix)}</Prefix><MaxKeys>{max_keys}</MaxKeys>',
+                     f'<KeyCount>{len(contents) + len(prefixes)}</KeyCount>']
+            if delimiter:
+                parts.append(f'<Delimiter>{escape(delimiter)}</Delimiter>')
+            parts.append(f'<IsTruncated>{"true" if next_key else "false"}</IsTruncated>')
+            if query.get('continuation-token'):
+                parts.append(f'<ContinuationToken>{escape(query["continuation-token"])}</ContinuationToken>')
+            if next_key:
+                parts.append(f'<NextContinuationToken>{_encode_token(next_key)}</NextContinuationToken>')
+            for key, obj in contents:
+                parts.append(f'<Contents><Key>{escape(key)}</Key><LastModified>{_iso(obj.last_modified)}</LastModified>'
+                             f'<ETag>"{obj.etag}"</ETag><Size>{obj.size}</Size><StorageClass>STANDARD</StorageClass></Contents>')
+            for common in prefixes:
+                parts.append(f'<CommonPrefixes><Prefix>{escape(common)}</Prefix></CommonPrefixes>')
+            parts.append('</ListBucketResult>')
+            self._xml(''.join(parts))
+
+        def _delete_objects(self, bucket, body):
+            root = ElementTree.fromstring(body)
+            keys = [el.text or '' for el in root.iter() if el.tag.endswith('Key')]
+            with standin.lock:
+                for key in keys:
+                    bucket.delete(key)
+            for key in keys:
+                standin.notify('ObjectRemoved:Delete', bucket.name, key)
+            deleted = ''.join(f'<Deleted><Key>{escape(key)}</Key></Deleted>' for key in keys)
+            self._xml(f'<DeleteResult xmlns="{S3_NS}">{deleted}</DeleteResult>')
+
+        def _get(self, bucket, key):
+            with standin.lock:
+                obj = bucket.objects.get(key)
+            if obj is None:
+                raise S3Error(404, 'NoSuchKey', 'The specified key does not exist.')
+            return obj
+
+        def _copy_source(self):
+            source = unquote(self.headers['x-amz-copy-source']).lstrip('/')
+            source_bucket, _, source_key = source.partition('/')
+            source_key = source_key.split('?versionId=')[0]
+            return self._get(standin.bucket(source_bucket), source_key)
+
+        def _object_headers(self, obj):
+            headers = {'ETag': f'"{obj.etag}"', 'Last-Modified': _http_date(obj.last_modified),
+                       'Content-Type': obj.content_type, 'Accept-Ranges': 'bytes'}
+            for name, value in obj.metadata.items():
+                headers[f'x-amz-meta-{name}'] = value
+            return headers
+
+        def _object_op(self, method, bucket, key, query, body):
+            if method == 'HEAD':
+                standin.record_call('HeadObject')
+                obj = self._get(bucket, key)
+                self._respond(200, headers=self._object_headers(obj), content_length=obj.size)
+            elif method == 'GET':
+                standin.record_call('GetObject')
+                obj = self._get(bucket, key)
+                if_match = self.headers.get('If-Match')
+                if if_match and if_match.strip('"') != obj.etag:
+                    raise S3Error(412, 'PreconditionFailed', 'At least one of the pre-conditions you specified did not hold')
+                headers = self._object_headers(obj)
+                byte_range = self.headers.get('Range')
+                if byte_range:
+                    first, _, last = byte_range.split('=', 1)[1].partition('-')
+                    start = int(first)
+                    end = min(int(last) + 1, obj.size) if last else obj.size
+                    headers['Content-Range'] = f'bytes {start}-{end - 1}/{obj.size}'
+                    self._respond(206, obj.read(start, end), headers)
+                else:
+                    self._respond(200, obj.read(), headers)
+            elif method == 'PUT' and 'uploadId' in query:
+                self._upload_part(bucket, key, query, body)
+            elif method == 'PUT' and 'x-amz-copy-source' in self.headers:
+                standin.record_call('CopyObject')
+                source = self._copy_source()
+                if_match = self.headers.get('x-amz-copy-source-if-match')
+                if if_match and if_match.strip('"') != source.etag:
+                    raise S3Error(412, 'PreconditionFailed', 'At least one of the pre-conditions you specified did not hold')
+                content_type = source.content_type
+                if self.headers.get('x-amz-metadata-directive', 'COPY').upper() == 'REPLACE':
+                    metadata = self._request_metadata()
+                    content_type = self.headers.get('Content-Type', content_type)
+                else:
+                    metadata = source.metadata
+                obj = StoredObject(source.data, source.size, source.etag, datetime.now(timezone.utc),
+                                   dict(metadata), content_type)
+                with standin.lock:
+                    bucket.put(key, obj)
+                standin.notify('ObjectCreated:Copy', bucket.name, key, obj)
+                self._xml(f'<CopyObjectResult><LastModified>{_iso(obj.last_modified)}</LastModified>'
+                          f'<ETag>"{obj.etag}"</ETag></CopyObjectResult>')
+            elif method == 'PUT':
+                standin.record_call('PutObject')
+                obj = standin.put_object(bucket.name, key, body, metadata=self._request_metadata(),
+                                         content_type=self.headers.get('Content-Type', 'binary/octet-stream'))
+                standin.notify('ObjectCreated:Put', bucket.name, key, obj)
+                self._respond(200, headers={'ETag': f'"{obj.etag}"'})
+            elif method == 'DELETE' and 'uploadId' in query:
+                standin.record_call('AbortMultipartUpload')
+                with standin.lock:
+                    if bucket.uploads.pop(query['uploadId'], None) is None:
+                        raise S3Error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+                self._respond(204)
+            elif method == 'DELETE':
+                standin.record_call('DeleteObject')
+                with standin.lock:
+                    bucket.delete(key)
+                standin.notify('ObjectRemoved:Delete', bucket.name, key)
+                self._respond(204)
+            elif method == 'POST' and 'uploads' in query:
+                standin.record_call('CreateMultipartUpload')
+                upload_id = uuid.uuid4().hex
+                with standin.lock:
+                    bucket.uploads[upload_id] = {'key': key, 'parts': {}, 'metadata': self._request_metadata(),
+                                                 'content_type': self.headers.get('Content-Type', 'binary/octet-stream')}
+                self._xml(f'<InitiateMultipartUploadResult xmlns="{S3_NS}"><Bucket>{escape(bucket.name)}</Bucket>'
+                          f'<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+            elif method == 'POST' and 'uploadId' in query:
+                self._complete_multipart(bucket, key, query, body)
+            else:
+                raise S3Error(501, 'NotImplemented', f'{method} on object')
+
+        def _request_metadata(self):
+            return {name[len('x-amz-meta-'):].lower(): value for name, value in self.headers.items()
+                    if name.lower().startswith('x-amz-meta-')}
+
+        def _upload_part(self, bucket, key, query, body):
+            with standin.lock:
+                upload = bucket.uploads.get(query['uploadId'])
+            if upload is None:
+                raise S3Error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+            part_number = int(query['partNumber'])
+            if 'x-amz-copy-source' in self.headers:
+                standin.record_call('UploadPartCopy')
+                source = self._copy_source()
+                source_range = self.headers.get('x-amz-copy-source-range')
+                if source_range:
+                    first, _, last = source_range.split('=', 1)[1].partition('-')
+                    body = source.read(int(first), int(last) + 1)
+                else:
+                    body = source.read()
+            else:
+                standin.record_call('UploadPart')
+            etag = hashlib.md5(body).hexdigest()
+            with standin.lock:
+                upload['parts'][part_number] = (etag, body)
+            if 'x-amz-copy-source' in self.headers:
+                self._xml(f'<CopyPartResult><LastModified>{_iso(datetime.now(timezone.utc))}</LastModified>'
+                          f'<ETag>"{etag}"</ETag></CopyPartResult>')
+            else:
+                self._respond(200, headers={'ETag': f'"{etag}"'})
+
+        def _complete_multipart(self, bucket, key, query, body):
+            standin.record_call('CompleteMultipartUpload')
+            with standin.lock:
+                upload = bucket.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                raise S3Error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+            root = ElementTree.fromstring(body)
+            numbers = [int(el.text) for el in root.iter() if el.tag.endswith('PartNumber')]
+            try:
+                parts = [upload['parts'][n] for n in numbers]
+            except KeyError:
+                raise S3Error(400, 'InvalidPart', 'One or more of the specified parts could not be found.')
+            data = b''.join(part for _, part in parts)
+            digest = hashlib.md5(b''.join(bytes.fromhex(etag) for etag, _ in parts)).hexdigest()
+            obj = StoredObject(data, len(data), f'{digest}-{len(parts)}', datetime.now(timezone.utc),
+                               upload['metadata'], upload['content_type'])
+            with standin.lock:
+                bucket.put(key, obj)
+            standin.notify('ObjectCreated:CompleteMultipartUpload', bucket.name, key, obj)
+            self._xml(f'<CompleteMultipartUploadResult xmlns="{S3_NS}"><Bucket>{escape(bucket.name)}</Bucket>'
+                      f'<Key>{escape(key)}</Key><ETag>"{obj.etag}"</ETag></CompleteMultipartUploadResult>')
+
+    return Handler
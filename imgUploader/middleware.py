@@ -1,38 +1,121 @@
 import logging
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
 from django.http import JsonResponse
-import requests
+from django.utils.deprecation import MiddlewareMixin
+from social_django import middleware as social_middleware
+from imgUploader.token_cache import InvalidToken, TokenInfoUnavailable, averify_google_token, verify_google_token
+from mainApp import metrics
 
 logger = logging.getLogger(__name__)
 
+class SocialAuthExceptionMiddleware(social_middleware.SocialAuthExceptionMiddleware, MiddlewareMixin):
+    # social_django's version is sync-only, which would push every request below it in
+    # MIDDLEWARE (including the async views) through one thread-sensitive worker.
+    # It only adds process_exception, so MiddlewareMixin can serve both modes.
+    __init__ = MiddlewareMixin.__init__
+    __call__ = MiddlewareMixin.__call__
+
+class MetricsMiddleware:
+    # Outermost, so its timings include authentication. Streaming bodies are timed only
+    # until the response object is returned.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def finish(self, request, response, recorder):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics.http_duration.observe(time.perf_counter() - recorder.started, view)
+        metrics.http_requests.inc(view, request.method, response.status_code)
+        response['Server-Timing'] = recorder.server_timing()
+        return response
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        recorder, token = metrics.start_request()
+        try:
+            return self.finish(request, self.get_response(request), recorder)
+        finally:
+            metrics.end_request(token)
+
+    async def __acall__(self, request):
+        recorder, token = metrics.start_request()
+        try:
+            return self.finish(request, await self.get_response(request), recorder)
+        finally:
+            metrics.end_request(token)
+
 class GoogleAuthMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def exempt(self, request):
+        return request.path in ['/api/google-login/', '/metrics', '/api/s3-events/']
+
+    def no_token(self):
+        return JsonResponse({'success': False, 'error': 'No token provided'}, status=401)
+
+    def authorize(self, request, idinfo):
+        if idinfo['aud'] != settings.GOOGLE_OAUTH2_CLIENT_ID:
+            return JsonResponse({'success': False, 'error': 'Unauthorized'}, status=401)
+        request.user_info = idinfo
+        return None
+
+    def rejected(self, error):
+        if isinstance(error, InvalidToken):
+            return JsonResponse({'success': False, 'error': 'Invalid token'}, status=401)
+        logger.error(f'Error verifying token: {str(error)}')
+        if isinstance(error, TokenInfoUnavailable):
+            # Not the token's fault: a 503 the client can retry, not a 401 that logs it out
+            response = JsonResponse({'success': False, 'error': 'Token verification unavailable'}, status=503)
+            response['Retry-After'] = '1'
+            return response
+        return JsonResponse({'success': False, 'error': 'Error verifying token'}, status=401)
 
     def __call__(self, request):
-        if request.path in ['/api/google-login/']:
+        if self.is_async:
+            return self.__acall__(request)
+        if self.exempt(request):
             return self.get_response(request)
-        
+
+        token = request.headers.get('Authorization')
+
+        if not token:
+            return self.no_token()
+
+        try:
+            denied = self.authorize(request, verify_google_token(token))
+        except Exception as e:
+            return self.rejected(e)
+
+        return denied or self.get_response(request)
+
+    async def __acall__(self, request):
+        if self.exempt(request):
+            return await self.get_response(request)
+
         token = request.headers.get('Authorization')
 
         if not token:
-            return JsonResponse({'success': False, 'error': 'No token provided'}, status=401)
+            return self.no_token()
 
         try:
-            
-            response = requests.get(f'https://www.googleapis.com/oauth2/v3/tokeninfo?access_token={token}')
-            
-            if response.status_code != 200:
-                return JsonResponse({'success': False, 'error': 'Invalid token'}, status=401)
-            
-            idinfo = response.json()
-            
-            if idinfo['aud'] != settings.GOOGLE_OAUTH2_CLIENT_ID:
-                return JsonResponse({'success': False, 'error': 'Unauthorized'}, status=401)
-            
-            request.user_info = idinfo
+            denied = self.authorize(request, await averify_google_token(token))
         except Exception as e:
-            logger.error(f'Error verifying token: {str(e)}')
-            return JsonResponse({'success': False, 'error': 'Error verifying token'}, status=401)
+            return self.rejected(e)
 
-        return self.get_response(request)
+        return denied or await self.get_response(request)
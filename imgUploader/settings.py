@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load the .env file
@@ -13,6 +14,10 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv('DJANGO_SECRET_KEY')
+# The test suite signs cursors, upload tokens and sessions; give it a throwaway key when
+# none is set (override_settings can't stand in: restoring an empty key raises)
+if not SECRET_KEY and sys.argv[1:2] == ['test']:
+    SECRET_KEY = 'test-only-secret-key'
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.getenv('DJANGO_DEBUG', 'False') == 'True'
@@ -43,6 +48,7 @@ CORS_ALLOW_ALL_ORIGINS = True  # For development
 CORS_ALLOW_CREDENTIALS = True
 
 MIDDLEWARE = [
+    'imgUploader.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -50,7 +56,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'social_django.middleware.SocialAuthExceptionMiddleware',
+    'imgUploader.middleware.SocialAuthExceptionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'imgUploader.middleware.GoogleAuthMiddleware'
@@ -148,6 +154,19 @@ LOGOUT_REDIRECT_URL = 'login'
 SOCIAL_AUTH_URL_NAMESPACE = 'social'
 
 GOOGLE_OAUTH2_CLIENT_ID=os.getenv('GOOGLE_OAUTH2_CLIENT_ID')
+GOOGLE_TOKENINFO_URL = os.getenv('GOOGLE_TOKENINFO_URL', 'https://www.googleapis.com/oauth2/v3/tokeninfo')
+GOOGLE_TOKENINFO_TIMEOUT = float(os.getenv('GOOGLE_TOKENINFO_TIMEOUT', '5'))
+
+# /metrics skips Google auth for Prometheus, so it answers only 'Authorization: Bearer <token>'
+# with this token; without one it is off unless METRICS_PUBLIC opts into serving it to anyone
+METRICS_AUTH_TOKEN = os.getenv('METRICS_AUTH_TOKEN', '')
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', 'False') == 'True'
+
+# Verified tokens are cached for at most this many seconds (never past the token's exp)
+GOOGLE_TOKEN_CACHE_SIZE = int(os.getenv('GOOGLE_TOKEN_CACHE_SIZE', '1024'))
+GOOGLE_TOKEN_CACHE_TTL = int(os.getenv('GOOGLE_TOKEN_CACHE_TTL', '300'))
+# Rejected tokens are remembered for this long; 0 disables the negative cache
+GOOGLE_TOKEN_NEGATIVE_CACHE_TTL = int(os.getenv('GOOGLE_TOKEN_NEGATIVE_CACHE_TTL', '0'))
 SOCIAL_AUTH_GOOGLE_OAUTH2_KEY = os.getenv('GOOGLE_OAUTH2_KEY')
 SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET = os.getenv('GOOGLE_OAUTH2_SECRET')
 SOCIAL_AUTH_GOOGLE_OAUTH2_REDIRECT_URI = os.getenv('SOCIAL_AUTH_GOOGLE_OAUTH2_REDIRECT_URI')
@@ -193,6 +212,155 @@ AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = os.getenv('AWS_STORAGE_BUCKET_NAME')
 AWS_S3_REGION_NAME = os.getenv('AWS_DEFAULT_REGION')
 
+AWS_S3_ENDPOINT_URL = os.getenv('AWS_S3_ENDPOINT_URL') or None
+
+# Folder fan-out and streamed upload parts run on one process-wide pool of
+# S3_CONCURRENCY_MAX threads. How many run at once adapts between S3_CONCURRENCY_MIN and
+# MAX: one more after each window of untroubled S3 calls, times S3_CONCURRENCY_BACKOFF
+# (at most once per S3_CONCURRENCY_COOLDOWN seconds) on throttling, or when an operation's
+# recent latency is S3_LATENCY_TOLERANCE times its usual. A request runs at most
+# S3_FANOUT_WORKERS tasks at once and takes turns with the others. New requests get a 503
+# with Retry-After while S3_FANOUT_MAX_QUEUE tasks are waiting, or the oldest has waited
+# S3_FANOUT_MAX_QUEUE_WAIT seconds.
+S3_FANOUT_WORKERS = int(os.getenv('S3_FANOUT_WORKERS', '32'))
+S3_CONCURRENCY_MIN = int(os.getenv('S3_CONCURRENCY_MIN', '4'))
+S3_CONCURRENCY_MAX = int(os.getenv('S3_CONCURRENCY_MAX', '64'))
+S3_CONCURRENCY_BACKOFF = float(os.getenv('S3_CONCURRENCY_BACKOFF', '0.7'))
+S3_CONCURRENCY_COOLDOWN = float(os.getenv('S3_CONCURRENCY_COOLDOWN', '1'))
+S3_LATENCY_TOLERANCE = float(os.getenv('S3_LATENCY_TOLERANCE', '4'))
+S3_FANOUT_MAX_QUEUE = int(os.getenv('S3_FANOUT_MAX_QUEUE', '2000'))
+S3_FANOUT_MAX_QUEUE_WAIT = float(os.getenv('S3_FANOUT_MAX_QUEUE_WAIT', '5'))
+# Shared S3 client: the connection pool must cover the pool above plus request threads
+AWS_S3_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_S3_MAX_POOL_CONNECTIONS', str(S3_CONCURRENCY_MAX * 2)))
+AWS_S3_MAX_ATTEMPTS = int(os.getenv('AWS_S3_MAX_ATTEMPTS', '5'))
+AWS_S3_CONNECT_TIMEOUT = float(os.getenv('AWS_S3_CONNECT_TIMEOUT', '5'))
+AWS_S3_READ_TIMEOUT = float(os.getenv('AWS_S3_READ_TIMEOUT', '60'))
+AWS_S3_PREWARM = os.getenv('AWS_S3_PREWARM', 'True') == 'True'
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '32'))
+
+# The async views share one aiohttp pool per event loop, so it can be much larger
+# than the thread-bound pool above. At most ASYNC_LISTING_CONCURRENCY listings run on
+# a loop at once and later ones queue, so a burst is served in arrival order instead
+# of every request in it finishing at the end
+AWS_S3_ASYNC_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_S3_ASYNC_MAX_POOL_CONNECTIONS', '256'))
+AWS_S3_ASYNC_KEEPALIVE_TIMEOUT = float(os.getenv('AWS_S3_ASYNC_KEEPALIVE_TIMEOUT', '30'))
+ASYNC_LISTING_CONCURRENCY = int(os.getenv('ASYNC_LISTING_CONCURRENCY', '64'))
+
+# Uploads: part size (S3 minimum is 5 MiB), parallel parts per upload, and how many
+# parts a streaming upload may buffer before it stops reading the request body
+S3_UPLOAD_PART_SIZE = int(os.getenv('S3_UPLOAD_PART_SIZE', str(8 * 1024 * 1024)))
+S3_UPLOAD_CONCURRENCY = int(os.getenv('S3_UPLOAD_CONCURRENCY', '4'))
+S3_UPLOAD_MAX_IN_FLIGHT_PARTS = int(os.getenv('S3_UPLOAD_MAX_IN_FLIGHT_PARTS', str(S3_UPLOAD_CONCURRENCY * 2)))
+# Process-wide pool shared by batch uploads and other bulk transfers
+S3_TRANSFER_WORKERS = int(os.getenv('S3_TRANSFER_WORKERS', '16'))
+S3_PRESIGNED_URL_EXPIRY = int(os.getenv('S3_PRESIGNED_URL_EXPIRY', '3600'))
+
+# Folder deletes run up to this many 1000-key DeleteObjects batches at once; folders
+# with more than S3_DELETE_INLINE_MAX_KEYS keys are deleted by a background job
+S3_DELETE_CONCURRENCY = int(os.getenv('S3_DELETE_CONCURRENCY', '8'))
+S3_DELETE_MAX_ATTEMPTS = int(os.getenv('S3_DELETE_MAX_ATTEMPTS', '6'))
+S3_DELETE_BACKOFF_BASE = float(os.getenv('S3_DELETE_BACKOFF_BASE', '0.2'))
+S3_DELETE_INLINE_MAX_KEYS = int(os.getenv('S3_DELETE_INLINE_MAX_KEYS', '1000'))
+
+# Folder moves copy server-side: CopyObject below S3_COPY_MULTIPART_THRESHOLD bytes,
+# parallel UploadPartCopy ranges of S3_COPY_PART_SIZE above it. Folders with more than
+# S3_MOVE_INLINE_MAX_KEYS keys are moved by a checkpointed background job.
+S3_COPY_MULTIPART_THRESHOLD = int(os.getenv('S3_COPY_MULTIPART_THRESHOLD', str(256 * 1024 * 1024)))
+S3_COPY_PART_SIZE = int(os.getenv('S3_COPY_PART_SIZE', str(64 * 1024 * 1024)))
+S3_MOVE_INLINE_MAX_KEYS = int(os.getenv('S3_MOVE_INLINE_MAX_KEYS', '200'))
+
+# Folder ZIP downloads fetch up to ZIP_DOWNLOAD_PREFETCH objects ahead of the entry being
+# written. Bodies up to ZIP_DOWNLOAD_BUFFER_BYTES are read ahead whole and larger ones are
+# streamed when their turn comes, so a download holds at most PREFETCH * BUFFER_BYTES.
+ZIP_DOWNLOAD_PREFETCH = int(os.getenv('ZIP_DOWNLOAD_PREFETCH', '8'))
+ZIP_DOWNLOAD_BUFFER_BYTES = int(os.getenv('ZIP_DOWNLOAD_BUFFER_BYTES', str(1024 * 1024)))
+
+# Identical concurrent listing and search GETs (same path, query and version) share one
+# computation. Waiters give up after SINGLE_FLIGHT_TIMEOUT seconds and compute their own.
+# Naming a cache in SINGLE_FLIGHT_CACHE_ALIAS coalesces across the processes sharing it;
+# results stay there for SINGLE_FLIGHT_RESULT_TTL seconds, and are keyed by version.
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'True') == 'True'
+SINGLE_FLIGHT_TIMEOUT = int(os.getenv('SINGLE_FLIGHT_TIMEOUT', '30'))
+SINGLE_FLIGHT_CACHE_ALIAS = os.getenv('SINGLE_FLIGHT_CACHE_ALIAS', '')
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv('SINGLE_FLIGHT_RESULT_TTL', '2'))
+
+# Images have their dimensions, format, EXIF orientation and capture time read from their
+# first IMAGE_METADATA_HEADER_BYTES into a table that search and list-files filter on.
+# Images written around us are read with a ranged GET, widened once up to
+# IMAGE_METADATA_MAX_HEADER_BYTES when large EXIF or ICC blocks push the headers further.
+IMAGE_METADATA_ENABLED = os.getenv('IMAGE_METADATA_ENABLED', 'True') == 'True'
+IMAGE_METADATA_HEADER_BYTES = int(os.getenv('IMAGE_METADATA_HEADER_BYTES', str(256 * 1024)))
+IMAGE_METADATA_MAX_HEADER_BYTES = int(os.getenv('IMAGE_METADATA_MAX_HEADER_BYTES', str(4 * 1024 * 1024)))
+
+# S3 event notifications (ObjectCreated/ObjectRemoved) keep the key index and folder
+# rollups current when objects change outside our views. They are POSTed to
+# api/s3-events/ with 'Authorization: Bearer <S3_EVENTS_AUTH_TOKEN>' (the endpoint is
+# off while it is unset) or read from S3_EVENTS_QUEUE_URL by `manage.py consume_s3_events`,
+# which also reconciles against a full listing every S3_EVENTS_RECONCILE_INTERVAL seconds.
+# Removals are remembered for S3_EVENTS_TOMBSTONE_TTL so late ObjectCreated events lose.
+S3_EVENTS_AUTH_TOKEN = os.getenv('S3_EVENTS_AUTH_TOKEN', '')
+S3_EVENTS_QUEUE_URL = os.getenv('S3_EVENTS_QUEUE_URL', '')
+AWS_SQS_ENDPOINT_URL = os.getenv('AWS_SQS_ENDPOINT_URL') or None
+S3_EVENTS_RECONCILE_INTERVAL = int(os.getenv('S3_EVENTS_RECONCILE_INTERVAL', '3600'))
+S3_EVENTS_TOMBSTONE_TTL = int(os.getenv('S3_EVENTS_TOMBSTONE_TTL', '86400'))
+
+# Background jobs are queued in the database and run by `manage.py run_jobs`, which must
+# be deployed next to the web processes. JOBS_EMBEDDED_WORKERS > 0 also runs them on that
+# many threads in each web process, for single-process setups. Running jobs whose worker
+# has not heartbeated for JOBS_LEASE_SECONDS are handed to another worker.
+JOBS_WORKERS = int(os.getenv('JOBS_WORKERS', '4'))
+JOBS_EMBEDDED_WORKERS = int(os.getenv('JOBS_EMBEDDED_WORKERS', '0'))
+JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', '1'))
+JOBS_LEASE_SECONDS = int(os.getenv('JOBS_LEASE_SECONDS', '60'))
+JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', '3'))
+JOBS_RETRY_BACKOFF = float(os.getenv('JOBS_RETRY_BACKOFF', '5'))
+
+# Folder stats come from one flat listing of the prefix up to this many keys;
+# bigger trees are listed per child folder in parallel instead
+FOLDER_STATS_FLAT_MAX_KEYS = int(os.getenv('FOLDER_STATS_FLAT_MAX_KEYS', '20000'))
+
+# Folder listings and stats are cached per prefix. The default is an in-process LRU;
+# point FOLDER_STATS_CACHE_BACKEND/LOCATION at a shared backend (e.g. redis) to share
+# them between workers. With the default, invalidation is per process too: a write
+# served by one worker leaves the others' copies until the TTL, which also bounds
+# staleness from writes made outside our views.
+FOLDER_STATS_CACHE_ALIAS = 'folder_stats'
+FOLDER_STATS_CACHE_TTL = int(os.getenv('FOLDER_STATS_CACHE_TTL', '300'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    FOLDER_STATS_CACHE_ALIAS: {
+        'BACKEND': os.getenv('FOLDER_STATS_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('FOLDER_STATS_CACHE_LOCATION', 'folder-stats'),
+        'TIMEOUT': FOLDER_STATS_CACHE_TTL,
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('FOLDER_STATS_CACHE_MAX_ENTRIES', '10000')),
+        },
+    },
+}
+
+# Search n-gram index: optional on-disk snapshot, and how often a process checks
+# whether other processes have written through the key index since it was built
+SEARCH_INDEX_SNAPSHOT = os.getenv('SEARCH_INDEX_SNAPSHOT', '')
+SEARCH_INDEX_REFRESH_SECONDS = int(os.getenv('SEARCH_INDEX_REFRESH_SECONDS', '300'))
+
+# Uploaded images get one derivative per max-edge size, rendered by a background job in
+# a process pool and stored under DERIVED_PREFIX/<original key>/<etag>/, which listings hide
+THUMBNAILS_ENABLED = os.getenv('THUMBNAILS_ENABLED', 'True') == 'True'
+THUMBNAIL_SIZES = [int(size) for size in os.getenv('THUMBNAIL_SIZES', '128,512,1600').split(',')]
+THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'WEBP')
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '80'))
+THUMBNAIL_MAX_SOURCE_BYTES = int(os.getenv('THUMBNAIL_MAX_SOURCE_BYTES', str(50 * 1024 * 1024)))
+THUMBNAIL_PROCESSES = int(os.getenv('THUMBNAIL_PROCESSES', str(os.cpu_count() or 1)))
+DERIVED_PREFIX = os.getenv('DERIVED_PREFIX', '_derived/')
+
+# Uploads are SHA-256 hashed; content already in the bucket is server-side copied from
+# its first copy instead of being sent again. Small files are cheaper to just upload.
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'True') == 'True'
+DEDUP_MIN_BYTES = int(os.getenv('DEDUP_MIN_BYTES', str(256 * 1024)))
+
 AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.{AWS_S3_REGION_NAME}.amazonaws.com'
 
 DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
@@ -0,0 +1,212 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from mainApp import metrics
+from mainApp.clients import get_http_session
+
+logger = logging.getLogger(__name__)
+
+# What tokeninfo answers for an expired, revoked or malformed token; any other
+# failure says nothing about the token
+INVALID_STATUSES = {400, 401}
+
+
+class InvalidToken(ValueError):
+    def __init__(self, detail):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class TokenInfoUnavailable(Exception):
+    """tokeninfo could not be asked or did not answer; the token may well be valid, so this is never cached."""
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TokenCache:
+    def __init__(self, max_size=1024, ttl=300, negative_ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # digest -> (expires_at, idinfo, error); error is set for negative entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _cached(self, digest):
+        # Caller holds the lock; returns None on a miss, raises on a negative hit
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        expires_at, idinfo, error = entry
+        if expires_at <= time.monotonic():
+            del self._entries[digest]
+            return None
+        self._entries.move_to_end(digest)
+        if error is not None:
+            self.negative_hits += 1
+            raise error
+        self.hits += 1
+        return idinfo
+
+    def lookup(self, token):
+        with self._lock:
+            return self._cached(self._digest(token))
+
+    def verify(self, token, fetch):
+        digest = self._digest(token)
+
+        with self._lock:
+            idinfo = self._cached(digest)
+            if idinfo is not None:
+                return idinfo
+
+            call = self._inflight.get(digest)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._inflight[digest] = call
+                self.misses += 1
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            idinfo = fetch(token)
+            call.result = idinfo
+            self._store(digest, self._ttl_for(idinfo), idinfo, None)
+            return idinfo
+        except InvalidToken as e:
+            call.error = e
+            if self.negative_ttl:
+                self._store(digest, self.negative_ttl, None, e)
+            raise
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(digest, None)
+            call.event.set()
+
+    def _ttl_for(self, idinfo):
+        ttl = self.ttl
+        exp = idinfo.get('exp')
+        if exp is not None:
+            try:
+                ttl = min(ttl, int(exp) - time.time())
+            except (TypeError, ValueError):
+                logger.warning(f'Ignoring malformed token exp: {exp!r}')
+        return ttl
+
+    def _store(self, digest, ttl, idinfo, error):
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[digest] = (time.monotonic() + ttl, idinfo, error)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(self._digest(token), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'negative_hits': self.negative_hits,
+                'coalesced': self.coalesced,
+            }
+
+
+def fetch_tokeninfo(token):
+    start = time.perf_counter()
+    try:
+        response = get_http_session().get(
+            settings.GOOGLE_TOKENINFO_URL,
+            params={'access_token': token},
+            timeout=settings.GOOGLE_TOKENINFO_TIMEOUT,
+        )
+    except Exception as e:
+        metrics.observe_tokeninfo(time.perf_counter() - start, 'error')
+        if isinstance(e, requests.RequestException):
+            raise TokenInfoUnavailable(str(e)) from e
+        raise
+    if response.status_code == 200:
+        outcome = 'valid'
+    else:
+        outcome = 'invalid' if response.status_code in INVALID_STATUSES else 'error'
+    metrics.observe_tokeninfo(time.perf_counter() - start, outcome)
+    if response.status_code == 200:
+        return response.json()
+    try:
+        detail = response.json()
+    except ValueError:
+        detail = response.text
+    if response.status_code in INVALID_STATUSES:
+        raise InvalidToken(detail)
+    raise TokenInfoUnavailable(f'tokeninfo returned {response.status_code}: {detail}')
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                _token_cache = TokenCache(
+                    max_size=settings.GOOGLE_TOKEN_CACHE_SIZE,
+                    ttl=settings.GOOGLE_TOKEN_CACHE_TTL,
+                    negative_ttl=settings.GOOGLE_TOKEN_NEGATIVE_CACHE_TTL,
+                )
+    return _token_cache
+
+
+def verify_google_token(token):
+    return get_token_cache().verify(token, fetch_tokeninfo)
+
+
+async def averify_google_token(token):
+    # Cache hits are answered on the event loop; only a tokeninfo round trip needs a thread
+    idinfo = get_token_cache().lookup(token)
+    if idinfo is not None:
+        return idinfo
+    return await sync_to_async(verify_google_token, thread_sensitive=False)(token)
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.contrib.auth.views import LogoutView  
-from mainApp import views
+from mainApp import async_views, views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -9,8 +9,32 @@ urlpatterns = [
     path('list-folders/', views.list_folders, name='list-folders'),
     path('list-files/<path:folder_id>/', views.list_files, name='list-files'),
     path('upload-file/', views.upload_file, name='upload-file'),
+    path('upload-files/', views.upload_files, name='upload-files'),
+    path('api/uploads/presign/', views.presign_upload, name='presign-upload'),
+    path('api/uploads/complete/', views.complete_upload, name='complete-upload'),
+    path('api/uploads/abort/', views.abort_upload, name='abort-upload'),
     path('delete-file/<str:folder_id>/<str:file_name>/', views.delete_file, name='delete-file'),
+    path('delete-folder/<path:folder_id>/', views.delete_file, name='delete-folder'),
+    path('download-folder/<path:folder_id>/', views.download_folder, name='download-folder'),
     path('create-folder/', views.create_folder, name='create-folder'),
+    path('move-folder/', views.move_folder, name='move-folder'),
     path('api/google-login/', views.google_login, name='google_login'),
     path('api/search/', views.search, name='search'),
+    path('api/jobs/', views.list_jobs, name='list-jobs'),
+    path('api/jobs/<int:job_id>/', views.job_status, name='job-status'),
+    path('api/jobs/<int:job_id>/cancel/', views.cancel_job, name='job-cancel'),
+    path('api/index/rebuild/', views.rebuild_index, name='rebuild-index'),
+    path('api/folder-stats/<path:folder_id>/', views.folder_stats_job, name='folder-stats-job'),
+    path('api/cache-stats/', views.cache_stats, name='cache-stats'),
+    path('api/dedup/report/', views.dedup_report, name='dedup-report'),
+    path('api/s3-events/', views.ingest_s3_events, name='s3-events'),
+    path('metrics', views.metrics_view, name='metrics'),
+    # Async variants of the S3-bound endpoints, for deployments served over ASGI
+    path('async/list-folders/', async_views.list_folders, name='async-list-folders'),
+    path('async/list-files/<path:folder_id>/', async_views.list_files, name='async-list-files'),
+    path('async/upload-file/', async_views.upload_file, name='async-upload-file'),
+    path('async/delete-file/<str:folder_id>/<str:file_name>/', async_views.delete_file, name='async-delete-file'),
+    path('async/delete-folder/<path:folder_id>/', async_views.delete_file, name='async-delete-folder'),
+    path('async/create-folder/', async_views.create_folder, name='async-create-folder'),
+    path('async/search/', async_views.search, name='async-search'),
 ]
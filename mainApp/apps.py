@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class MainappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mainApp'
+
+    def ready(self):
+        from mainApp import job_handlers  # noqa: F401  registers the background job kinds
+
+        if settings.AWS_S3_PREWARM:
+            from mainApp.clients import prewarm
+            prewarm()
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from mainApp import bulk_delete, clients, dedup, executors, folder_stats, stats_cache
+
+logger = logging.getLogger(__name__)
+
+
+# One semaphore per event loop, as asyncio primitives belong to the loop they run on
+_listing_slots = weakref.WeakKeyDictionary()
+
+
+def listing_slot():
+    """How many listings run on this loop at once; the rest wait their turn in arrival order."""
+    loop = asyncio.get_running_loop()
+    slot = _listing_slots.get(loop)
+    if slot is None:
+        slot = _listing_slots[loop] = asyncio.Semaphore(settings.ASYNC_LISTING_CONCURRENCY)
+    return slot
+
+
+async def gather_limited(func, items, limit=None):
+    # Sized by the adaptive limit when it starts; the shared pool is for threads only
+    semaphore = asyncio.Semaphore(limit or min(settings.S3_FANOUT_WORKERS, executors.concurrency_limit()))
+
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+async def paginate(s3_client, **kwargs):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    async for page in paginator.paginate(**kwargs):
+        yield page
+
+
+async def collect_tree(s3_client, bucket_name, prefix):
+    stats = folder_stats.TreeStats(prefix)
+    async for page in paginate(s3_client, Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            stats.add(obj)
+    return stats
+
+
+async def list_page(s3_client, bucket_name, prefix, limit, continuation_token=None):
+    page = folder_stats.Page(bucket_name, prefix, limit, continuation_token)
+    while not page.add(await s3_client.list_objects_v2(**page.request())):
+        pass
+    return page.result()
+
+
+async def _fan_out(s3_client, bucket_name, listing, start_after=None):
+    children = []
+    async for page in paginate(s3_client, **folder_stats.fan_out_params(bucket_name, listing.prefix, start_after)):
+        children.extend(listing.add_page(page))
+
+    for stats in await gather_limited(lambda child: collect_tree(s3_client, bucket_name, child), children):
+        listing.folders[stats.prefix] = stats
+    return listing
+
+
+async def list_prefix(s3_client, bucket_name, prefix, estimate=None):
+    # Same strategy as folder_stats.list_prefix, with the fan-out on the event loop
+    listing = folder_stats.Listing(prefix)
+    if estimate is None:
+        estimate = await sync_to_async(folder_stats.estimate_key_count)(prefix)
+    if folder_stats.needs_fan_out(estimate):
+        return await _fan_out(s3_client, bucket_name, listing)
+
+    scan = folder_stats.FlatScan(listing, estimate)
+    async for page in paginate(s3_client, Bucket=bucket_name, Prefix=prefix):
+        if not scan.add_page(page):
+            return await _fan_out(s3_client, bucket_name, listing, start_after=scan.complete_through)
+    return listing
+
+
+async def resolve_created_at(s3_client, bucket_name, stats_list):
+    markers, known, missing = await sync_to_async(folder_stats.markers_to_resolve)(list(stats_list))
+
+    async def head(prefix):
+        try:
+            return prefix, await s3_client.head_object(Bucket=bucket_name, Key=prefix)
+        except ClientError as e:
+            return folder_stats.unreadable_marker(prefix, e)
+    heads = await gather_limited(head, missing)
+    await sync_to_async(folder_stats.apply_created_at)(markers, known, heads)
+
+
+async def _get_or_compute(kind, prefix, compute):
+    cache_key, value = await sync_to_async(stats_cache.lookup, thread_sensitive=False)(kind, prefix)
+    if value is not None:
+        return value
+    start = time.perf_counter()
+    value = await compute()
+    await sync_to_async(stats_cache.store, thread_sensitive=False)(cache_key, value, time.perf_counter() - start)
+    return value
+
+
+async def get_listing(s3_client, bucket_name, prefix):
+    async def compute():
+        listing = await list_prefix(s3_client, bucket_name, prefix)
+        await resolve_created_at(s3_client, bucket_name, listing.folders.values())
+        return listing.as_dict()
+    return await _get_or_compute('listing', prefix, compute)
+
+
+async def get_tree(s3_client, bucket_name, prefix):
+    async def compute():
+        stats = await collect_tree(s3_client, bucket_name, prefix)
+        await resolve_created_at(s3_client, bucket_name, [stats])
+        return stats.as_dict()
+    return await _get_or_compute('tree', prefix, compute)
+
+
+async def get_trees(s3_client, bucket_name, children):
+    return await gather_limited(lambda child: get_tree(s3_client, bucket_name, child), children)
+
+
+async def key_exists(s3_client, bucket_name, key, delimiter=None):
+    kwargs = {'Bucket': bucket_name, 'Prefix': key, 'MaxKeys': 1}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    response = await s3_client.list_objects_v2(**kwargs)
+    return 'Contents' in response or 'CommonPrefixes' in response
+
+
+async def upload_fileobj(s3_client, bucket_name, key, file, content_type=None, metadata=None):
+    extra = {'ContentType': content_type or 'binary/octet-stream'}
+    if metadata:
+        extra['Metadata'] = metadata
+    part_size = settings.S3_UPLOAD_PART_SIZE
+    if file.size <= part_size:
+        body = await asyncio.to_thread(file.read)
+        response = await s3_client.put_object(Bucket=bucket_name, Key=key, Body=body, **extra)
+        return response['ETag'].strip('"')
+
+    response = await s3_client.create_multipart_upload(Bucket=bucket_name, Key=key, **extra)
+    upload_id = response['UploadId']
+    # Parts are read only once a slot is free, so at most S3_UPLOAD_CONCURRENCY are buffered
+    slots = asyncio.Semaphore(settings.S3_UPLOAD_CONCURRENCY)
+
+    async def send(part_number, data):
+        try:
+            response = await s3_client.upload_part(
+                Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            slots.release()
+
+    tasks = []
+    try:
+        while True:
+            await slots.acquire()
+            data = await asyncio.to_thread(file.read, part_size)
+            if not data:
+                slots.release()
+                break
+            tasks.append(asyncio.ensure_future(send(len(tasks) + 1, data)))
+        parts = await asyncio.gather(*tasks)
+        response = await s3_client.complete_multipart_upload(
+            Bucket=bucket_name, Key=key, UploadId=upload_id, MultipartUpload={'Parts': list(parts)})
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        try:
+            await s3_client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logger.error(f'Error aborting multipart upload of {key}: {str(e)}')
+        raise
+    return response['ETag'].strip('"')
+
+
+async def store_file(s3_client, bucket_name, key, file, content_type=None):
+    # dedup.store_file with the S3 calls on the event loop; returns (etag, deduplicated)
+    sha256, blob = await sync_to_async(dedup.lookup)(file)
+    if sha256 is None:
+        return await upload_fileobj(s3_client, bucket_name, key, file, content_type), False
+    if blob is not None:
+        try:
+            response = await s3_client.copy_object(**dedup.copy_params(blob, bucket_name, key, content_type))
+        except ClientError as e:
+            if not await sync_to_async(dedup.copy_failed)(blob, e):
+                raise
+        else:
+            return await sync_to_async(dedup.copied)(blob, response), True
+    etag = await upload_fileobj(s3_client, bucket_name, key, file, content_type, metadata={'sha256': sha256})
+    await sync_to_async(dedup.record)(sha256, file.size, key, etag)
+    return etag, False
+
+
+async def delete_batch(s3_client, bucket_name, keys):
+    batch = bulk_delete.BatchDelete(keys)
+    while True:
+        try:
+            response = await s3_client.delete_objects(Bucket=bucket_name, Delete=batch.request())
+        except ClientError as e:
+            delay = batch.failed(e)
+        else:
+            delay = batch.answered(response)
+        if delay is None:
+            return batch.deleted, batch.errors
+        await asyncio.sleep(delay)
+
+
+def _forget_deleted(bucket_name, keys):
+    bulk_delete.forget_deleted(clients.get_s3_client(), bucket_name, keys)
+
+
+async def delete_prefix(s3_client, bucket_name, prefix):
+    # Same as bulk_delete.delete_prefix: each listed page is deleted while the next is
+    # listed, and forgotten as soon as its batch is done
+    report = bulk_delete.DeleteReport()
+    in_flight = set()
+
+    async def collect(done):
+        for task in done:
+            deleted, errors = task.result()
+            report.add(deleted, errors)
+            await sync_to_async(_forget_deleted)(bucket_name, deleted)
+
+    try:
+        async for page in paginate(s3_client, Bucket=bucket_name, Prefix=prefix,
+                                   PaginationConfig={'PageSize': bulk_delete.BATCH_SIZE}):
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            if not keys:
+                continue
+            if len(in_flight) >= settings.S3_DELETE_CONCURRENCY:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                await collect(done)
+            in_flight.add(asyncio.ensure_future(delete_batch(s3_client, bucket_name, keys)))
+    finally:
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            await collect(done)
+    return report
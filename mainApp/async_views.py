@@ -0,0 +1,226 @@
+import logging
+import os
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+from django.http import JsonResponse
+from django.conf import settings
+
+from mainApp import async_s3, conditional, dedup, folder_stats, image_metadata, key_index, pagination, singleflight, stats_cache, streaming, thumbnails, views
+from mainApp.clients import get_async_s3_client, get_s3_client
+
+logger = logging.getLogger(__name__)
+
+
+def csrf_exempt(view):
+    # django.views.decorators.csrf.csrf_exempt wraps the view in a plain function on
+    # Django 4.2, which would hide the coroutine from the handler
+    view.csrf_exempt = True
+    return view
+
+
+async def get_listing(request, s3_client, bucket_name, prefix):
+    if not request.GET.get('limit'):
+        async with async_s3.listing_slot():
+            listing = await async_s3.get_listing(s3_client, bucket_name, prefix)
+        return listing['files'], views.by_last_modified(listing['folders']), None, True
+
+    limit, sort, token = pagination.page_params(request, prefix)
+    async with async_s3.listing_slot():
+        files, children, next_token = await async_s3.list_page(s3_client, bucket_name, prefix, limit, token)
+        folders = await async_s3.get_trees(s3_client, bucket_name, children)
+    next_cursor = pagination.encode_cursor(prefix, next_token, sort) if next_token else None
+    return files, folders, next_cursor, False
+
+
+async def listing_items(s3_client, bucket_name, prefix, file_item):
+    # views.listing_items, as an async iterator the response streams from the loop
+    async for page in async_s3.paginate(s3_client, Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        files, children = folder_stats.page_entries(page, prefix)
+        for obj in files:
+            yield dict(file_item(obj), type='file')
+        for stats in await async_s3.get_trees(s3_client, bucket_name, children):
+            yield dict(stats, type='folder')
+
+
+async def scan_search_items(s3_client, bucket_name, query, file_type, limit=None, offset=0):
+    scan = views.SearchScan(query, file_type, limit, offset)
+    async for page in async_s3.paginate(s3_client, Bucket=bucket_name, Prefix=''):
+        for obj in page.get('Contents', []):
+            item = scan.page(scan.match(obj['Key']))
+            if item is not None:
+                yield item
+            if scan.done:
+                return
+
+
+@conditional.versioned(views.listing_version)
+@singleflight.coalesce(views.listing_version)
+async def list_folders(request):
+    s3_client = await get_async_s3_client()
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    fmt = streaming.stream_format(request)
+    if fmt:
+        return streaming.stream_response(listing_items(s3_client, bucket_name, '', views.root_file_item), fmt)
+    try:
+        file_objects, folders, next_cursor, complete = await get_listing(request, s3_client, bucket_name, '')
+        return JsonResponse(views.folders_payload(file_objects, folders, next_cursor, complete))
+    except pagination.InvalidPageRequest as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return views.error_response(e)
+
+
+@conditional.versioned(views.listing_version)
+@singleflight.coalesce(views.listing_version)
+async def list_files(request, folder_id):
+    s3_client = await get_async_s3_client()
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    folder_key = folder_id.rstrip('/') + '/'
+    fmt = streaming.stream_format(request)
+    if image_metadata.requested(request):
+        return await sync_to_async(views.image_files_response)(request, folder_id, folder_key, fmt)
+    if fmt:
+        return streaming.stream_response(listing_items(s3_client, bucket_name, folder_key, views.folder_file_item), fmt)
+    try:
+        file_objects, folders, next_cursor, complete = await get_listing(request, s3_client, bucket_name, folder_key)
+        thumbnail_urls = await sync_to_async(thumbnails.urls_for)(file_objects)
+        return JsonResponse(views.files_payload(folder_id, file_objects, folders, next_cursor, complete, thumbnail_urls))
+    except pagination.InvalidPageRequest as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return views.error_response(e)
+
+
+@csrf_exempt
+@conditional.versioned(views.search_version)
+@singleflight.coalesce(views.search_version)
+async def search(request):
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Invalid request method'}, status=400)
+    query = request.GET.get('q', '')
+    file_type = request.GET.get('type', None)
+    images = image_metadata.requested(request)
+    if not query and not images:
+        return JsonResponse({'error': 'Query parameter is required'}, status=400)
+    try:
+        limit, offset = views.search_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'limit and offset must be integers'}, status=400)
+    fmt = streaming.stream_format(request)
+    if images:
+        return await sync_to_async(views.image_search_response)(request, query, file_type, limit, offset, fmt)
+
+    try:
+        result = await sync_to_async(views.index_search)(query, file_type, limit, offset)
+        if result is not None:
+            if fmt:
+                return streaming.stream_response(views.search_result_items(result), fmt)
+            return JsonResponse(result, status=200)
+    except Exception as e:
+        logger.error(f'Error searching key index, falling back to S3: {str(e)}')
+
+    try:
+        s3_client = await get_async_s3_client()
+        items = scan_search_items(s3_client, os.getenv('AWS_STORAGE_BUCKET_NAME'), query, file_type, limit, offset)
+        if fmt:
+            return streaming.stream_response(items, fmt)
+        result = {'files': [], 'folders': []}
+        async for item in items:
+            result[item['type'] + 's'].append(item['key'])
+        return JsonResponse(result, status=200)
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        return views.error_response(e)
+
+
+@csrf_exempt
+async def upload_file(request):
+    if request.method != 'POST' or 'file' not in await sync_to_async(views.hashed_files)(request):
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    folder_id = request.POST.get('folder_id')
+    if folder_id is None:
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    file = request.FILES['file']
+    file_name = request.POST.get('file_name', file.name)
+    file_key = os.path.join(folder_id, file_name)
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    try:
+        s3_client = await get_async_s3_client()
+        if await async_s3.key_exists(s3_client, bucket_name, file_key):
+            return JsonResponse({'error': 'A file with the same name already exists'}, status=400)
+        header = await sync_to_async(image_metadata.read_header)(file_key, file)
+        etag, deduplicated = await async_s3.store_file(s3_client, bucket_name, file_key, file, file.content_type)
+        await sync_to_async(key_index.record_object)(file_key, size=file.size, etag=etag)
+        await sync_to_async(image_metadata.record)(bucket_name, file_key, header, file.size, etag)
+        await sync_to_async(stats_cache.invalidate_key, thread_sensitive=False)(file_key)
+        await sync_to_async(thumbnails.schedule)(bucket_name, file_key, etag=etag, size=file.size)
+        return JsonResponse({'message': 'File uploaded successfully', 'deduplicated': deduplicated}, status=200)
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        return views.error_response(e)
+
+
+@csrf_exempt
+async def delete_file(request, folder_id, file_name=None):
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    try:
+        s3_client = await get_async_s3_client()
+        if file_name:
+            file_key = os.path.join(folder_id, file_name)
+            await s3_client.delete_object(Bucket=bucket_name, Key=file_key)
+            await sync_to_async(key_index.remove_object)(file_key)
+            await sync_to_async(stats_cache.invalidate_key, thread_sensitive=False)(file_key)
+            await sync_to_async(thumbnails.delete_for)(get_s3_client(), bucket_name, file_key)
+            await sync_to_async(dedup.forget)(file_key)
+            await sync_to_async(image_metadata.forget)(file_key)
+            return JsonResponse({'message': 'File deleted successfully'}, status=200)
+
+        folder_key = folder_id.rstrip('/') + '/'
+        response = await s3_client.list_objects_v2(
+            Bucket=bucket_name, Prefix=folder_key, MaxKeys=settings.S3_DELETE_INLINE_MAX_KEYS)
+        if not response.get('KeyCount', len(response.get('Contents', []))):
+            return JsonResponse({'error': 'Folder not found or empty'}, status=404)
+        if response.get('IsTruncated'):
+            # Large trees go to the same background job as the sync view
+            return await sync_to_async(views.start_folder_delete)(request, bucket_name, folder_key)
+        # Each batch's keys are forgotten as it finishes, as in bulk_delete.delete_folder
+        try:
+            report = await async_s3.delete_prefix(s3_client, bucket_name, folder_key)
+        finally:
+            await sync_to_async(stats_cache.invalidate_prefix, thread_sensitive=False)(folder_key)
+        return views.folder_deleted(report.as_dict())
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        return views.error_response(e)
+
+
+@csrf_exempt
+async def create_folder(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    parent_folder = request.POST.get('parent_folder', '')
+    folder_name = request.POST.get('folder_name')
+    if not folder_name:
+        return JsonResponse({'error': 'Folder name is required'}, status=400)
+
+    folder_key = os.path.join(parent_folder, folder_name).rstrip('/') + '/'
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    try:
+        s3_client = await get_async_s3_client()
+        if await async_s3.key_exists(s3_client, bucket_name, folder_key, delimiter='/'):
+            return JsonResponse({'error': 'Folder with the same name already exists'}, status=400)
+        created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S%z')
+        created_at = created_at[:-2] + ':' + created_at[-2:]
+        await s3_client.put_object(Bucket=bucket_name, Key=folder_key, Metadata={'createdAt': created_at})
+        await sync_to_async(key_index.record_object)(folder_key, created_at=views.parse_date(created_at))
+        await sync_to_async(stats_cache.invalidate_key, thread_sensitive=False)(folder_key)
+        return JsonResponse({'message': 'Folder created successfully'}, status=200)
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        return views.error_response(e)
@@ -0,0 +1,177 @@
+import logging
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from mainApp import dedup, executors, image_metadata, key_index, stats_cache, thumbnails
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+RETRYABLE_CODES = {'SlowDown', 'InternalError', 'ServiceUnavailable', 'RequestTimeout', 'Throttling'}
+
+
+class DeleteReport:
+    def __init__(self):
+        self.deleted = 0
+        self.errors = []
+
+    def add(self, deleted, errors):
+        self.deleted += len(deleted)
+        self.errors.extend(errors)
+
+    def as_dict(self):
+        return {'deleted_count': self.deleted, 'error_count': len(self.errors), 'errors': self.errors}
+
+
+def backoff_delay(attempt):
+    delay = settings.S3_DELETE_BACKOFF_BASE * (2 ** attempt)
+    return delay + random.uniform(0, delay)
+
+
+def error_entry(key, code, message):
+    return {'Key': key, 'Code': code, 'Message': message}
+
+
+def delete_request(keys):
+    return {'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+
+
+def classify(pending, response):
+    # Splits a DeleteObjects response into deleted keys, final errors and keys worth retrying
+    failed = {error['Key']: error for error in response.get('Errors', [])}
+    deleted = [key for key in pending if key not in failed]
+    retry = [key for key, error in failed.items() if error.get('Code') in RETRYABLE_CODES]
+    errors = [error_entry(key, error.get('Code'), error.get('Message'))
+              for key, error in failed.items() if error.get('Code') not in RETRYABLE_CODES]
+    return deleted, errors, retry
+
+
+class BatchDelete:
+    """The attempts at one DeleteObjects batch: send ``request()`` and report each outcome
+    to ``answered`` or ``failed``, which return how long to wait before trying again, or
+    None once every key is deleted or given up on.
+    """
+
+    def __init__(self, keys):
+        self.pending = list(keys)
+        self.deleted = []
+        self.errors = []
+        self.attempts = 0
+
+    def request(self):
+        return delete_request(self.pending)
+
+    def _retry(self):
+        self.attempts += 1
+        if self.attempts < settings.S3_DELETE_MAX_ATTEMPTS:
+            return backoff_delay(self.attempts - 1)
+        return None
+
+    def _give_up(self, code, message):
+        self.errors.extend(error_entry(key, code, message) for key in self.pending)
+        self.pending = []
+
+    def failed(self, error):
+        code = error.response.get('Error', {}).get('Code')
+        delay = self._retry() if code in RETRYABLE_CODES else None
+        if delay is None:
+            self._give_up(code, str(error))
+        return delay
+
+    def answered(self, response):
+        done, failed, self.pending = classify(self.pending, response)
+        self.deleted.extend(done)
+        self.errors.extend(failed)
+        if not self.pending:
+            return None
+        delay = self._retry()
+        if delay is None:
+            self._give_up('SlowDown', 'Gave up after retries')
+        return delay
+
+
+def delete_batch(s3_client, bucket_name, keys):
+    batch = BatchDelete(keys)
+    while True:
+        try:
+            response = s3_client.delete_objects(Bucket=bucket_name, Delete=batch.request())
+        except ClientError as e:
+            delay = batch.failed(e)
+        else:
+            delay = batch.answered(response)
+        if delay is None:
+            return batch.deleted, batch.errors
+        time.sleep(delay)
+
+
+def iter_batches(s3_client, bucket_name, prefix):
+    batch = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            batch.append(obj['Key'])
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def forget_deleted(s3_client, bucket_name, keys):
+    """Drop what the app keeps about ``keys`` now that they are gone from the bucket."""
+    keys = [key for key in keys if not thumbnails.is_derived(key)]
+    if not keys:
+        return
+    key_index.remove_keys(keys)
+    dedup.forget_keys(keys)
+    image_metadata.forget_keys(keys)
+    try:
+        thumbnails.delete_for_keys(s3_client, bucket_name, keys)
+    except Exception as e:
+        logger.error(f'Error deleting derivatives of {len(keys)} deleted objects: {str(e)}')
+
+
+def delete_prefix(s3_client, bucket_name, prefix, progress=None):
+    report = DeleteReport()
+    executor = executors.get_executor('transfers')
+    in_flight = set()
+
+    def collect(done):
+        for future in done:
+            deleted, errors = future.result()
+            report.add(deleted, errors)
+            forget_deleted(s3_client, bucket_name, deleted)
+
+    try:
+        # Listing continues while earlier batches are deleted, with a bounded number in flight
+        for batch in iter_batches(s3_client, bucket_name, prefix):
+            if len(in_flight) >= settings.S3_DELETE_CONCURRENCY:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+                if progress is not None:
+                    progress(report)
+            in_flight.add(executor.submit(delete_batch, s3_client, bucket_name, batch))
+    finally:
+        # Also on cancellation: batches already sent must still reach the key index
+        collect(wait(in_flight).done)
+    if progress is not None:
+        progress(report)
+    return report
+
+
+def delete_folder(s3_client, bucket_name, folder_key, progress=None):
+    # Each batch's keys are forgotten as it finishes, so a failed or cancelled delete
+    # leaves no records of deleted objects and keeps those of the ones still there
+    try:
+        return delete_prefix(s3_client, bucket_name, folder_key, progress=progress)
+    finally:
+        stats_cache.invalidate_prefix(folder_key)
+
+
+def probe_size(s3_client, bucket_name, prefix, limit):
+    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, MaxKeys=limit)
+    return response.get('KeyCount', len(response.get('Contents', []))), response.get('IsTruncated', False)
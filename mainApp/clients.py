@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import threading
+import weakref
+
+import boto3
+import requests
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from mainApp import executors, metrics
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_s3_client = None
+_sqs_client = None
+_http_session = None
+
+
+def build_s3_client():
+    config = Config(
+        max_pool_connections=settings.AWS_S3_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=settings.AWS_S3_CONNECT_TIMEOUT,
+        read_timeout=settings.AWS_S3_READ_TIMEOUT,
+        retries={'mode': 'adaptive', 'max_attempts': settings.AWS_S3_MAX_ATTEMPTS},
+    )
+    # A private session: the boto3 default session is not safe to share across threads
+    session = boto3.session.Session()
+    return executors.instrument(metrics.instrument(session.client(
+        's3',
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        region_name=settings.AWS_S3_REGION_NAME,
+        endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+        config=config,
+    )))
+
+
+def build_sqs_client():
+    session = boto3.session.Session()
+    return session.client(
+        'sqs',
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        region_name=settings.AWS_S3_REGION_NAME,
+        endpoint_url=settings.AWS_SQS_ENDPOINT_URL,
+    )
+
+
+def build_async_s3_client():
+    config = AioConfig(
+        max_pool_connections=settings.AWS_S3_ASYNC_MAX_POOL_CONNECTIONS,
+        connect_timeout=settings.AWS_S3_CONNECT_TIMEOUT,
+        read_timeout=settings.AWS_S3_READ_TIMEOUT,
+        retries={'mode': 'adaptive', 'max_attempts': settings.AWS_S3_MAX_ATTEMPTS},
+        connector_args={'keepalive_timeout': settings.AWS_S3_ASYNC_KEEPALIVE_TIMEOUT},
+    )
+    return get_session().create_client(
+        's3',
+        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        region_name=settings.AWS_S3_REGION_NAME,
+        endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+        config=config,
+    )
+
+
+def build_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_transfer_config():
+    return TransferConfig(
+        multipart_threshold=settings.S3_UPLOAD_PART_SIZE,
+        multipart_chunksize=settings.S3_UPLOAD_PART_SIZE,
+        max_concurrency=settings.S3_UPLOAD_CONCURRENCY,
+    )
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        with _lock:
+            if _s3_client is None:
+                _s3_client = build_s3_client()
+    return _s3_client
+
+
+def get_sqs_client():
+    global _sqs_client
+    if _sqs_client is None:
+        with _lock:
+            if _sqs_client is None:
+                _sqs_client = build_sqs_client()
+    return _sqs_client
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                _http_session = build_http_session()
+    return _http_session
+
+
+class _AsyncClientSlot:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.context = None
+        self.client = None
+
+
+# aiohttp connection pools belong to the event loop that created them, so there is
+# one async client per running loop rather than one per process
+_async_slots = weakref.WeakKeyDictionary()
+
+
+async def get_async_s3_client():
+    loop = asyncio.get_running_loop()
+    slot = _async_slots.get(loop)
+    if slot is None:
+        slot = _async_slots[loop] = _AsyncClientSlot()
+    if slot.client is None:
+        async with slot.lock:
+            if slot.client is None:
+                context = build_async_s3_client()
+                slot.client = executors.instrument(metrics.instrument(await context.__aenter__()))
+                slot.context = context
+    return slot.client
+
+
+async def close_async_s3_client():
+    slot = _async_slots.pop(asyncio.get_running_loop(), None)
+    if slot is not None and slot.context is not None:
+        await slot.context.__aexit__(None, None, None)
+
+
+def reset_clients():
+    global _s3_client, _sqs_client, _http_session
+    with _lock:
+        if _http_session is not None:
+            _http_session.close()
+        _s3_client = None
+        _sqs_client = None
+        _http_session = None
+
+
+def prewarm():
+    try:
+        get_s3_client()
+        get_http_session()
+    except Exception as e:
+        logger.error(f'Error pre-warming clients: {str(e)}')
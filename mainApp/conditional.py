@@ -0,0 +1,50 @@
+import functools
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+def _tag(response, etag, last_modified):
+    response.headers.setdefault('ETag', etag)
+    response.headers.setdefault('Last-Modified', http_date(last_modified))
+    # Polling clients must revalidate rather than reuse a heuristically fresh copy
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def versioned(version_func):
+    """Answer conditional GETs from ``version_func(request, *args, **kwargs)``.
+
+    version_func returns ``(token, last_modified)``. Unlike Django's ``condition``, one call
+    provides both validators, and async views are wrapped without losing their coroutine.
+    """
+    def evaluate(request, version):
+        token, last_modified = version
+        etag, last_modified = quote_etag(token), int(last_modified)
+        return etag, last_modified, get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            async def wrapper(request, *args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return await view(request, *args, **kwargs)
+                version = await sync_to_async(version_func, thread_sensitive=False)(request, *args, **kwargs)
+                etag, last_modified, response = evaluate(request, version)
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                return _tag(response, etag, last_modified)
+        else:
+            def wrapper(request, *args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return view(request, *args, **kwargs)
+                etag, last_modified, response = evaluate(request, version_func(request, *args, **kwargs))
+                if response is None:
+                    response = view(request, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                return _tag(response, etag, last_modified)
+        return functools.wraps(view)(wrapper)
+    return decorator
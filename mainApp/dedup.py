@@ -0,0 +1,188 @@
+import hashlib
+import logging
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from mainApp import key_index
+from mainApp.models import ContentBlob
+
+logger = logging.getLogger(__name__)
+
+# CopyObject's limit; larger duplicates are simply uploaded again
+MAX_COPY_BYTES = 5 * 1024 ** 3
+READ_SIZE = 1024 * 1024
+# The copy's source is gone or was overwritten since it was recorded
+STALE_CODES = {'NoSuchKey', '404', 'PreconditionFailed', '412'}
+
+
+def eligible(size):
+    return settings.DEDUP_ENABLED and size is not None and settings.DEDUP_MIN_BYTES <= size <= MAX_COPY_BYTES
+
+
+def file_digest(file):
+    # Files that came through HashingUploadHandler were hashed as they arrived
+    if getattr(file, 'sha256', None):
+        return file.sha256
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(READ_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def find(sha256, size):
+    return ContentBlob.objects.filter(sha256=sha256, size=size).exclude(key='').first()
+
+
+def lookup(file):
+    """``(sha256, blob to copy or None)`` for ``file``, or ``(None, None)`` if it is not deduplicated."""
+    if not eligible(file.size):
+        return None, None
+    sha256 = file_digest(file)
+    return sha256, find(sha256, file.size)
+
+
+def record(sha256, size, key, etag=''):
+    """Remember ``key`` as the copy source for content ``sha256``; the first writer wins."""
+    if not settings.DEDUP_ENABLED:
+        return
+    etag = (etag or '').strip('"')
+    try:
+        blob, created = ContentBlob.objects.get_or_create(sha256=sha256, defaults={
+            'size': size, 'key': key, 'etag': etag})
+        if not created and not blob.key:
+            ContentBlob.objects.filter(pk=blob.pk, key='').update(key=key, etag=etag)
+    except IntegrityError:
+        pass
+    except Exception as e:
+        logger.error(f'Error recording content blob for {key}: {str(e)}')
+
+
+def _detach(blobs):
+    # Rows outlive their source object so the savings they recorded stay in the report
+    blobs.update(key='', etag='')
+
+
+def copy_params(blob, bucket_name, key, content_type=None):
+    params = {
+        'Bucket': bucket_name,
+        'Key': key,
+        'CopySource': {'Bucket': bucket_name, 'Key': blob.key},
+        'MetadataDirective': 'REPLACE',
+        'Metadata': {'sha256': blob.sha256},
+        'ContentType': content_type or 'binary/octet-stream',
+    }
+    if blob.etag:
+        params['CopySourceIfMatch'] = f'"{blob.etag}"'
+    return params
+
+
+def copied(blob, response):
+    """Count a copy of ``blob`` and return the ETag from its CopyObject ``response``."""
+    ContentBlob.objects.filter(pk=blob.pk).update(
+        hits=F('hits') + 1, bytes_saved=F('bytes_saved') + blob.size, last_hit_at=timezone.now())
+    return response['CopyObjectResult']['ETag'].strip('"')
+
+
+def copy_failed(blob, error):
+    """Detach a blob whose source no longer holds its content; True if the upload should go ahead instead."""
+    code = error.response.get('Error', {}).get('Code')
+    if code not in STALE_CODES:
+        return False
+    _detach(ContentBlob.objects.filter(pk=blob.pk))
+    return True
+
+
+def copy_blob(s3_client, blob, bucket_name, key, content_type=None):
+    """Server-side copy of ``blob`` to ``key``; returns the new ETag, or None if the blob was stale."""
+    try:
+        response = s3_client.copy_object(**copy_params(blob, bucket_name, key, content_type))
+    except ClientError as e:
+        if copy_failed(blob, e):
+            return None
+        raise
+    return copied(blob, response)
+
+
+def upload(s3_client, bucket_name, key, file, config=None, metadata=None):
+    """Upload ``file`` to ``key`` and return the ETag it was stored with.
+
+    Below the multipart threshold that is one PutObject; above it boto3's managed upload
+    runs and a HeadObject reads the ETag back. That ETag is None when the object was
+    overwritten in between, as told by its sha256 metadata.
+    """
+    threshold = config.multipart_threshold if config is not None else settings.S3_UPLOAD_PART_SIZE
+    extra = {'Metadata': metadata} if metadata else {}
+    if file.size < threshold:
+        file.seek(0)
+        return s3_client.put_object(Bucket=bucket_name, Key=key, Body=file.read(), **extra)['ETag'].strip('"')
+    s3_client.upload_fileobj(file, bucket_name, key, Config=config, ExtraArgs=extra)
+    head = s3_client.head_object(Bucket=bucket_name, Key=key)
+    if metadata and head.get('Metadata', {}).get('sha256') != metadata.get('sha256'):
+        return None
+    return head['ETag'].strip('"')
+
+
+def store_file(s3_client, bucket_name, key, file, content_type=None, config=None):
+    """Upload ``file`` to ``key``, or copy an identical object already in the bucket.
+
+    Returns ``(etag, deduplicated)``.
+    """
+    sha256, blob = lookup(file)
+    if sha256 is None:
+        return upload(s3_client, bucket_name, key, file, config), False
+    if blob is not None:
+        etag = copy_blob(s3_client, blob, bucket_name, key, content_type)
+        if etag is not None:
+            return etag, True
+    etag = upload(s3_client, bucket_name, key, file, config, {'sha256': sha256})
+    if etag is not None:
+        # The ETag makes later copies conditional on the source still holding these bytes
+        record(sha256, file.size, key, etag)
+    return etag, False
+
+
+def forget(key):
+    _detach(ContentBlob.objects.filter(key=key))
+
+
+def forget_overwritten(objects):
+    """Detach the blobs whose key now holds other content; ``objects`` is ``[(key, etag)]``."""
+    etags = {key: (etag or '').strip('"') for key, etag in objects}
+    keys = list(etags)
+    for start in range(0, len(keys), 1000):
+        stale = [blob.pk for blob in ContentBlob.objects.filter(key__in=keys[start:start + 1000])
+                 if blob.etag != etags[blob.key]]
+        if stale:
+            _detach(ContentBlob.objects.filter(pk__in=stale))
+
+
+def forget_keys(keys):
+    keys = list(keys)
+    for start in range(0, len(keys), 1000):
+        _detach(ContentBlob.objects.filter(key__in=keys[start:start + 1000]))
+
+
+def forget_prefix(prefix):
+    _detach(ContentBlob.objects.filter(key_index.prefix_filter(prefix)).exclude(key=''))
+
+
+def report(top=20):
+    totals = ContentBlob.objects.aggregate(deduplicated_uploads=Sum('hits'), bytes_saved=Sum('bytes_saved'))
+    live = ContentBlob.objects.exclude(key='').aggregate(blobs=Count('pk'), stored_bytes=Sum('size'))
+    return {
+        'blobs': live['blobs'],
+        'stored_bytes': live['stored_bytes'] or 0,
+        'deduplicated_uploads': totals['deduplicated_uploads'] or 0,
+        'bytes_saved': totals['bytes_saved'] or 0,
+        'top': [
+            {'sha256': blob.sha256, 'key': blob.key, 'size': blob.size, 'hits': blob.hits,
+             'bytes_saved': blob.bytes_saved}
+            for blob in ContentBlob.objects.filter(hits__gt=0).order_by('-bytes_saved')[:top]
+        ],
+    }
@@ -0,0 +1,82 @@
+import math
+
+from django.conf import settings
+from django.core import signing
+
+MAX_PARTS = 10000
+TOKEN_SALT = 'mainApp.direct_uploads'
+# Completing may come a while after the last presigned URL was used
+COMPLETE_GRACE = 3600
+
+
+class InvalidUpload(ValueError):
+    pass
+
+
+def upload_token(key, upload_id=''):
+    """Signed proof that this server presigned ``key`` (and ``upload_id``), for complete and abort."""
+    return signing.dumps({'key': key, 'upload_id': upload_id}, salt=TOKEN_SALT)
+
+
+def check_token(token, key, upload_id=''):
+    try:
+        issued = signing.loads(token or '', salt=TOKEN_SALT,
+                               max_age=settings.S3_PRESIGNED_URL_EXPIRY + COMPLETE_GRACE)
+    except signing.BadSignature:
+        raise InvalidUpload('upload_token is missing, invalid or expired')
+    if issued != {'key': key, 'upload_id': upload_id or ''}:
+        raise InvalidUpload('upload_token was not issued for this key and upload_id')
+
+
+def parse_parts(parts):
+    """``[{'PartNumber', 'ETag'}]`` from a client's list, sorted; raises InvalidUpload."""
+    if not isinstance(parts, list) or not parts:
+        raise InvalidUpload('parts must be a non-empty list')
+    etags = {}
+    for part in parts:
+        if not isinstance(part, dict) or not isinstance(part.get('ETag'), str) or not part['ETag']:
+            raise InvalidUpload('Every part needs a PartNumber and an ETag')
+        try:
+            number = int(part.get('PartNumber'))
+        except (TypeError, ValueError):
+            raise InvalidUpload(f'Invalid PartNumber: {part.get("PartNumber")!r}')
+        if not 1 <= number <= MAX_PARTS or number in etags:
+            raise InvalidUpload(f'Invalid or repeated PartNumber: {number}')
+        etags[number] = part['ETag']
+    return [{'PartNumber': number, 'ETag': etags[number]} for number in sorted(etags)]
+
+
+def part_size_for(size):
+    part_size = max(settings.S3_UPLOAD_PART_SIZE, 5 * 1024 * 1024)
+    return max(part_size, math.ceil(size / MAX_PARTS))
+
+
+def presign_put(s3_client, bucket_name, key, content_type=None):
+    params = {'Bucket': bucket_name, 'Key': key}
+    if content_type:
+        params['ContentType'] = content_type
+    return s3_client.generate_presigned_url('put_object', Params=params,
+                                            ExpiresIn=settings.S3_PRESIGNED_URL_EXPIRY)
+
+
+def start_multipart(s3_client, bucket_name, key, size, content_type=None):
+    params = {'Bucket': bucket_name, 'Key': key}
+    if content_type:
+        params['ContentType'] = content_type
+    upload_id = s3_client.create_multipart_upload(**params)['UploadId']
+    part_size = part_size_for(size)
+    parts = []
+    for part_number in range(1, math.ceil(size / part_size) + 1):
+        url = s3_client.generate_presigned_url(
+            'upload_part',
+            Params={'Bucket': bucket_name, 'Key': key, 'UploadId': upload_id, 'PartNumber': part_number},
+            ExpiresIn=settings.S3_PRESIGNED_URL_EXPIRY,
+        )
+        parts.append({'PartNumber': part_number, 'url': url})
+    return {'upload_id': upload_id, 'part_size': part_size, 'parts': parts}
+
+
+def complete_multipart(s3_client, bucket_name, key, upload_id, parts):
+    # parts as returned by parse_parts
+    s3_client.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                        MultipartUpload={'Parts': parts})
@@ -0,0 +1,361 @@
+import contextvars
+import math
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from mainApp import metrics
+
+_lock = threading.Lock()
+_executors = {}
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    # Tasks run in a copy of the submitter's context, so per-request state (metrics)
+    # follows the work onto pool threads
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f'Too busy ({reason}), retry in {retry_after}s')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdaptiveLimit:
+    """How many S3 calls may run at once, adjusted AIMD-style from what S3 reports.
+
+    The limit grows by one after a limit's worth of calls without trouble, and is
+    multiplied by ``backoff`` on throttling or when an operation's recent latency reaches
+    ``tolerance`` times its long-run average; cuts are at most one per ``cooldown``.
+    """
+
+    FAST = 0.2
+    SLOW = 0.02
+    WARMUP = 50
+
+    def __init__(self, minimum, maximum, initial, backoff, cooldown, tolerance):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.tolerance = tolerance
+        self._value = float(min(max(initial, minimum), maximum))
+        self._successes = 0
+        self._last_cut = 0.0
+        # operation -> [calls, recent latency, long-run latency]
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return int(self._value)
+
+    def succeeded(self, operation, seconds):
+        with self._lock:
+            series = self._latency.get(operation)
+            if series is None:
+                series = self._latency[operation] = [0, seconds, seconds]
+            series[0] += 1
+            series[1] += self.FAST * (seconds - series[1])
+            series[2] += self.SLOW * (seconds - series[2])
+            if series[0] > self.WARMUP and series[1] > series[2] * self.tolerance:
+                self._cut('latency')
+                return
+            self._successes += 1
+            if self._successes >= self._value:
+                self._successes = 0
+                self._value = min(self._value + 1, self.maximum)
+
+    def throttled(self):
+        with self._lock:
+            self._cut('throttle')
+
+    def _cut(self, reason):
+        now = time.monotonic()
+        if now - self._last_cut < self.cooldown:
+            return
+        self._last_cut = now
+        self._successes = 0
+        self._value = max(self._value * self.backoff, self.minimum)
+        metrics.s3_concurrency_decreases.inc(reason)
+
+
+class _Task:
+    __slots__ = ('future', 'run', 'fn', 'args', 'kwargs', 'queued')
+
+    def __init__(self, fn, args, kwargs):
+        self.future = Future()
+        self.run = contextvars.copy_context().run
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.queued = time.monotonic()
+
+
+class Share:
+    """One request's (or upload's) handle on a FairShareExecutor."""
+
+    def __init__(self, executor, max_running):
+        self.executor = executor
+        self.max_running = max_running
+        self.tasks = deque()
+        self.running = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        return self.executor._submit(self, _Task(fn, args, kwargs))
+
+    def map(self, fn, items):
+        futures = [self.submit(fn, item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+class FairShareExecutor:
+    """Thread pool whose tasks belong to shares that take turns.
+
+    At most ``limit.value`` tasks run at once, and each share at most its own
+    ``max_running``. A free thread goes to the next share, in turn, that is below an even
+    split of the limit, and only when there is none to one that is above it, so a wide
+    fan-out cannot starve a narrow one. Tasks run in their submitter's context.
+    """
+
+    def __init__(self, max_workers, limit, name='fanout'):
+        self.max_workers = max_workers
+        self.limit = limit
+        self.name = name
+        self._cond = threading.Condition()
+        # Shares with queued tasks, in turn order
+        self._waiting = OrderedDict()
+        self._shares = 0
+        self._running = 0
+        self._queued = 0
+        self._idle = 0
+        self._threads = []
+        self._task_seconds = 0.0
+        self._shutdown = False
+
+    def share(self, max_running=None):
+        return Share(self, max_running or settings.S3_FANOUT_WORKERS)
+
+    def admit(self):
+        """Raise Overloaded when a new request should not add to the queue."""
+        with self._cond:
+            queued = self._queued
+            oldest = min((share.tasks[0].queued for share in self._waiting), default=None)
+            limit = max(self.limit.value, 1)
+            task_seconds = self._task_seconds
+        if queued >= settings.S3_FANOUT_MAX_QUEUE:
+            reason = 'queue'
+        elif oldest is not None and time.monotonic() - oldest >= settings.S3_FANOUT_MAX_QUEUE_WAIT:
+            reason = 'wait'
+        else:
+            return
+        metrics.executor_shed.inc(reason)
+        # Roughly how long the backlog takes to drain at the current limit
+        raise Overloaded(reason, max(1, math.ceil(queued * task_seconds / limit)))
+
+    def _submit(self, share, task):
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            if not share.tasks and not share.running:
+                self._shares += 1
+            share.tasks.append(task)
+            self._waiting.setdefault(share, None)
+            self._queued += 1
+            if self._idle:
+                self._cond.notify()
+            elif len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, name=f's3-{self.name}-{len(self._threads)}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        return task.future
+
+    def _next(self):
+        if self._running >= self.limit.value:
+            return None
+        fair = max(1, self.limit.value // max(self._shares, 1))
+        candidates = [share for share in self._waiting if share.running < share.max_running]
+        share = next((share for share in candidates if share.running < fair), None) or next(iter(candidates), None)
+        if share is None:
+            return None
+        task = share.tasks.popleft()
+        del self._waiting[share]
+        if share.tasks:
+            # Back of the line
+            self._waiting[share] = None
+        share.running += 1
+        self._running += 1
+        self._queued -= 1
+        return share, task
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._idle += 1
+                picked = self._next()
+                while picked is None:
+                    if self._shutdown and not self._queued:
+                        self._idle -= 1
+                        return
+                    self._cond.wait()
+                    picked = self._next()
+                self._idle -= 1
+            share, task = picked
+            started = time.monotonic()
+            metrics.executor_queue_wait.observe(started - task.queued)
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    task.future.set_result(task.run(task.fn, *task.args, **task.kwargs))
+                except BaseException as e:
+                    task.future.set_exception(e)
+            with self._cond:
+                share.running -= 1
+                self._running -= 1
+                if not share.tasks and not share.running:
+                    self._shares -= 1
+                self._task_seconds += 0.1 * (time.monotonic() - started - self._task_seconds)
+                # Freed capacity may be for a share another thread passed over
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'limit': self.limit.value,
+                'running': self._running,
+                'queued': self._queued,
+                'shares': self._shares,
+                'threads': len(self._threads),
+                'task_seconds': round(self._task_seconds, 4),
+            }
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+def _pool_sizes():
+    return {
+        'transfers': settings.S3_TRANSFER_WORKERS,
+    }
+
+
+def _process_pool_sizes():
+    return {
+        'imaging': settings.THUMBNAIL_PROCESSES,
+    }
+
+
+def get_executor(name):
+    executor = _executors.get(name)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = ContextThreadPoolExecutor(max_workers=_pool_sizes()[name], thread_name_prefix=f's3-{name}')
+                _executors[name] = executor
+    return executor
+
+
+def get_fanout_executor():
+    executor = _executors.get('fanout')
+    if executor is None:
+        with _lock:
+            executor = _executors.get('fanout')
+            if executor is None:
+                limit = AdaptiveLimit(settings.S3_CONCURRENCY_MIN, settings.S3_CONCURRENCY_MAX,
+                                      settings.S3_FANOUT_WORKERS, settings.S3_CONCURRENCY_BACKOFF,
+                                      settings.S3_CONCURRENCY_COOLDOWN, settings.S3_LATENCY_TOLERANCE)
+                executor = _executors['fanout'] = FairShareExecutor(settings.S3_CONCURRENCY_MAX, limit)
+    return executor
+
+
+def fan_out(fn, items):
+    """``[fn(item) for item in items]`` on the fan-out pool, as one share.
+
+    Called while serving a request, this raises Overloaded instead of queueing behind a
+    backlog; background work always queues.
+    """
+    executor = get_fanout_executor()
+    if metrics.in_request():
+        executor.admit()
+    return executor.share().map(fn, items)
+
+
+def concurrency_limit():
+    return get_fanout_executor().limit.value
+
+
+def stats():
+    return get_fanout_executor().stats()
+
+
+def retry_after(error):
+    """Seconds a client should wait before retrying after ``error``, if it was load-related."""
+    if isinstance(error, Overloaded):
+        return error.retry_after
+    if isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in metrics.THROTTLE_CODES:
+        return max(1, math.ceil(settings.S3_CONCURRENCY_COOLDOWN))
+    return None
+
+
+# botocore event hooks feeding the adaptive limit; like metrics', they suit both clients
+
+def _before_call(context, **kwargs):
+    context['limit_started'] = time.perf_counter()
+
+
+def _after_call(http_response, model, context, **kwargs):
+    started = context.get('limit_started')
+    if started is not None and getattr(http_response, 'status_code', 500) < 500:
+        get_fanout_executor().limit.succeeded(model.name, time.perf_counter() - started)
+
+
+def _needs_retry(response, **kwargs):
+    if response is not None and response[1].get('Error', {}).get('Code') in metrics.THROTTLE_CODES:
+        get_fanout_executor().limit.throttled()
+
+
+def instrument(client):
+    events = client.meta.events
+    events.register('before-call.s3', _before_call)
+    events.register('after-call.s3', _after_call)
+    events.register('needs-retry.s3', _needs_retry)
+    return client
+
+
+def get_process_pool(name):
+    # Spawned rather than forked: the web process has live threads and sockets by now
+    key = f'process:{name}'
+    executor = _executors.get(key)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(key)
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=_process_pool_sizes()[name],
+                                               mp_context=multiprocessing.get_context('spawn'))
+                _executors[key] = executor
+    return executor
+
+
+def shutdown(wait=True):
+    with _lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=wait)
+        _executors.clear()
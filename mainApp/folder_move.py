@@ -0,0 +1,192 @@
+import logging
+import math
+from concurrent.futures import wait
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from mainApp import bulk_delete, executors, image_metadata, key_index, stats_cache, thumbnails
+from mainApp.models import ContentBlob, ImageDerivative
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = bulk_delete.BATCH_SIZE
+MAX_PARTS = 10000
+# UploadPartCopy does not carry these over, unlike CopyObject's MetadataDirective=COPY
+COPIED_HEADERS = ('CacheControl', 'ContentDisposition', 'ContentEncoding', 'ContentLanguage', 'ContentType')
+PHASES = ('objects', 'derivatives', 'records')
+# Every failure is counted but only the first ones are kept, since the report rides in the checkpoint
+MAX_REPORTED_ERRORS = 100
+
+
+class MoveReport:
+    def __init__(self, moved=0, errors=None, error_count=None):
+        self.moved = moved
+        self.errors = list(errors or [])
+        self.error_count = len(self.errors) if error_count is None else error_count
+
+    def add_errors(self, errors):
+        errors = list(errors)
+        self.error_count += len(errors)
+        self.errors.extend(errors[:max(0, MAX_REPORTED_ERRORS - len(self.errors))])
+
+    def as_dict(self):
+        return {'moved_count': self.moved, 'error_count': self.error_count, 'errors': self.errors}
+
+
+def target_key(key, source, destination):
+    return destination + key[len(source):]
+
+
+def part_ranges(size):
+    part_size = max(settings.S3_COPY_PART_SIZE, math.ceil(size / MAX_PARTS))
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+
+def copy_object(s3_client, bucket_name, key, target):
+    # MetadataDirective defaults to COPY, so folder markers keep their createdAt
+    response = s3_client.copy_object(Bucket=bucket_name, Key=target, CopySource={'Bucket': bucket_name, 'Key': key})
+    return response['CopyObjectResult']['ETag'].strip('"')
+
+
+def copy_multipart(s3_client, bucket_name, key, target, size):
+    """Copy a large object as parallel UploadPartCopy ranges.
+
+    Parts run on the transfers pool, so this must be called from outside that pool.
+    """
+    head = s3_client.head_object(Bucket=bucket_name, Key=key)
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket_name, Key=target, Metadata=head.get('Metadata', {}),
+        **{name: head[name] for name in COPIED_HEADERS if head.get(name)})['UploadId']
+
+    def copy_part(number, first, last):
+        # If-Match keeps every part from the same version of the source
+        response = s3_client.upload_part_copy(
+            Bucket=bucket_name, Key=target, UploadId=upload_id, PartNumber=number,
+            CopySource={'Bucket': bucket_name, 'Key': key}, CopySourceRange=f'bytes={first}-{last}',
+            CopySourceIfMatch=head['ETag'])
+        return {'PartNumber': number, 'ETag': response['CopyPartResult']['ETag']}
+
+    executor = executors.get_executor('transfers')
+    futures = [executor.submit(copy_part, number, first, last)
+               for number, (first, last) in enumerate(part_ranges(size), 1)]
+    try:
+        wait(futures)
+        parts = [future.result() for future in futures]
+        response = s3_client.complete_multipart_upload(Bucket=bucket_name, Key=target, UploadId=upload_id,
+                                                       MultipartUpload={'Parts': parts})
+    except Exception:
+        try:
+            s3_client.abort_multipart_upload(Bucket=bucket_name, Key=target, UploadId=upload_id)
+        except Exception as e:
+            logger.error(f'Error aborting multipart copy to {target}: {str(e)}')
+        raise
+    return response['ETag'].strip('"')
+
+
+def _copy(s3_client, bucket_name, obj, target):
+    # -> (source object, target key, new ETag or None, error entry or None)
+    try:
+        if obj.get('Size', 0) >= settings.S3_COPY_MULTIPART_THRESHOLD:
+            etag = copy_multipart(s3_client, bucket_name, obj['Key'], target, obj['Size'])
+        else:
+            etag = copy_object(s3_client, bucket_name, obj['Key'], target)
+        return obj, target, etag, None
+    except ClientError as e:
+        return obj, target, None, bulk_delete.error_entry(obj['Key'], e.response.get('Error', {}).get('Code'), str(e))
+    except Exception as e:
+        return obj, target, None, bulk_delete.error_entry(obj['Key'], 'CopyFailed', str(e))
+
+
+def _move_blobs(copied):
+    # Dedup sources follow their object; a multipart copy changes the ETag they check against
+    targets = {obj['Key']: (target, etag) for obj, target, etag in copied}
+    for blob in ContentBlob.objects.filter(key__in=list(targets)):
+        target, etag = targets[blob.key]
+        ContentBlob.objects.filter(pk=blob.pk).update(key=target, etag=etag)
+
+
+def move_batch(s3_client, bucket_name, objects, source, destination, report):
+    """Copy one listing page to ``destination``, then delete the sources that were copied."""
+    executor = executors.get_executor('transfers')
+    large = [obj for obj in objects if obj.get('Size', 0) >= settings.S3_COPY_MULTIPART_THRESHOLD]
+    futures = [executor.submit(_copy, s3_client, bucket_name, obj, target_key(obj['Key'], source, destination))
+               for obj in objects if obj.get('Size', 0) < settings.S3_COPY_MULTIPART_THRESHOLD]
+    # Large objects fan out their own parts, so they run from here while the small copies proceed
+    results = [_copy(s3_client, bucket_name, obj, target_key(obj['Key'], source, destination)) for obj in large]
+    results.extend(future.result() for future in futures)
+
+    copied = [(obj, target, etag) for obj, target, etag, error in results if error is None]
+    report.add_errors(error for *_, error in results if error is not None)
+    deleted, errors = bulk_delete.delete_batch(s3_client, bucket_name, [obj['Key'] for obj, _, _ in copied])
+    report.add_errors(errors)
+
+    now = datetime.now(timezone.utc)
+    key_index.apply_changes(
+        [key_index.build_object(target, obj.get('Size', 0), now, etag)
+         for obj, target, etag in copied if not thumbnails.is_derived(target)],
+        [key for key in deleted if not thumbnails.is_derived(key)])
+    _move_blobs(copied)
+    image_metadata.moved([(obj['Key'], target, etag) for obj, target, etag in copied])
+    for obj, target, etag in copied:
+        # A multipart copy has a new ETag, so the moved derivatives no longer match it
+        if etag != obj.get('ETag', '').strip('"'):
+            thumbnails.schedule(bucket_name, target, etag, obj.get('Size'))
+    return len(deleted)
+
+
+def _move_derivative_records(source, destination):
+    rows = list(ImageDerivative.objects.filter(key_index.prefix_filter(source, 'source_key')))
+    for row in rows:
+        row.source_key = target_key(row.source_key, source, destination)
+        row.key = target_key(row.key, thumbnails.derived_prefix(source), thumbnails.derived_prefix(destination))
+    ImageDerivative.objects.bulk_update(rows, ['source_key', 'key'], batch_size=BATCH_SIZE)
+
+
+def iter_pages(s3_client, bucket_name, prefix, start_after=''):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    params = {'Bucket': bucket_name, 'Prefix': prefix, 'PaginationConfig': {'PageSize': BATCH_SIZE}}
+    if start_after:
+        params['StartAfter'] = start_after
+    for page in paginator.paginate(**params):
+        if page.get('Contents'):
+            yield page['Contents']
+
+
+def move_folder(s3_client, bucket_name, source, destination, checkpoint=None, save=None):
+    """Move everything under ``source`` to ``destination`` server-side.
+
+    The listing is worked through a page at a time: copy, then delete the sources that
+    were copied, so a failed copy leaves its source in place. After each page
+    ``save(state)`` is called with a JSON-able state (it may raise to stop the move);
+    passing that state back as ``checkpoint`` resumes after the last finished page.
+    Derivatives move with their images, once the images are done.
+    """
+    state = dict(checkpoint or {'phase': PHASES[0], 'after': '', 'moved': 0, 'errors': [], 'error_count': 0})
+    report = MoveReport(state['moved'], state['errors'], state.get('error_count'))
+    prefixes = {
+        'objects': (source, destination),
+        'derivatives': (thumbnails.derived_prefix(source), thumbnails.derived_prefix(destination)),
+    }
+    try:
+        for phase in PHASES[PHASES.index(state['phase']):]:
+            if phase == 'records':
+                _move_derivative_records(source, destination)
+                break
+            src, dst = prefixes[phase]
+            for objects in iter_pages(s3_client, bucket_name, src, state['after'] if phase == state['phase'] else ''):
+                moved = move_batch(s3_client, bucket_name, objects, src, dst, report)
+                if phase == 'objects':
+                    report.moved += moved
+                    stats_cache.invalidate_prefix(source)
+                    stats_cache.invalidate_prefix(destination)
+                state.update(phase=phase, after=objects[-1]['Key'], moved=report.moved, errors=report.errors,
+                             error_count=report.error_count)
+                if save is not None:
+                    save(state)
+            state.update(phase=PHASES[PHASES.index(phase) + 1], after='')
+    finally:
+        stats_cache.invalidate_prefix(source)
+        stats_cache.invalidate_prefix(destination)
+    return report
@@ -0,0 +1,307 @@
+import logging
+from datetime import timezone
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from mainApp import executors, key_index, thumbnails
+from mainApp.models import S3Object
+
+logger = logging.getLogger(__name__)
+
+
+class TreeStats:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.file_count = 0
+        self.subfolders = set()
+        self.last_modified = None
+        self.created_at = None
+        self.total_files = 0
+        self.total_size = 0
+        self.descendants = set()
+        self.tree_last_modified = None
+
+    def add(self, obj):
+        relative = obj['Key'][len(self.prefix):]
+        if not relative:
+            # The folder marker written by create_folder; resolve_created_at swaps in its createdAt
+            self.created_at = obj['LastModified']
+            return
+        parts = relative.split('/')
+        if len(parts) == 1:
+            self.file_count += 1
+            if self.last_modified is None or obj['LastModified'] > self.last_modified:
+                self.last_modified = obj['LastModified']
+        else:
+            self.subfolders.add(parts[0])
+            for depth in range(1, len(parts)):
+                self.descendants.add('/'.join(parts[:depth]))
+            if not parts[-1]:
+                return
+        self.total_files += 1
+        self.total_size += obj.get('Size', 0)
+        if self.tree_last_modified is None or obj['LastModified'] > self.tree_last_modified:
+            self.tree_last_modified = obj['LastModified']
+
+    def as_dict(self):
+        last_modified = self.last_modified
+        if self.file_count == 0 and not self.subfolders:
+            last_modified = self.created_at
+        return {
+            'folderName': self.prefix,
+            'FileCount': self.file_count,
+            'FolderCount': len(self.subfolders),
+            'LastModified': last_modified,
+            'CreatedAt': self.created_at,
+            'TotalFileCount': self.total_files,
+            'TotalFolderCount': len(self.descendants),
+            'TotalSize': self.total_size,
+            'TreeLastModified': self.tree_last_modified or self.created_at,
+        }
+
+
+class Listing:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.files = []
+        self.folders = {}
+
+    def add(self, obj):
+        key = obj['Key']
+        if key == self.prefix or thumbnails.is_derived(key):
+            return
+        cut = key.find('/', len(self.prefix))
+        if cut < 0:
+            self.files.append(obj)
+            return
+        child = key[:cut + 1]
+        stats = self.folders.get(child)
+        if stats is None:
+            stats = self.folders[child] = TreeStats(child)
+        stats.add(obj)
+
+    def add_page(self, page):
+        """Add a delimited page's files; returns the child folders it names, to be fanned out."""
+        for obj in page.get('Contents', []):
+            self.add(obj)
+        return child_prefixes(page)
+
+    def folder_stats(self):
+        return [stats.as_dict() for stats in self.folders.values()]
+
+    def as_dict(self):
+        return {
+            'prefix': self.prefix,
+            'files': self.files,
+            'folders': self.folder_stats(),
+        }
+
+
+class FlatScan:
+    """One flat listing of every level below ``listing.prefix``, fed page by page.
+
+    Without an estimate the scan stops after a page budget; the children it has not
+    finished are dropped so the fan-out can pick them up after ``complete_through``.
+    """
+
+    def __init__(self, listing, estimate):
+        self.listing = listing
+        self.max_pages = None if estimate is not None else -(-settings.FOLDER_STATS_FLAT_MAX_KEYS // 1000)
+        self.pages = 0
+        self.current_child = self.last_key = self.complete_through = None
+
+    def add_page(self, page):
+        """Add one page; False once the budget is spent and the rest must be fanned out."""
+        prefix = self.listing.prefix
+        self.pages += 1
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            cut = key.find('/', len(prefix))
+            child = key[:cut + 1] if cut >= 0 else None
+            if child != self.current_child and self.last_key is not None:
+                self.complete_through = self.last_key
+            self.listing.add(obj)
+            if child is None:
+                self.complete_through = key
+            self.current_child, self.last_key = child, key
+        if self.max_pages is not None and self.pages >= self.max_pages and page.get('IsTruncated'):
+            if self.current_child is not None:
+                self.listing.folders.pop(self.current_child, None)
+            return False
+        return True
+
+
+class Page:
+    """Up to ``limit`` of ``prefix``'s files and child folders, gathered one response at a time.
+
+    The folder's own marker and the derivatives folder take listing slots without being
+    entries, so requests continue until ``limit`` real entries are in or the folder ends.
+    """
+
+    def __init__(self, bucket_name, prefix, limit, continuation_token=None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.limit = limit
+        self.continuation_token = continuation_token
+        self.files = []
+        self.children = []
+
+    def request(self):
+        kwargs = {'Bucket': self.bucket_name, 'Prefix': self.prefix, 'Delimiter': '/',
+                  'MaxKeys': self.limit - len(self.files) - len(self.children)}
+        if self.continuation_token:
+            kwargs['ContinuationToken'] = self.continuation_token
+        return kwargs
+
+    def add(self, response):
+        """Take in a ListObjectsV2 response; True once the page is complete."""
+        files, children = page_entries(response, self.prefix)
+        self.files.extend(files)
+        self.children.extend(children)
+        self.continuation_token = response.get('NextContinuationToken')
+        return not self.continuation_token or len(self.files) + len(self.children) >= self.limit
+
+    def result(self):
+        return self.files, self.children, self.continuation_token
+
+
+def child_prefixes(page):
+    return [cp['Prefix'] for cp in page.get('CommonPrefixes', []) if not thumbnails.is_derived(cp['Prefix'])]
+
+
+def page_entries(page, prefix):
+    """A delimited page's ``(files, child folders)``, without the folder's own marker."""
+    return [obj for obj in page.get('Contents', []) if obj['Key'] != prefix], child_prefixes(page)
+
+
+def fan_out_params(bucket_name, prefix, start_after=None):
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix, 'Delimiter': '/'}
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    return kwargs
+
+
+def needs_fan_out(estimate):
+    return estimate is not None and estimate > settings.FOLDER_STATS_FLAT_MAX_KEYS
+
+
+def created_at_from_head(head):
+    # S3 lowercases metadata names; other stores may not
+    value = next((value for name, value in head.get('Metadata', {}).items() if name.lower() == 'createdat'), None)
+    created_at = parse_datetime(value) if value else None
+    if created_at is not None and created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at
+
+
+def markers_to_resolve(stats_list):
+    """``({prefix: stats}, {prefix: known createdAt}, [prefixes to read])`` for the folders that have a marker."""
+    markers = {stats.prefix: stats for stats in stats_list if stats.created_at is not None}
+    known = key_index.created_at_of(list(markers)) if markers else {}
+    return markers, known, [prefix for prefix in markers if prefix not in known]
+
+
+def unreadable_marker(prefix, error):
+    logger.error(f'Error fetching metadata for {prefix}: {str(error)}')
+    return prefix, None
+
+
+def apply_created_at(markers, known, heads):
+    """Set each folder's created_at from ``known`` and ``heads`` (``[(prefix, head or None)]``).
+
+    What the heads told is stored for next time; a marker without createdAt metadata
+    keeps its LastModified, and one that could not be read is tried again later.
+    """
+    found = {}
+    for prefix, head in heads:
+        if head is not None:
+            found[prefix] = created_at_from_head(head) or markers[prefix].created_at
+    for prefix, created_at in {**known, **found}.items():
+        markers[prefix].created_at = created_at
+    if found:
+        key_index.store_created_at(found)
+
+
+def resolve_created_at(s3_client, bucket_name, stats_list):
+    """Give folders the createdAt create_folder stored on their marker, which moves keep.
+
+    Each marker is read with HeadObject only until the key index knows its value.
+    """
+    markers, known, missing = markers_to_resolve(stats_list)
+
+    def head(prefix):
+        try:
+            return prefix, s3_client.head_object(Bucket=bucket_name, Key=prefix)
+        except ClientError as e:
+            return unreadable_marker(prefix, e)
+    # A single tree is resolved from inside the fan-out pool, so it must not fan out again
+    heads = map_children(head, missing) if len(missing) > 1 else [head(prefix) for prefix in missing]
+    apply_created_at(markers, known, heads)
+
+
+def estimate_key_count(prefix):
+    try:
+        if key_index.is_ready():
+            return S3Object.objects.filter(key_index.prefix_filter(prefix)).count()
+    except Exception as e:
+        logger.error(f'Error estimating key count for {prefix}: {str(e)}')
+    return None
+
+
+def collect_tree(s3_client, bucket_name, prefix):
+    stats = TreeStats(prefix)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            stats.add(obj)
+    return stats
+
+
+def list_page(s3_client, bucket_name, prefix, limit, continuation_token=None):
+    """Up to ``limit`` of ``prefix``'s files and child folders, with the token for the rest."""
+    page = Page(bucket_name, prefix, limit, continuation_token)
+    while not page.add(s3_client.list_objects_v2(**page.request())):
+        pass
+    return page.result()
+
+
+def iter_pages(s3_client, bucket_name, prefix, page_size=1000):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/',
+                                   PaginationConfig={'PageSize': page_size}):
+        yield page_entries(page, prefix)
+
+
+def map_children(func, children):
+    if not children:
+        return []
+    return executors.fan_out(func, children)
+
+
+def _fan_out(s3_client, bucket_name, listing, start_after=None):
+    children = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**fan_out_params(bucket_name, listing.prefix, start_after)):
+        children.extend(listing.add_page(page))
+
+    for stats in map_children(lambda child: collect_tree(s3_client, bucket_name, child), children):
+        listing.folders[stats.prefix] = stats
+    return listing
+
+
+def list_prefix(s3_client, bucket_name, prefix, estimate=None):
+    listing = Listing(prefix)
+    if estimate is None:
+        estimate = estimate_key_count(prefix)
+    if needs_fan_out(estimate):
+        return _fan_out(s3_client, bucket_name, listing)
+
+    # One flat listing covers every level below the prefix
+    scan = FlatScan(listing, estimate)
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        if not scan.add_page(page):
+            return _fan_out(s3_client, bucket_name, listing, start_after=scan.complete_through)
+    return listing
@@ -0,0 +1,305 @@
+import hashlib
+import logging
+import re
+from datetime import datetime, time, timezone
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.db.models import F
+from django.utils.dateparse import parse_date, parse_datetime
+
+from mainApp import executors, imaging, key_index, pagination, stats_cache, thumbnails
+from mainApp.models import ImageMetadata
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+# Pillow's names for formats people also call by their extension
+FORMAT_ALIASES = {'JPG': 'JPEG', 'TIF': 'TIFF'}
+
+
+def _format(value):
+    return FORMAT_ALIASES.get(value.upper(), value.upper())
+
+
+# Query parameter -> (lookup, parser)
+FILTERS = {
+    'min_width': ('width__gte', int),
+    'max_width': ('width__lte', int),
+    'min_height': ('height__gte', int),
+    'max_height': ('height__lte', int),
+    'format': ('format', _format),
+    'orientation': ('orientation', int),
+    'taken_after': ('taken_at__gte', 'date'),
+    'taken_before': ('taken_at__lt', 'date'),
+}
+# sort parameter -> column; a leading '-' reverses it
+SORTS = {'name': 'key', 'width': 'width', 'height': 'height', 'taken': 'taken_at', 'size': 'size'}
+CONTENT_RANGE = re.compile(r'bytes \d+-\d+/(\d+)')
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def wanted(key):
+    return settings.IMAGE_METADATA_ENABLED and thumbnails.is_image(key)
+
+
+def _normalize_etag(etag):
+    return (etag or '').strip('"')
+
+
+def _aware(value):
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def save(key, info, etag='', size=0, last_modified=None):
+    parent, _, _, _ = key_index.split_key(key)
+    ImageMetadata.objects.update_or_create(key=key, defaults={
+        'parent': parent,
+        'etag': _normalize_etag(etag),
+        'format': (info['format'] or '')[:16],
+        'width': info['width'],
+        'height': info['height'],
+        'orientation': info['orientation'],
+        'taken_at': _aware(info['taken_at']),
+        'size': size or 0,
+        'last_modified': last_modified,
+    })
+
+
+def record(bucket_name, key, header, size, etag='', last_modified=None):
+    """Store what ``header``, the start of a just-written image, says about it; never fails the caller.
+
+    When the headers run past ``header`` the object is read again by a background job.
+    """
+    if not wanted(key):
+        return
+    try:
+        info = imaging.probe(header)
+    except ValueError:
+        if size is not None and size > len(header):
+            schedule(bucket_name, key, etag, size)
+        return
+    try:
+        save(key, info, etag, size, last_modified or datetime.now(timezone.utc))
+    except Exception as e:
+        logger.error(f'Error recording image metadata for {key}: {str(e)}')
+
+
+def read_header(key, file):
+    # Read before the file goes to S3: the transfer closes it when done
+    if not wanted(key):
+        return b''
+    file.seek(0)
+    header = file.read(settings.IMAGE_METADATA_HEADER_BYTES)
+    file.seek(0)
+    return header
+
+
+def schedule(bucket_name, key, etag=None, size=None):
+    """Queue extraction for an image written without passing through us; never fails the caller."""
+    if not wanted(key):
+        return None
+    from mainApp import jobs
+
+    etag = _normalize_etag(etag)
+    idempotency_key = None
+    if etag:
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        idempotency_key = f'image-metadata:{digest}:{etag}'
+    try:
+        job, _ = jobs.enqueue('extract_image_metadata', {'bucket': bucket_name, 'key': key, 'etag': etag},
+                              idempotency_key=idempotency_key)
+        return job
+    except Exception as e:
+        logger.error(f'Error scheduling image metadata for {key}: {str(e)}')
+        return None
+
+
+def _read_header(s3_client, bucket_name, key, length, etag=None):
+    params = {'Bucket': bucket_name, 'Key': key, 'Range': f'bytes=0-{length - 1}'}
+    if etag:
+        params['IfMatch'] = etag
+    response = s3_client.get_object(**params)
+    with response['Body'] as body:
+        data = body.read()
+    match = CONTENT_RANGE.match(response.get('ContentRange') or '')
+    size = int(match.group(1)) if match else response['ContentLength']
+    return data, size, response
+
+
+def extract(s3_client, bucket_name, key):
+    """Ranged-GET the start of ``key`` and store its metadata.
+
+    Returns the stored row, or None when the object is gone or is not a readable image.
+    """
+    try:
+        data, size, response = _read_header(s3_client, bucket_name, key, settings.IMAGE_METADATA_HEADER_BYTES)
+        etag = _normalize_etag(response['ETag'])
+        try:
+            info = imaging.probe(data)
+        except ValueError:
+            if size <= len(data) or len(data) >= settings.IMAGE_METADATA_MAX_HEADER_BYTES:
+                raise
+            # Large EXIF or ICC blocks push the headers past the first range
+            data, _, _ = _read_header(s3_client, bucket_name, key, settings.IMAGE_METADATA_MAX_HEADER_BYTES,
+                                      response['ETag'])
+            info = imaging.probe(data)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404', 'PreconditionFailed', '412'):
+            return None
+        raise
+    except ValueError as e:
+        logger.error(f'Error reading image metadata of {key}: {str(e)}')
+        return None
+    save(key, info, etag, size, response.get('LastModified'))
+    return ImageMetadata.objects.get(key=key)
+
+
+def extract_for(s3_client, bucket_name, key, etag=None):
+    etag = _normalize_etag(etag)
+    if etag and ImageMetadata.objects.filter(key=key, etag=etag).exists():
+        return {'key': key, 'etag': etag, 'skipped': 'up to date'}
+    row = extract(s3_client, bucket_name, key)
+    if row is None:
+        return {'key': key, 'skipped': 'not a readable image'}
+    # Filtered listings and searches read the table, so their version tokens are stale
+    stats_cache.invalidate_key(key)
+    return {'key': key, 'etag': row.etag, 'width': row.width, 'height': row.height}
+
+
+def backfill(s3_client, bucket_name, prefix='', force=False):
+    """Extract metadata for the images under ``prefix`` that have none for their current ETag.
+
+    Each listing page is read with parallel ranged GETs on the transfers pool.
+    Returns counts of images extracted, skipped as current and unreadable.
+    """
+    counts = {'extracted': 0, 'current': 0, 'unreadable': 0}
+    executor = executors.get_executor('transfers')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        images = {obj['Key']: _normalize_etag(obj.get('ETag')) for obj in page.get('Contents', []) if wanted(obj['Key'])}
+        if not force:
+            for key, etag in ImageMetadata.objects.filter(key__in=list(images)).values_list('key', 'etag'):
+                if images[key] == etag:
+                    del images[key]
+                    counts['current'] += 1
+        for row in executor.map(lambda key: extract(s3_client, bucket_name, key), images):
+            counts['extracted' if row is not None else 'unreadable'] += 1
+    if counts['extracted']:
+        stats_cache.invalidate_prefix(prefix)
+    return counts
+
+
+def moved(copied):
+    """Carry rows over to the keys ``[(source, target, etag)]`` were copied to."""
+    targets = {source: (target, etag) for source, target, etag in copied}
+    for row in ImageMetadata.objects.filter(key__in=list(targets)):
+        target, etag = targets[row.key]
+        ImageMetadata.objects.filter(key=target).delete()
+        ImageMetadata.objects.filter(pk=row.pk).update(
+            key=target, parent=key_index.split_key(target)[0], etag=_normalize_etag(etag))
+
+
+def forget(key):
+    ImageMetadata.objects.filter(key=key).delete()
+
+
+def forget_keys(keys):
+    keys = list(keys)
+    for start in range(0, len(keys), BATCH_SIZE):
+        ImageMetadata.objects.filter(key__in=keys[start:start + BATCH_SIZE]).delete()
+
+
+def forget_prefix(prefix):
+    ImageMetadata.objects.filter(key_index.prefix_filter(prefix)).delete()
+
+
+def _parse_date(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        parsed = datetime.combine(day, time.min)
+    return _aware(parsed)
+
+
+def requested(request):
+    """Whether the request filters or sorts on image metadata."""
+    sort = request.GET.get('sort', '').lstrip('-')
+    return any(request.GET.get(name) for name in FILTERS) or (sort in SORTS and sort != 'name')
+
+
+def filters(request):
+    lookups = {}
+    for name, (lookup, parse) in FILTERS.items():
+        value = request.GET.get(name)
+        if not value:
+            continue
+        try:
+            lookups[lookup] = _parse_date(value) if parse == 'date' else parse(value)
+        except ValueError:
+            raise InvalidQuery(f'Invalid value for {name}: {value}')
+    return lookups
+
+
+def ordering(sort):
+    column = SORTS.get(sort.lstrip('-'))
+    if column is None:
+        raise InvalidQuery(f'sort must be one of {", ".join(sorted(SORTS))}, optionally prefixed with -')
+    field = F(column).desc(nulls_last=True) if sort.startswith('-') else F(column).asc(nulls_last=True)
+    return [field, 'key'] if column != 'key' else [field]
+
+
+def query(request, parent=None, contains=None, suffix=None):
+    """Rows matching the request's filters, in its sort order; ``parent`` limits them to one folder."""
+    rows = ImageMetadata.objects.filter(**filters(request))
+    if parent is not None:
+        rows = rows.filter(parent=parent)
+    if contains:
+        rows = rows.filter(key__icontains=contains)
+    if suffix:
+        rows = rows.filter(key__iendswith=suffix)
+    return rows.order_by(*ordering(request.GET.get('sort') or 'name'))
+
+
+def page(request, rows, prefix):
+    """Slice ``rows`` by the request's limit and cursor; returns ``(rows, next_cursor)``."""
+    if not request.GET.get('limit'):
+        return list(rows), None
+    try:
+        limit = int(request.GET['limit'])
+    except ValueError:
+        raise InvalidQuery('limit must be an integer')
+    if not 1 <= limit <= pagination.MAX_PAGE_SIZE:
+        raise InvalidQuery(f'limit must be between 1 and {pagination.MAX_PAGE_SIZE}')
+    sort = request.GET.get('sort') or 'name'
+    offset = 0
+    if request.GET.get('cursor'):
+        offset = pagination.decode_cursor(request.GET['cursor'], prefix, sort)
+        if not isinstance(offset, int) or offset < 0:
+            raise InvalidQuery('Invalid cursor')
+    found = list(rows[offset:offset + limit + 1])
+    next_cursor = pagination.encode_cursor(prefix, offset + limit, sort) if len(found) > limit else None
+    return found[:limit], next_cursor
+
+
+def as_dict(row):
+    return {
+        'width': row.width,
+        'height': row.height,
+        'format': row.format,
+        'orientation': row.orientation,
+        'taken_at': row.taken_at,
+        'size': row.size,
+    }
+
+
+def as_object(row):
+    # The shape of a ListObjectsV2 entry, for the listing payloads
+    return {'Key': row.key, 'LastModified': row.last_modified, 'Size': row.size, 'ETag': row.etag}
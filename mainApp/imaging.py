@@ -0,0 +1,118 @@
+# Pure image work that runs in the imaging process pool. This module must stay free of
+# Django imports so that spawned worker processes can import it without settings.
+import io
+from datetime import datetime, timedelta, timezone
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+CONTENT_TYPES = {
+    'WEBP': 'image/webp',
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+}
+
+EXIF_IFD = 0x8769
+ORIENTATION = 0x0112
+DATETIME = 0x0132
+DATETIME_ORIGINAL = 0x9003
+OFFSET_TIME_ORIGINAL = 0x9011
+# Orientations that turn the image a quarter, so it displays with width and height swapped
+TRANSPOSED = {5, 6, 7, 8}
+
+
+def _open(data, largest):
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale, which is most of the
+        # cost of a thumbnail; draft() picks the smallest scale still >= largest
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise ValueError(f'Cannot decode image: {str(e)}')
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    return image
+
+
+def _encode(image, fmt, quality):
+    buffer = io.BytesIO()
+    if fmt == 'JPEG' and image.mode == 'RGBA':
+        image = image.convert('RGB')
+    image.save(buffer, fmt, quality=quality)
+    return buffer.getvalue()
+
+
+def render(data, sizes, fmt='WEBP', quality=80):
+    """Return ``[(size, body, width, height)]`` for each max-edge size, largest first.
+
+    Each size is scaled from the previous one rather than from the original, and sizes
+    at least as large as the image share one encoding of it (images are never upscaled).
+    """
+    sizes = sorted(set(sizes), reverse=True)
+    image = _open(data, sizes[0])
+    unscaled = None
+    results = []
+    for size in sizes:
+        if max(image.size) > size:
+            image = image.copy()
+            image.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+            body = _encode(image, fmt, quality)
+        else:
+            if unscaled is None:
+                unscaled = _encode(image, fmt, quality)
+            body = unscaled
+        results.append((size, body, image.width, image.height))
+    return results
+
+
+def _capture_time(exif):
+    exif_ifd = exif.get_ifd(EXIF_IFD)
+    value = exif_ifd.get(DATETIME_ORIGINAL) or exif.get(DATETIME)
+    if not isinstance(value, str):
+        return None
+    try:
+        taken = datetime.strptime(value.strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+    offset = exif_ifd.get(OFFSET_TIME_ORIGINAL)
+    if isinstance(offset, str) and len(offset.strip('\x00 ')) == 6:
+        offset = offset.strip('\x00 ')
+        try:
+            hours, minutes = int(offset[1:3]), int(offset[4:6])
+        except ValueError:
+            return taken
+        sign = -1 if offset[0] == '-' else 1
+        taken = taken.replace(tzinfo=timezone(sign * timedelta(hours=hours, minutes=minutes)))
+    return taken
+
+
+def probe(data):
+    """Read format, displayed size, EXIF orientation and capture time from an image's headers.
+
+    ``data`` may be just the start of the file: nothing is decoded. The capture time is
+    naive unless the file records its UTC offset.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            info = {'format': image.format, 'orientation': None, 'taken_at': None}
+            try:
+                exif = image.getexif()
+            except Exception:
+                # Broken EXIF still leaves the dimensions
+                exif = {}
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError, EOFError) as e:
+        raise ValueError(f'Cannot read image headers: {str(e)}')
+    if exif:
+        orientation = exif.get(ORIENTATION)
+        if isinstance(orientation, int) and 1 <= orientation <= 8:
+            info['orientation'] = orientation
+        try:
+            info['taken_at'] = _capture_time(exif)
+        except Exception:
+            pass
+    if info['orientation'] in TRANSPOSED:
+        width, height = height, width
+    info.update(width=width, height=height)
+    return info
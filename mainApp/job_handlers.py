@@ -0,0 +1,45 @@
+from mainApp import bulk_delete, folder_move, image_metadata, jobs, key_index, s3_events, stats_cache, thumbnails
+from mainApp.clients import get_s3_client
+
+
+@jobs.register('delete_folder')
+def delete_folder(job):
+    progress = lambda report: jobs.update_progress(job, report.deleted)
+    report = bulk_delete.delete_folder(get_s3_client(), job.params['bucket'], job.params['prefix'], progress=progress)
+    return report.as_dict()
+
+
+@jobs.register('move_folder')
+def move_folder(job):
+    # Retries and jobs taken over from a lost worker resume from the last saved page
+    save = lambda state: jobs.update_progress(job, state['moved'], checkpoint=state)
+    report = folder_move.move_folder(get_s3_client(), job.params['bucket'], job.params['source'],
+                                     job.params['destination'], checkpoint=job.checkpoint, save=save)
+    return report.as_dict()
+
+
+@jobs.register('rebuild_index')
+def rebuild_index(job):
+    count = key_index.rebuild(get_s3_client(), job.params['bucket'], job.params.get('prefix', ''))
+    jobs.update_progress(job, count, total=count)
+    return {'indexed': count}
+
+
+@jobs.register('reconcile_index')
+def reconcile_index(job):
+    return s3_events.reconcile(get_s3_client(), job.params['bucket'], job.params.get('prefix', ''))
+
+
+@jobs.register('folder_tree_stats')
+def folder_tree_stats(job):
+    return stats_cache.get_tree(get_s3_client(), job.params['bucket'], job.params['prefix'])
+
+
+@jobs.register('render_derivatives')
+def render_derivatives(job):
+    return thumbnails.render_for(get_s3_client(), job.params['bucket'], job.params['key'], job.params.get('etag'))
+
+
+@jobs.register('extract_image_metadata')
+def extract_image_metadata(job):
+    return image_metadata.extract_for(get_s3_client(), job.params['bucket'], job.params['key'], job.params.get('etag'))
@@ -0,0 +1,217 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from mainApp.models import Job
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class LeaseLost(Exception):
+    """The job was handed to another worker after this one's lease expired."""
+
+
+class IdempotencyConflict(ValueError):
+    pass
+
+
+def register(kind):
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind, params, idempotency_key=None, max_attempts=None, run_after=None):
+    if kind not in _handlers:
+        raise ValueError(f'Unknown job kind: {kind}')
+    fields = {
+        'kind': kind,
+        'params': params,
+        'max_attempts': max_attempts or settings.JOBS_MAX_ATTEMPTS,
+        'run_after': run_after or timezone.now(),
+    }
+    if not idempotency_key:
+        job, created = Job.objects.create(**fields), True
+    else:
+        try:
+            with transaction.atomic():
+                job, created = Job.objects.get_or_create(idempotency_key=idempotency_key, defaults=fields)
+        except IntegrityError:
+            job, created = Job.objects.get(idempotency_key=idempotency_key), False
+        if not created and (job.kind, job.params) != (kind, params):
+            raise IdempotencyConflict(f'Idempotency key {idempotency_key} was used for a different job')
+    if created:
+        start_embedded_worker()
+    return job, created
+
+
+def _held(job, worker_name):
+    return Job.objects.filter(pk=job.pk, locked_by=worker_name, status=Job.RUNNING)
+
+
+def update_progress(job, progress, total=None, checkpoint=None):
+    # Doubles as the cancellation and lease check: the update only matches while this
+    # worker (job.locked_by since the claim) still holds the job and no cancel is pending
+    job.progress = progress
+    fields = {'progress': progress, 'heartbeat_at': timezone.now(), 'updated_at': timezone.now()}
+    if total is not None:
+        job.total = fields['total'] = total
+    if checkpoint is not None:
+        job.checkpoint = fields['checkpoint'] = checkpoint
+    if not _held(job, job.locked_by).filter(cancel_requested=False).update(**fields):
+        if _held(job, job.locked_by).exists():
+            raise JobCancelled(job.pk)
+        raise LeaseLost(job.pk)
+
+
+def cancel(job):
+    now = timezone.now()
+    if not Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(
+            status=Job.CANCELLED, cancel_requested=True, finished_at=now, updated_at=now):
+        Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(cancel_requested=True, updated_at=now)
+    job.refresh_from_db()
+    return job
+
+
+def _release(job, worker_name, **fields):
+    # A worker whose lease expired must not overwrite the job's newer state
+    if not _held(job, worker_name).update(locked_by='', updated_at=timezone.now(), **fields):
+        logger.warning(f'Job {job.pk} ({job.kind}) is no longer held by {worker_name}; '
+                       f'dropped its {fields["status"]} outcome')
+
+
+def _finish(job, worker_name, **fields):
+    _release(job, worker_name, finished_at=timezone.now(), **fields)
+
+
+def execute(job, worker_name):
+    handler = _handlers.get(job.kind)
+    try:
+        if handler is None:
+            raise ValueError(f'Unknown job kind: {job.kind}')
+        result = handler(job)
+    except JobCancelled:
+        _finish(job, worker_name, status=Job.CANCELLED, error='Cancelled', progress=job.progress, total=job.total)
+    except LeaseLost:
+        # The worker now holding the job runs it; this one just stops
+        logger.warning(f'Job {job.pk} ({job.kind}) was taken over by another worker; stopped attempt {job.attempts}')
+    except Exception as e:
+        logger.error(f'Job {job.pk} ({job.kind}) attempt {job.attempts} failed: {str(e)}')
+        if job.attempts < job.max_attempts:
+            delay = settings.JOBS_RETRY_BACKOFF * (2 ** (job.attempts - 1))
+            _release(job, worker_name, status=Job.QUEUED, error=str(e),
+                     run_after=timezone.now() + timedelta(seconds=delay))
+        else:
+            _finish(job, worker_name, status=Job.FAILED, error=str(e))
+    else:
+        _finish(job, worker_name, status=Job.SUCCEEDED, result=result, error='')
+    finally:
+        close_old_connections()
+
+
+class Worker:
+    def __init__(self, workers=None, poll_interval=None, kinds=None, name=None):
+        self.workers = workers or settings.JOBS_WORKERS
+        self.poll_interval = poll_interval if poll_interval is not None else settings.JOBS_POLL_INTERVAL
+        self.kinds = kinds
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.active = {}
+        self.stopping = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job-worker')
+
+    def queued(self):
+        queryset = Job.objects.filter(status=Job.QUEUED)
+        if self.kinds:
+            queryset = queryset.filter(kind__in=self.kinds)
+        return queryset
+
+    def claim(self, limit):
+        now = timezone.now()
+        candidates = self.queued().filter(run_after__lte=now)
+        claimed = []
+        for pk in candidates.order_by('run_after', 'pk').values_list('pk', flat=True)[:limit * 2]:
+            if len(claimed) >= limit:
+                break
+            # The conditional update is the lock: only one worker moves a job out of queued
+            if Job.objects.filter(pk=pk, status=Job.QUEUED).update(
+                    status=Job.RUNNING, locked_by=self.name, heartbeat_at=now, started_at=now,
+                    updated_at=now, attempts=F('attempts') + 1):
+                claimed.append(Job.objects.get(pk=pk))
+        return claimed
+
+    def heartbeat(self):
+        if self.active:
+            Job.objects.filter(pk__in=list(self.active), locked_by=self.name).update(heartbeat_at=timezone.now())
+
+    def recover_expired(self):
+        # Jobs whose worker stopped heartbeating are retried, or failed once out of attempts
+        now = timezone.now()
+        expired = Job.objects.filter(status=Job.RUNNING,
+                                     heartbeat_at__lt=now - timedelta(seconds=settings.JOBS_LEASE_SECONDS))
+        expired.filter(attempts__gte=F('max_attempts')).update(
+            status=Job.FAILED, error='Worker lost', locked_by='', finished_at=now, updated_at=now)
+        expired.update(status=Job.QUEUED, locked_by='', run_after=now, updated_at=now)
+
+    def run_once(self):
+        for pk in [pk for pk, future in self.active.items() if future.done()]:
+            del self.active[pk]
+        free = self.workers - len(self.active)
+        claimed = self.claim(free) if free > 0 and not self.stopping.is_set() else []
+        for job in claimed:
+            self.active[job.pk] = self._executor.submit(execute, job, self.name)
+        return len(claimed)
+
+    def run(self, until_idle=False):
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self.recover_expired()
+                    self.heartbeat()
+                    self.run_once()
+                    # Retries waiting out their backoff still count as work
+                    if until_idle and not self.active and not self.queued().exists():
+                        break
+                except Exception as e:
+                    logger.error(f'Job worker {self.name} poll failed: {str(e)}')
+                finally:
+                    close_old_connections()
+                self.stopping.wait(self.poll_interval)
+        finally:
+            self._executor.shutdown(wait=True)
+            close_old_connections()
+
+    def stop(self):
+        self.stopping.set()
+
+
+_embedded = None
+_embedded_lock = threading.Lock()
+
+
+def start_embedded_worker():
+    # Lets a single-process deployment run jobs without `manage.py run_jobs`
+    global _embedded
+    if _embedded is not None or settings.JOBS_EMBEDDED_WORKERS <= 0:
+        return _embedded
+    with _embedded_lock:
+        if _embedded is None:
+            worker = Worker(workers=settings.JOBS_EMBEDDED_WORKERS)
+            threading.Thread(target=worker.run, name='job-worker-embedded', daemon=True).start()
+            _embedded = worker
+    return _embedded
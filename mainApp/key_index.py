@@ -0,0 +1,193 @@
+import functools
+import logging
+import posixpath
+from datetime import datetime, timezone
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Left
+from django.db.models.lookups import Exact
+
+from mainApp import ngram_index, thumbnails
+from mainApp.models import IndexState, S3Object
+
+logger = logging.getLogger(__name__)
+
+BULK_BATCH_SIZE = 1000
+UPSERT_FIELDS = ('parent', 'basename', 'extension', 'is_folder', 'size', 'last_modified', 'etag', 'sequencer')
+
+
+def split_key(key):
+    is_folder = key.endswith('/')
+    path = key.rstrip('/')
+    parent, basename = posixpath.split(path)
+    parent = parent + '/' if parent else ''
+    extension = ''
+    if not is_folder:
+        extension = posixpath.splitext(basename)[1].lstrip('.').lower()[:32]
+    return parent, basename, extension, is_folder
+
+
+def prefix_filter(prefix, field='key'):
+    """A Q for the rows whose ``field`` starts with ``prefix``, matched case-sensitively.
+
+    ``__startswith`` alone is a LIKE, which SQLite compares case-insensitively, so
+    ``Photos/`` would also take in ``photos/``. The LIKE narrows the rows and comparing
+    their leading characters with ``=`` keeps exactly the ones S3 would list; unlike a
+    key range, that does not depend on the database's collation.
+    """
+    if not prefix:
+        return Q()
+    return Q(**{f'{field}__startswith': prefix}) & Q(Exact(Left(field, len(prefix)), prefix))
+
+
+def build_object(key, size=0, last_modified=None, etag='', sequencer=''):
+    parent, basename, extension, is_folder = split_key(key)
+    return S3Object(
+        key=key,
+        parent=parent,
+        basename=basename,
+        extension=extension,
+        is_folder=is_folder,
+        size=size or 0,
+        last_modified=last_modified,
+        etag=(etag or '').strip('"'),
+        sequencer=sequencer or '',
+    )
+
+
+def mark_stale():
+    try:
+        IndexState.objects.update_or_create(pk=1, defaults={'stale': True})
+    except Exception as e:
+        logger.error(f'Error marking key index stale: {str(e)}')
+
+
+def mark_synced(last_synced):
+    IndexState.objects.update_or_create(pk=1, defaults={
+        'stale': False,
+        'object_count': S3Object.objects.count(),
+        'last_synced': last_synced,
+    })
+
+
+def is_ready():
+    return IndexState.objects.filter(pk=1, stale=False).exists()
+
+
+def _bump_generation():
+    IndexState.objects.filter(pk=1).update(generation=F('generation') + 1)
+    return IndexState.objects.filter(pk=1).values_list('generation', flat=True).first()
+
+
+def _apply_to_search_index(apply):
+    ngram_index.apply(apply, _bump_generation())
+
+
+def _write_through(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            # S3 already changed; an index we failed to update must not answer searches
+            logger.error(f'Error updating key index in {func.__name__}: {str(e)}')
+            mark_stale()
+    return wrapper
+
+
+@_write_through
+def record_object(key, size=0, last_modified=None, etag='', created_at=None):
+    obj = build_object(key, size, last_modified or datetime.now(timezone.utc), etag)
+    defaults = {field: getattr(obj, field) for field in UPSERT_FIELDS}
+    if created_at is not None:
+        defaults['created_at'] = created_at
+    S3Object.objects.update_or_create(key=key, defaults=defaults)
+    _apply_to_search_index(lambda index: index.add(key))
+
+
+@_write_through
+def remove_object(key):
+    S3Object.objects.filter(key=key).delete()
+    _apply_to_search_index(lambda index: index.remove(key))
+
+
+@_write_through
+def remove_keys(keys):
+    keys = list(keys)
+    for start in range(0, len(keys), BULK_BATCH_SIZE):
+        S3Object.objects.filter(key__in=keys[start:start + BULK_BATCH_SIZE]).delete()
+
+    def apply(index):
+        for key in keys:
+            index.remove(key)
+    _apply_to_search_index(apply)
+
+
+@_write_through
+def remove_prefix(prefix):
+    S3Object.objects.filter(prefix_filter(prefix)).delete()
+    _apply_to_search_index(lambda index: index.remove_prefix(prefix))
+
+
+@_write_through
+def apply_changes(objects, removed_keys=()):
+    """Upsert ``objects`` (unsaved rows from build_object) and delete ``removed_keys`` together.
+
+    Returns True, or None when the write failed and the index was marked stale.
+    """
+    removed_keys = list(removed_keys)
+    with transaction.atomic():
+        S3Object.objects.bulk_create(objects, batch_size=BULK_BATCH_SIZE, update_conflicts=True,
+                                     unique_fields=['key'], update_fields=UPSERT_FIELDS)
+        for start in range(0, len(removed_keys), BULK_BATCH_SIZE):
+            S3Object.objects.filter(key__in=removed_keys[start:start + BULK_BATCH_SIZE]).delete()
+
+    def apply(index):
+        for obj in objects:
+            index.add(obj.key)
+        for key in removed_keys:
+            index.remove(key)
+    if objects or removed_keys:
+        _apply_to_search_index(apply)
+    return True
+
+
+def created_at_of(keys):
+    """The known createdAt of the folder markers among ``keys``, as ``{key: datetime}``."""
+    found = {}
+    for start in range(0, len(keys), BULK_BATCH_SIZE):
+        found.update(S3Object.objects.filter(key__in=keys[start:start + BULK_BATCH_SIZE], created_at__isnull=False)
+                     .values_list('key', 'created_at'))
+    return found
+
+
+def store_created_at(values):
+    try:
+        for key, created_at in values.items():
+            S3Object.objects.filter(key=key).update(created_at=created_at)
+    except Exception as e:
+        logger.error(f'Error storing folder creation times: {str(e)}')
+
+
+def rebuild(s3_client, bucket_name, prefix=''):
+    IndexState.objects.update_or_create(pk=1, defaults={'stale': True})
+    count = 0
+    with transaction.atomic():
+        S3Object.objects.filter(prefix_filter(prefix)).delete()
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix,
+                                       PaginationConfig={'PageSize': BULK_BATCH_SIZE}):
+            batch = [build_object(obj['Key'], obj.get('Size', 0), obj.get('LastModified'), obj.get('ETag', ''))
+                     for obj in page.get('Contents', []) if not thumbnails.is_derived(obj['Key'])]
+            S3Object.objects.bulk_create(batch, batch_size=BULK_BATCH_SIZE)
+            count += len(batch)
+    IndexState.objects.update_or_create(pk=1, defaults={
+        'stale': False,
+        'object_count': S3Object.objects.count(),
+        'last_synced': datetime.now(timezone.utc),
+    })
+    _bump_generation()
+    ngram_index.reset()
+    return count
+
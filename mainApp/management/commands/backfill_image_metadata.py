@@ -0,0 +1,23 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from mainApp import image_metadata
+from mainApp.clients import get_s3_client
+
+
+class Command(BaseCommand):
+    help = 'Read the headers of images already in the bucket into the image metadata table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bucket', default=os.getenv('AWS_STORAGE_BUCKET_NAME'))
+        parser.add_argument('--prefix', default='')
+        parser.add_argument('--force', action='store_true', help='also re-read images whose metadata is current')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        counts = image_metadata.backfill(get_s3_client(), options['bucket'], options['prefix'], options['force'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Extracted {counts['extracted']} images, {counts['current']} already current, "
+            f"{counts['unreadable']} unreadable in {time.time() - start:.1f}s"))
@@ -0,0 +1,39 @@
+import os
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mainApp import s3_events
+from mainApp.clients import get_s3_client, get_sqs_client
+
+
+class Command(BaseCommand):
+    help = 'Apply S3 event notifications from an SQS queue to the key index and folder stats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue-url', default=settings.S3_EVENTS_QUEUE_URL)
+        parser.add_argument('--bucket', default=os.getenv('AWS_STORAGE_BUCKET_NAME'))
+        parser.add_argument('--batch-size', type=int, default=10, help='messages per receive (SQS allows 1-10)')
+        parser.add_argument('--wait-time', type=int, default=20, help='long-poll seconds per receive')
+        parser.add_argument('--reconcile-interval', type=int, default=settings.S3_EVENTS_RECONCILE_INTERVAL,
+                            help='seconds between reconciles against a full listing (0 disables)')
+        parser.add_argument('--until-empty', action='store_true', help='exit once a receive returns nothing')
+
+    def handle(self, *args, **options):
+        if not options['queue_url']:
+            raise CommandError('Pass --queue-url or set S3_EVENTS_QUEUE_URL')
+        consumer = s3_events.Consumer(
+            s3_events.SqsQueue(get_sqs_client(), options['queue_url']),
+            options['bucket'],
+            s3_client=get_s3_client(),
+            batch_size=options['batch_size'],
+            wait_seconds=options['wait_time'],
+            reconcile_interval=options['reconcile_interval'],
+        )
+        # Finish the batch in hand on SIGTERM/SIGINT; unacknowledged messages would be redelivered anyway
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: consumer.stop())
+        self.stdout.write(f'Consuming S3 events for {options["bucket"]} from {options["queue_url"]}')
+        consumer.run(until_empty=options['until_empty'])
+        self.stdout.write(self.style.SUCCESS('S3 event consumer stopped'))
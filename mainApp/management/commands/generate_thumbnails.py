@@ -0,0 +1,24 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from mainApp import thumbnails
+from mainApp.clients import get_s3_client
+
+
+class Command(BaseCommand):
+    help = 'Queue derivative rendering for images already in the bucket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bucket', default=os.getenv('AWS_STORAGE_BUCKET_NAME'))
+        parser.add_argument('--prefix', default='')
+
+    def handle(self, *args, **options):
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        queued = 0
+        for page in paginator.paginate(Bucket=options['bucket'], Prefix=options['prefix']):
+            for obj in page.get('Contents', []):
+                # Idempotency keys carry the ETag, so images already rendered are not queued twice
+                if thumbnails.schedule(options['bucket'], obj['Key'], etag=obj.get('ETag'), size=obj.get('Size')):
+                    queued += 1
+        self.stdout.write(self.style.SUCCESS(f'Queued derivatives for {queued} images'))
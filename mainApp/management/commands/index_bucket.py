@@ -0,0 +1,19 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from mainApp import key_index
+from mainApp.clients import get_s3_client
+
+
+class Command(BaseCommand):
+    help = 'Bulk load the local key index from a full listing of the bucket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bucket', default=os.getenv('AWS_STORAGE_BUCKET_NAME'))
+
+    def handle(self, *args, **options):
+        start = time.time()
+        count = key_index.rebuild(get_s3_client(), options['bucket'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} objects in {time.time() - start:.1f}s'))
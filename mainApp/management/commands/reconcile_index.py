@@ -0,0 +1,20 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from mainApp import s3_events
+from mainApp.clients import get_s3_client
+
+
+class Command(BaseCommand):
+    help = 'Correct the key index against a flat listing of the bucket without rebuilding it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bucket', default=os.getenv('AWS_STORAGE_BUCKET_NAME'))
+        parser.add_argument('--prefix', default='')
+
+    def handle(self, *args, **options):
+        counts = s3_events.reconcile(get_s3_client(), options['bucket'], options['prefix'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Listed {counts["listed"]} objects in {counts["seconds"]:.1f}s: {counts["added"]} added, '
+            f'{counts["updated"]} updated, {counts["removed"]} removed'))
@@ -0,0 +1,24 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from mainApp.jobs import Worker
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs from the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='concurrent jobs (default JOBS_WORKERS)')
+        parser.add_argument('--poll-interval', type=float, default=None)
+        parser.add_argument('--kind', action='append', dest='kinds', help='only run jobs of this kind')
+        parser.add_argument('--until-idle', action='store_true', help='exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        worker = Worker(workers=options['workers'], poll_interval=options['poll_interval'], kinds=options['kinds'])
+        # Finish the jobs in hand on SIGTERM/SIGINT instead of abandoning them to the lease timeout
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: worker.stop())
+        self.stdout.write(f'Job worker {worker.name} running {worker.workers} at a time')
+        worker.run(until_idle=options['until_idle'])
+        self.stdout.write(self.style.SUCCESS(f'Job worker {worker.name} stopped'))
@@ -0,0 +1,25 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mainApp import key_index
+from mainApp.ngram_index import NgramIndex
+
+
+class Command(BaseCommand):
+    help = 'Build the n-gram search index from the key index and write it to a snapshot file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.SEARCH_INDEX_SNAPSHOT)
+
+    def handle(self, *args, **options):
+        if not options['path']:
+            raise CommandError('No snapshot path: pass --path or set SEARCH_INDEX_SNAPSHOT')
+        if not key_index.is_ready():
+            raise CommandError('The key index is stale; run index_bucket first')
+        start = time.time()
+        index = NgramIndex.from_database()
+        index.save(options['path'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {len(index)} keys to {options["path"]} in {time.time() - start:.1f}s'))
@@ -0,0 +1,217 @@
+import contextvars
+import threading
+import time
+from collections import defaultdict
+
+# Per-process metrics. Each worker process keeps its own totals, so a Prometheus scrape
+# behind a load balancer sees one process at a time; run one scrape target per process.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  'TooManyRequestsException', 'ProvisionedThroughputExceededException'}
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        label_values = tuple(map(str, label_values))
+        with self._lock:
+            self._values[label_values] += amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, label_values)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        label_values = tuple(map(str, label_values))
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets + ('+Inf',), series):
+                    le = bound if bound == '+Inf' else _number(bound)
+                    labels = _labels(self.labels + ('le',), label_values + (le,))
+                    lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = _labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {_number(series[-1])}')
+                lines.append(f'{self.name}_count{labels} {series[-2]}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+s3_requests = Counter('s3_requests_total', 'S3 API calls by operation and HTTP status', ('operation', 'status'))
+s3_duration = Histogram('s3_request_duration_seconds', 'S3 API call latency, retries included', ('operation',))
+s3_retries = Counter('s3_retries_total', 'S3 attempts beyond the first', ('operation',))
+s3_throttles = Counter('s3_throttles_total', 'S3 responses asking us to slow down', ('operation',))
+tokeninfo_requests = Counter('tokeninfo_requests_total', 'Google tokeninfo round trips', ('outcome',))
+tokeninfo_duration = Histogram('tokeninfo_request_duration_seconds', 'Google tokeninfo latency')
+s3_events = Counter('s3_events_total', 'S3 event notifications by outcome', ('outcome',))
+http_requests = Counter('http_requests_total', 'Responses by view, method and status', ('view', 'method', 'status'))
+http_duration = Histogram('http_request_duration_seconds', 'Time to produce a response, by view', ('view',))
+singleflight_requests = Counter('singleflight_requests_total',
+                                'Coalescable requests: computed, shared in-process or shared via the cache',
+                                ('view', 'outcome'))
+executor_queue_wait = Histogram('executor_queue_wait_seconds', 'Time fan-out tasks waited for a thread')
+executor_shed = Counter('executor_shed_total', 'Requests turned away with 503 by fan-out backpressure', ('reason',))
+s3_concurrency_decreases = Counter('s3_concurrency_decreases_total', 'Cuts to the adaptive S3 concurrency limit',
+                                   ('reason',))
+
+_metrics = [s3_requests, s3_duration, s3_retries, s3_throttles, tokeninfo_requests, tokeninfo_duration,
+            s3_events, http_requests, http_duration, singleflight_requests, executor_queue_wait, executor_shed,
+            s3_concurrency_decreases]
+
+
+def expose(gauges=None):
+    """Prometheus text format; ``gauges`` maps extra names to ``(help, value)`` read at scrape time."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.expose())
+    for name, (help_text, value) in sorted((gauges or {}).items()):
+        if value is not None:
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {_number(value)}'])
+    return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics:
+    """What one request spent on S3 and tokeninfo, for its Server-Timing header."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = defaultdict(lambda: [0, 0.0])
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        # Fan-out threads record into the same request concurrently
+        with self._lock:
+            timing = self.timings[name]
+            timing[0] += 1
+            timing[1] += seconds
+
+    def server_timing(self):
+        with self._lock:
+            timings = sorted(self.timings.items())
+        entries = []
+        s3_calls = sum(count for name, (count, _) in timings if name.startswith('s3.'))
+        if s3_calls:
+            s3_seconds = sum(seconds for name, (_, seconds) in timings if name.startswith('s3.'))
+            entries.append(f's3;dur={s3_seconds * 1000:.1f};desc="{s3_calls} calls"')
+        for name, (count, seconds) in timings:
+            entries.append(f'{name.replace(".", "-")};dur={seconds * 1000:.1f};desc="{count}x"')
+        entries.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(entries)
+
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+def start_request():
+    recorder = RequestMetrics()
+    return recorder, _current.set(recorder)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def in_request():
+    return _current.get() is not None
+
+
+def record(name, seconds):
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.add(name, seconds)
+
+
+def observe_tokeninfo(seconds, outcome):
+    tokeninfo_requests.inc(outcome)
+    tokeninfo_duration.observe(seconds)
+    record('tokeninfo', seconds)
+
+
+# botocore event hooks. They are plain functions, so the async client can use them too.
+
+def _before_call(model, context, **kwargs):
+    context['metrics_started'] = time.perf_counter()
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    started = context.get('metrics_started')
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    s3_requests.inc(model.name, getattr(http_response, 'status_code', 0))
+    s3_duration.observe(elapsed, model.name)
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        s3_retries.inc(model.name, amount=retries)
+    record(f's3.{model.name}', elapsed)
+
+
+def _after_call_error(exception, model, context, **kwargs):
+    # Connection failures that outlasted the retries never reach after-call
+    started = context.get('metrics_started')
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    s3_requests.inc(model.name, 'error')
+    s3_duration.observe(elapsed, model.name)
+    record(f's3.{model.name}', elapsed)
+
+
+def _needs_retry(response, operation, **kwargs):
+    # Emitted after every attempt; only throttling responses are counted here
+    if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+        s3_throttles.inc(operation.name)
+
+
+def instrument(client):
+    events = client.meta.events
+    events.register('before-call.s3', _before_call)
+    events.register('after-call.s3', _after_call)
+    events.register('after-call-error.s3', _after_call_error)
+    events.register('needs-retry.s3', _needs_retry)
+    return client
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stale', models.BooleanField(default=True)),
+                ('object_count', models.BigIntegerField(default=0)),
+                ('last_synced', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='S3Object',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=1024, unique=True)),
+                ('parent', models.CharField(db_index=True, max_length=1024)),
+                ('basename', models.CharField(db_index=True, max_length=1024)),
+                ('extension', models.CharField(blank=True, db_index=True, max_length=32)),
+                ('is_folder', models.BooleanField(default=False)),
+                ('size', models.BigIntegerField(default=0)),
+                ('last_modified', models.DateTimeField(null=True)),
+                ('etag', models.CharField(blank=True, max_length=128)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['is_folder', 'basename'], name='mainApp_s3o_is_fold_655316_idx'), models.Index(fields=['extension', 'basename'], name='mainApp_s3o_extensi_fa127f_idx')],
+            },
+        ),
+    ]
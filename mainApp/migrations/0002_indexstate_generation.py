@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainApp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexstate',
+            name='generation',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainApp', '0004_job_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageDerivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_key', models.CharField(db_index=True, max_length=1024)),
+                ('etag', models.CharField(max_length=64)),
+                ('size', models.PositiveIntegerField()),
+                ('format', models.CharField(max_length=8)),
+                ('key', models.CharField(max_length=1024, unique=True)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('bytes', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='imagederivative',
+            constraint=models.UniqueConstraint(fields=('source_key', 'etag', 'size', 'format'), name='unique_image_derivative'),
+        ),
+    ]
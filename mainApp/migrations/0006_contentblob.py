@@ -0,0 +1,27 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainApp', '0005_imagederivative'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContentBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('key', models.CharField(db_index=True, max_length=1024)),
+                ('etag', models.CharField(blank=True, max_length=128)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('bytes_saved', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_hit_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.13 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainApp', '0006_contentblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RemovedKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=1024, unique=True)),
+                ('sequencer', models.CharField(blank=True, max_length=64)),
+                ('removed_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='s3object',
+            name='sequencer',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.13 on 2026-10-18 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainApp', '0008_job_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageMetadata',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=1024, unique=True)),
+                ('parent', models.CharField(db_index=True, max_length=1024)),
+                ('etag', models.CharField(blank=True, max_length=128)),
+                ('format', models.CharField(db_index=True, max_length=16)),
+                ('width', models.PositiveIntegerField(db_index=True)),
+                ('height', models.PositiveIntegerField(db_index=True)),
+                ('orientation', models.PositiveSmallIntegerField(null=True)),
+                ('taken_at', models.DateTimeField(db_index=True, null=True)),
+                ('size', models.BigIntegerField(db_index=True, default=0)),
+                ('last_modified', models.DateTimeField(null=True)),
+                ('extracted_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['parent', 'taken_at'], name='mainApp_ima_parent_a1f6c7_idx'), models.Index(fields=['parent', 'width'], name='mainApp_ima_parent_555864_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainApp', '0009_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='s3object',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
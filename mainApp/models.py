@@ -1,3 +1,165 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class S3Object(models.Model):
+    key = models.CharField(max_length=1024, unique=True)
+    parent = models.CharField(max_length=1024, db_index=True)
+    basename = models.CharField(max_length=1024, db_index=True)
+    extension = models.CharField(max_length=32, blank=True, db_index=True)
+    is_folder = models.BooleanField(default=False)
+    size = models.BigIntegerField(default=0)
+    last_modified = models.DateTimeField(null=True)
+    etag = models.CharField(max_length=128, blank=True)
+    # Sequencer of the S3 event last applied to the row; blank when our own views wrote it
+    sequencer = models.CharField(max_length=64, blank=True)
+    # A folder marker's createdAt metadata, once known; moves copy the metadata, not the time
+    created_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_folder', 'basename']),
+            models.Index(fields=['extension', 'basename']),
+        ]
+
+    def __str__(self):
+        return self.key
+
+
+class RemovedKey(models.Model):
+    # Tombstones, so an ObjectCreated event delivered after a newer ObjectRemoved is ignored
+    key = models.CharField(max_length=1024, unique=True)
+    sequencer = models.CharField(max_length=64, blank=True)
+    removed_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.key
+
+
+class IndexState(models.Model):
+    stale = models.BooleanField(default=True)
+    object_count = models.BigIntegerField(default=0)
+    generation = models.BigIntegerField(default=0)
+    last_synced = models.DateTimeField(null=True)
+
+    @classmethod
+    def get(cls):
+        state, _ = cls.objects.get_or_create(pk=1)
+        return state
+
+
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+    FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+    kind = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    params = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
+    progress = models.BigIntegerField(default=0)
+    total = models.BigIntegerField(null=True)
+    result = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    # Where a resumable handler got to; a retried attempt picks up from here
+    checkpoint = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=1)
+    run_after = models.DateTimeField(default=timezone.now)
+    cancel_requested = models.BooleanField(default=False)
+    locked_by = models.CharField(max_length=255, blank=True)
+    heartbeat_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+
+    def as_dict(self):
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'status': self.status,
+            'params': self.params,
+            'progress': self.progress,
+            'total': self.total,
+            'result': self.result,
+            'checkpoint': self.checkpoint,
+            'error': self.error,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'cancel_requested': self.cancel_requested,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class ImageDerivative(models.Model):
+    source_key = models.CharField(max_length=1024, db_index=True)
+    etag = models.CharField(max_length=64)
+    size = models.PositiveIntegerField()
+    format = models.CharField(max_length=8)
+    key = models.CharField(max_length=1024, unique=True)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    bytes = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source_key', 'etag', 'size', 'format'], name='unique_image_derivative'),
+        ]
+
+
+class ContentBlob(models.Model):
+    # One row per distinct upload content; key is the object later duplicates are copied from
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    key = models.CharField(max_length=1024, db_index=True)
+    etag = models.CharField(max_length=128, blank=True)
+    hits = models.PositiveIntegerField(default=0)
+    bytes_saved = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_hit_at = models.DateTimeField(null=True)
+
+
+class ImageMetadata(models.Model):
+    # Read from the image's headers when it is written; width and height are as displayed,
+    # after EXIF orientation
+    key = models.CharField(max_length=1024, unique=True)
+    parent = models.CharField(max_length=1024, db_index=True)
+    etag = models.CharField(max_length=128, blank=True)
+    format = models.CharField(max_length=16, db_index=True)
+    width = models.PositiveIntegerField(db_index=True)
+    height = models.PositiveIntegerField(db_index=True)
+    orientation = models.PositiveSmallIntegerField(null=True)
+    # EXIF capture time. Cameras that record no UTC offset have their clock taken as UTC.
+    taken_at = models.DateTimeField(null=True, db_index=True)
+    size = models.BigIntegerField(default=0, db_index=True)
+    last_modified = models.DateTimeField(null=True)
+    extracted_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['parent', 'taken_at']),
+            models.Index(fields=['parent', 'width']),
+        ]
+
+    def __str__(self):
+        return self.key
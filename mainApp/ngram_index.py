@@ -0,0 +1,364 @@
+import base64
+import bisect
+import heapq
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from mainApp.models import IndexState, S3Object
+
+logger = logging.getLogger(__name__)
+
+# 3: JSON, so loading a snapshot never runs code from it (2 was a pickle)
+SNAPSHOT_VERSION = 3
+
+
+def basename_of(key):
+    return key.rstrip('/').rsplit('/', 1)[-1]
+
+
+def searchable(key):
+    # What a query has to occur in, as in the S3 scan: a folder's own name, a file's whole key
+    return (basename_of(key) if key.endswith('/') else key).lower()
+
+
+class PrefixTrie:
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.insert(prefix)
+
+    def insert(self, prefix):
+        node = self.root
+        for part in prefix.rstrip('/').split('/'):
+            node = node.setdefault(part, {})
+        node[None] = True
+
+    def covers(self, key):
+        node = self.root
+        for part in key.split('/')[:-1]:
+            node = node.get(part)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class NgramIndex:
+    def __init__(self, n=3):
+        self.n = n
+        self.keys = []
+        self.names = []
+        self.ids = {}
+        self.postings = {}
+        # Names shorter than n, which have no grams
+        self.short = []
+        self.removed = 0
+        self.generation = None
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def grams(self, text):
+        return {text[i:i + self.n] for i in range(len(text) - self.n + 1)}
+
+    def add(self, key):
+        with self.lock:
+            if key in self.ids:
+                return
+            doc_id = len(self.keys)
+            name = searchable(key)
+            self.keys.append(key)
+            self.names.append(name)
+            self.ids[key] = doc_id
+            if len(name) < self.n:
+                self.short.append(doc_id)
+            for gram in self.grams(name):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array('I')
+                posting.append(doc_id)
+
+    def remove(self, key):
+        with self.lock:
+            doc_id = self.ids.pop(key, None)
+            if doc_id is None:
+                return
+            self.keys[doc_id] = None
+            self.removed += 1
+            if self.removed > max(1024, len(self.keys) // 4):
+                self._compact()
+
+    def remove_prefix(self, prefix):
+        with self.lock:
+            for key in [key for key in self.ids if key.startswith(prefix)]:
+                self.remove(key)
+
+    def _compact(self):
+        live = [key for key in self.keys if key is not None]
+        self.keys, self.names, self.ids, self.postings, self.short, self.removed = [], [], {}, {}, [], 0
+        for key in live:
+            self.add(key)
+
+    def _candidates(self, query):
+        if len(query) < self.n:
+            # A shorter query occurs in a name only inside one of its grams, so the matches
+            # are the postings of the grams containing it, plus the names too short for any
+            candidates = set(doc_id for doc_id in self.short if query in self.names[doc_id])
+            for gram, posting in self.postings.items():
+                if query in gram:
+                    candidates.update(posting)
+            return sorted(candidates)
+        postings = sorted((self.postings.get(gram) for gram in self.grams(query)),
+                          key=lambda p: len(p) if p is not None else -1)
+        if postings[0] is None:
+            return ()
+        candidates = postings[0]
+        for posting in postings[1:]:
+            candidates = [doc_id for doc_id in candidates if _contains(posting, doc_id)]
+            if not candidates:
+                return ()
+        return (doc_id for doc_id in candidates if query in self.names[doc_id])
+
+    @staticmethod
+    def _rank(query, key):
+        name = basename_of(key).lower()
+        position = name.find(query)
+        if name == query:
+            tier = 0
+        elif position == 0:
+            tier = 1
+        elif position > 0 and not name[position - 1].isalnum():
+            tier = 2
+        elif position > 0:
+            tier = 3
+        else:
+            # Only the file's path matches
+            tier = 4
+        return tier, len(name), key
+
+    def search(self, query, file_type=None, limit=None, offset=0):
+        query = query.lower()
+        file_type = file_type.lower() if file_type else None
+        folders = []
+        files = []
+        with self.lock:
+            for doc_id in self._candidates(query):
+                key = self.keys[doc_id]
+                if key is None:
+                    continue
+                rank = self._rank(query, key)
+                if key.endswith('/'):
+                    folders.append(rank)
+                elif not file_type or key.lower().endswith(file_type):
+                    files.append(rank)
+
+        trie = PrefixTrie(rank[2] for rank in folders)
+        files = [rank for rank in files if not trie.covers(rank[2])]
+        page = _page(folders + files, limit, offset)
+        return {
+            'files': [key for key in page if not key.endswith('/')],
+            'folders': [key for key in page if key.endswith('/')],
+            'total_files': len(files),
+            'total_folders': len(folders),
+        }
+
+    def save(self, path):
+        with self.lock:
+            if self.removed:
+                self._compact()
+            payload = {
+                'version': SNAPSHOT_VERSION,
+                'n': self.n,
+                'generation': self.generation,
+                'keys': _encode(zlib.compress('\n'.join(self.keys).encode('utf-8'))),
+                'postings': {gram: _encode(posting.tobytes()) for gram, posting in self.postings.items()},
+            }
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, delete=False) as fh:
+            json.dump(payload, fh, ensure_ascii=False, separators=(',', ':'))
+        os.replace(fh.name, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as fh:
+            payload = json.load(fh)
+        if not isinstance(payload, dict) or payload.get('version') != SNAPSHOT_VERSION:
+            version = payload.get('version') if isinstance(payload, dict) else None
+            raise ValueError(f'Unsupported search index snapshot version: {version}')
+        index = cls(payload['n'])
+        data = zlib.decompress(_decode(payload['keys'])).decode('utf-8')
+        index.keys = data.split('\n') if data else []
+        index.names = [searchable(key) for key in index.keys]
+        index.ids = {key: doc_id for doc_id, key in enumerate(index.keys)}
+        index.short = [doc_id for doc_id, name in enumerate(index.names) if len(name) < index.n]
+        for gram, raw in payload['postings'].items():
+            posting = array('I')
+            posting.frombytes(_decode(raw))
+            index.postings[gram] = posting
+        index.generation = payload['generation']
+        return index
+
+    @classmethod
+    def from_database(cls, n=3):
+        index = cls(n)
+        index.generation = IndexState.get().generation
+        for key in S3Object.objects.order_by('pk').values_list('key', flat=True).iterator(chunk_size=10000):
+            index.add(key)
+        return index
+
+
+def _encode(raw):
+    return base64.b64encode(raw).decode('ascii')
+
+
+def _decode(text):
+    return base64.b64decode(text, validate=True)
+
+
+def _contains(posting, doc_id):
+    i = bisect.bisect_left(posting, doc_id)
+    return i < len(posting) and posting[i] == doc_id
+
+
+def _page(ranked, limit, offset):
+    # Folders and files share one ranking, so a page holds at most ``limit`` of both together
+    if limit is None:
+        ranked = sorted(ranked)[offset:]
+    else:
+        ranked = heapq.nsmallest(offset + limit, ranked)[offset:]
+    return [rank[2] for rank in ranked]
+
+
+_index = None
+_index_checked_at = 0
+_index_lock = threading.Lock()
+# One build of a missing index at a time
+_build_lock = threading.Lock()
+# Changes made while a build runs, as (change, generation), replayed onto its result
+_pending = None
+# Bumped by reset(), so a build that started before it is thrown away
+_epoch = 0
+
+
+def _load():
+    path = settings.SEARCH_INDEX_SNAPSHOT
+    generation = IndexState.get().generation
+    if path and os.path.exists(path):
+        try:
+            index = NgramIndex.load(path)
+            if index.generation == generation:
+                return index
+            logger.info('Search index snapshot is out of date, rebuilding from the key index')
+        except Exception as e:
+            logger.error(f'Error loading search index snapshot {path}: {str(e)}')
+    return NgramIndex.from_database()
+
+
+def _build(loader):
+    """Run ``loader`` and install its index, with the changes applied meanwhile replayed onto it.
+
+    Called with _build_lock held. Returns the new index, which is not installed when
+    reset() ran in the meantime.
+    """
+    global _index, _pending
+    with _index_lock:
+        _pending = []
+        epoch = _epoch
+    try:
+        index = loader()
+    except BaseException:
+        with _index_lock:
+            _pending = None
+        raise
+    with _index_lock:
+        changes, _pending = _pending, None
+        for change, generation in changes:
+            change(index)
+            if index.generation is not None and generation == index.generation + 1:
+                index.generation = generation
+        if epoch == _epoch:
+            _index = index
+    return index
+
+
+def _rebuild_in_background():
+    def run():
+        try:
+            _build(NgramIndex.from_database)
+        except Exception as e:
+            logger.error(f'Error rebuilding search index: {str(e)}')
+        finally:
+            _build_lock.release()
+            close_old_connections()
+
+    threading.Thread(target=run, name='search-index-rebuild', daemon=True).start()
+
+
+def get_index():
+    """The search index, built on first use.
+
+    Every SEARCH_INDEX_REFRESH_SECONDS a process checks whether other processes wrote
+    through the key index since its index was built. If so it rebuilds in a background
+    thread and keeps answering from the index it has until the new one is ready.
+    """
+    global _index_checked_at
+    now = time.monotonic()
+    index = _index
+    if index is None:
+        with _build_lock:
+            index = _index
+            if index is None:
+                index = _build(_load)
+                _index_checked_at = time.monotonic()
+        return index
+    if now - _index_checked_at >= settings.SEARCH_INDEX_REFRESH_SECONDS and _build_lock.acquire(blocking=False):
+        started = False
+        try:
+            _index_checked_at = now
+            if IndexState.get().generation != index.generation:
+                _rebuild_in_background()
+                started = True
+        finally:
+            if not started:
+                _build_lock.release()
+    return index
+
+
+def apply(change, generation):
+    """Apply ``change(index)``, a write through the key index that made ``generation``.
+
+    It goes to the loaded index, and to one being built once that is ready.
+    """
+    with _index_lock:
+        index = _index
+        if _pending is not None:
+            _pending.append((change, generation))
+    if index is not None:
+        with index.lock:
+            change(index)
+            # Only claim the new generation if nobody else wrote in between
+            if index.generation is not None and generation == index.generation + 1:
+                index.generation = generation
+
+
+def loaded_index():
+    return _index
+
+
+def reset():
+    global _index, _index_checked_at, _epoch
+    with _index_lock:
+        _index = None
+        _index_checked_at = 0
+        _epoch += 1
@@ -0,0 +1,42 @@
+import base64
+import json
+
+MAX_PAGE_SIZE = 1000
+SORT_MODES = ('name',)
+
+
+class InvalidPageRequest(ValueError):
+    pass
+
+
+def encode_cursor(prefix, token, sort):
+    payload = json.dumps({'p': prefix, 't': token, 's': sort}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, prefix, sort):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        token = payload['t']
+    except (ValueError, KeyError, TypeError):
+        raise InvalidPageRequest('Invalid cursor')
+    if payload.get('p') != prefix or payload.get('s') != sort:
+        raise InvalidPageRequest('Cursor does not belong to this listing')
+    return token
+
+
+def page_params(request, prefix):
+    try:
+        limit = int(request.GET['limit'])
+    except ValueError:
+        raise InvalidPageRequest('limit must be an integer')
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise InvalidPageRequest(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    sort = request.GET.get('sort', 'name')
+    if sort not in SORT_MODES:
+        raise InvalidPageRequest(f'sort must be one of {", ".join(SORT_MODES)}')
+    token = None
+    if request.GET.get('cursor'):
+        token = decode_cursor(request.GET['cursor'], prefix, sort)
+    return limit, sort, token
@@ -0,0 +1,360 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote_plus
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.dateparse import parse_datetime
+
+from mainApp import dedup, image_metadata, key_index, metrics, ngram_index, stats_cache, thumbnails
+from mainApp.models import RemovedKey, S3Object
+
+logger = logging.getLogger(__name__)
+
+CREATED = 'created'
+REMOVED = 'removed'
+BATCH_SIZE = key_index.BULK_BATCH_SIZE
+# Past this many touched folders one epoch bump under the prefix is cheaper than per-folder invalidation
+MAX_FOLDER_INVALIDATIONS = 1000
+
+
+class S3Event:
+    __slots__ = ('action', 'bucket', 'key', 'size', 'etag', 'sequencer', 'time')
+
+    def __init__(self, action, bucket, key, size=0, etag='', sequencer='', time=None):
+        self.action = action
+        self.bucket = bucket
+        self.key = key
+        self.size = size or 0
+        self.etag = (etag or '').strip('"')
+        self.sequencer = sequencer or ''
+        self.time = time or datetime.now(timezone.utc)
+
+
+def _action(event_name):
+    if event_name.startswith('ObjectCreated:'):
+        return CREATED
+    if event_name.startswith(('ObjectRemoved:', 'LifecycleExpiration:')):
+        return REMOVED
+    return None
+
+
+def parse(payload):
+    """Return the S3Events in a notification, an SNS envelope around one, or a list of either.
+
+    Raises ValueError for anything that is not JSON of that shape. s3:TestEvent, event
+    types other than ObjectCreated/ObjectRemoved and records whose sequencer is not hex
+    yield nothing.
+    """
+    if isinstance(payload, (bytes, str)):
+        payload = json.loads(payload)
+    if isinstance(payload, list):
+        return [event for item in payload for event in parse(item)]
+    if not isinstance(payload, dict):
+        raise ValueError('S3 event payload must be a JSON object')
+    if payload.get('Type') == 'Notification' and 'Message' in payload:
+        return parse(payload['Message'])
+
+    events = []
+    for record in payload.get('Records') or []:
+        action = _action(record.get('eventName', ''))
+        s3 = record.get('s3') or {}
+        obj = s3.get('object') or {}
+        if action is None or not obj.get('key'):
+            continue
+        if not _valid_sequencer(obj.get('sequencer')):
+            # Retrying the batch cannot fix it, so the record is dropped rather than failing the rest
+            logger.error(f'Skipping S3 event for {obj["key"]} with malformed sequencer {obj.get("sequencer")!r}')
+            metrics.s3_events.inc('malformed')
+            continue
+        events.append(S3Event(
+            action,
+            (s3.get('bucket') or {}).get('name'),
+            # Keys arrive form-encoded: spaces as '+', everything else percent-escaped
+            unquote_plus(obj['key']),
+            size=obj.get('size'),
+            etag=obj.get('eTag'),
+            sequencer=obj.get('sequencer'),
+            time=parse_datetime(record.get('eventTime') or ''),
+        ))
+    return events
+
+
+def _valid_sequencer(sequencer):
+    if not sequencer:
+        return True
+    try:
+        int(sequencer, 16)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _newer(event, sequencer, when):
+    """Whether ``event`` happened after the state recorded with ``sequencer`` at ``when``."""
+    if event.sequencer and sequencer:
+        # Sequencers of one key are hex strings of varying length, so compare them as numbers
+        return int(event.sequencer, 16) > int(sequencer, 16)
+    # Rows our views or reconcile wrote carry no sequencer, only the time of the write
+    return when is None or event.time >= when
+
+
+def _folders(keys):
+    # A folder marker's own listing changes with it; a file changes its parent's
+    return {key if key.endswith('/') else key_index.split_key(key)[0] for key in keys}
+
+
+def _invalidate(keys, prefix=''):
+    folders = _folders(keys)
+    if len(folders) > MAX_FOLDER_INVALIDATIONS:
+        stats_cache.invalidate_prefix(prefix)
+        return
+    for folder in folders:
+        stats_cache.invalidate_key(folder)
+
+
+def _known_state(keys):
+    # key -> (sequencer, time) of the latest change we applied: the row, or its tombstone
+    state = {}
+    for start in range(0, len(keys), BATCH_SIZE):
+        chunk = keys[start:start + BATCH_SIZE]
+        for key, sequencer, removed_at in RemovedKey.objects.filter(key__in=chunk).values_list(
+                'key', 'sequencer', 'removed_at'):
+            state[key] = (sequencer, removed_at)
+        for key, sequencer, last_modified in S3Object.objects.filter(key__in=chunk).values_list(
+                'key', 'sequencer', 'last_modified'):
+            state[key] = (sequencer, last_modified)
+    return state
+
+
+def _record_tombstones(created, removed):
+    with transaction.atomic():
+        keys = [event.key for event in created]
+        for start in range(0, len(keys), BATCH_SIZE):
+            RemovedKey.objects.filter(key__in=keys[start:start + BATCH_SIZE]).delete()
+        RemovedKey.objects.bulk_create(
+            [RemovedKey(key=event.key, sequencer=event.sequencer, removed_at=event.time) for event in removed],
+            batch_size=BATCH_SIZE, update_conflicts=True, unique_fields=['key'],
+            update_fields=['sequencer', 'removed_at'])
+
+
+def apply(events, bucket_name, s3_client=None):
+    """Apply a batch of events to the key index, folder rollups, dedup records and thumbnails.
+
+    Events may arrive late, duplicated or out of order; per key only the one with the
+    highest sequencer counts, and only if it is newer than what was last applied. Returns
+    counts of events applied, skipped as stale and ignored (other buckets, derivatives).
+    """
+    counts = {'applied': 0, 'stale': 0, 'ignored': 0}
+    latest = {}
+    for event in events:
+        if event.bucket != bucket_name or thumbnails.is_derived(event.key):
+            counts['ignored'] += 1
+            continue
+        current = latest.get(event.key)
+        if current is not None:
+            counts['stale'] += 1
+            if not _newer(event, current.sequencer, current.time):
+                continue
+        latest[event.key] = event
+
+    known = _known_state(list(latest))
+    created, removed = [], []
+    for key, event in latest.items():
+        if key in known and not _newer(event, *known[key]):
+            counts['stale'] += 1
+            continue
+        (created if event.action == CREATED else removed).append(event)
+    counts['applied'] = len(created) + len(removed)
+
+    if created or removed:
+        key_index.apply_changes(
+            [key_index.build_object(e.key, e.size, e.time, e.etag, e.sequencer) for e in created],
+            [e.key for e in removed])
+        _record_tombstones(created, removed)
+        _invalidate([e.key for e in created + removed])
+        dedup.forget_keys(e.key for e in removed)
+        # Written outside the app, so a blob recorded for the key no longer describes it
+        dedup.forget_overwritten((e.key, e.etag) for e in created)
+        image_metadata.forget_keys(e.key for e in removed)
+        for event in removed:
+            if s3_client is not None and thumbnails.is_image(event.key):
+                thumbnails.delete_for(s3_client, bucket_name, event.key)
+        for event in created:
+            thumbnails.schedule(bucket_name, event.key, event.etag, event.size)
+            image_metadata.schedule(bucket_name, event.key, event.etag, event.size)
+
+    for outcome, count in counts.items():
+        if count:
+            metrics.s3_events.inc(outcome, amount=count)
+    return counts
+
+
+def _reconcile_page(listed, started, counts):
+    """Compare one page of the listing with the index rows for the same keys."""
+    changed, seen = [], set()
+    keys = list(listed)
+    for start in range(0, len(keys), BATCH_SIZE):
+        rows = S3Object.objects.filter(key__in=keys[start:start + BATCH_SIZE]).values_list(
+            'key', 'size', 'etag', 'last_modified')
+        for key, size, etag, last_modified in rows:
+            seen.add(key)
+            # Anything written after the reconcile began may be newer than the listing
+            if last_modified is not None and last_modified >= started:
+                continue
+            obj = listed[key]
+            if size != obj.get('Size', 0) or etag != obj.get('ETag', '').strip('"'):
+                changed.append(obj)
+    added = [obj for key, obj in listed.items() if key not in seen]
+    if added:
+        recently_removed = set(RemovedKey.objects.filter(
+            key__in=[obj['Key'] for obj in added], removed_at__gte=started).values_list('key', flat=True))
+        added = [obj for obj in added if obj['Key'] not in recently_removed]
+
+    counts['listed'] += len(listed)
+    counts['added'] += len(added)
+    counts['updated'] += len(changed)
+    upserts = [key_index.build_object(obj['Key'], obj.get('Size', 0), obj.get('LastModified'), obj.get('ETag', ''))
+               for obj in added + changed]
+    if not upserts:
+        return [], True
+    ok = key_index.apply_changes(upserts)
+    dedup.forget_overwritten((obj['Key'], obj.get('ETag')) for obj in changed)
+    return [obj.key for obj in upserts], bool(ok)
+
+
+def _reconcile_removed(prefix, listed_keys, started, counts):
+    """Drop the index rows under ``prefix`` that the listing no longer has."""
+    rows = S3Object.objects.filter(key_index.prefix_filter(prefix)).values_list('key', 'last_modified')
+    removed = [key for key, last_modified in rows.iterator(chunk_size=BATCH_SIZE)
+               if key not in listed_keys and (last_modified is None or last_modified < started)]
+    counts['removed'] += len(removed)
+    ok = True
+    for start in range(0, len(removed), BATCH_SIZE):
+        batch = removed[start:start + BATCH_SIZE]
+        ok = bool(key_index.apply_changes([], batch)) and ok
+        dedup.forget_keys(batch)
+        image_metadata.forget_keys(batch)
+    return removed, ok
+
+
+def reconcile(s3_client, bucket_name, prefix=''):
+    """Bring the key index under ``prefix`` in line with a flat listing.
+
+    Each listing page is checked against the rows for its keys; rows the listing never
+    showed are removed at the end. Keys are matched exactly rather than by ranges, since
+    the database's collation need not order them as S3 does. Rows and tombstones written
+    after the reconcile began are left alone, because the listing may predate them. A
+    whole-bucket pass also expires old tombstones and, if every write went through,
+    marks the index fresh.
+    """
+    started = datetime.now(timezone.utc)
+    counts = {'listed': 0, 'added': 0, 'updated': 0, 'removed': 0}
+    touched = []
+    ok = True
+    listed_keys = set()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': BATCH_SIZE}):
+        listed = {obj['Key']: obj for obj in page.get('Contents', []) if not thumbnails.is_derived(obj['Key'])}
+        if not listed:
+            continue
+        listed_keys.update(listed)
+        keys, page_ok = _reconcile_page(listed, started, counts)
+        touched.extend(keys)
+        ok = ok and page_ok
+
+    keys, removed_ok = _reconcile_removed(prefix, listed_keys, started, counts)
+    touched.extend(keys)
+    ok = ok and removed_ok
+
+    _invalidate(touched, prefix)
+    if not prefix:
+        RemovedKey.objects.filter(
+            removed_at__lt=started - timedelta(seconds=settings.S3_EVENTS_TOMBSTONE_TTL)).delete()
+        if ok:
+            was_ready = key_index.is_ready()
+            key_index.mark_synced(started)
+            if not was_ready:
+                ngram_index.reset()
+    counts['seconds'] = round((datetime.now(timezone.utc) - started).total_seconds(), 3)
+    return counts
+
+
+class SqsQueue:
+    def __init__(self, client, queue_url):
+        self.client = client
+        self.queue_url = queue_url
+
+    def receive(self, max_messages, wait_seconds):
+        response = self.client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=max_messages,
+                                               WaitTimeSeconds=wait_seconds)
+        return [(message['ReceiptHandle'], message['Body']) for message in response.get('Messages', [])]
+
+    def delete(self, receipts):
+        entries = [{'Id': str(n), 'ReceiptHandle': receipt} for n, receipt in enumerate(receipts)]
+        for start in range(0, len(entries), 10):
+            response = self.client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries[start:start + 10])
+            for failure in response.get('Failed', []):
+                logger.error(f'Error deleting S3 event message: {failure.get("Message", failure.get("Code"))}')
+
+
+class Consumer:
+    """Reads event notifications from ``queue`` and applies them in batches.
+
+    ``queue`` needs ``receive(max_messages, wait_seconds)`` returning ``(receipt, body)``
+    pairs and ``delete(receipts)``; SqsQueue wraps SQS. Messages are deleted only once
+    their events are applied, so a crash redelivers them.
+    """
+
+    def __init__(self, queue, bucket_name, s3_client=None, batch_size=10, wait_seconds=20, reconcile_interval=0):
+        self.queue = queue
+        self.bucket_name = bucket_name
+        self.s3_client = s3_client
+        self.batch_size = batch_size
+        self.wait_seconds = wait_seconds
+        self.reconcile_interval = reconcile_interval
+        self.last_reconcile = time.monotonic()
+        self.stopping = threading.Event()
+
+    def poll(self):
+        messages = self.queue.receive(self.batch_size, self.wait_seconds)
+        events, done = [], []
+        for receipt, body in messages:
+            try:
+                events.extend(parse(body))
+            except ValueError as e:
+                # Left on the queue, so its redrive policy can move it to a dead-letter queue
+                logger.error(f'Unreadable S3 event message: {str(e)}')
+                metrics.s3_events.inc('unreadable')
+                continue
+            done.append(receipt)
+        if events:
+            apply(events, self.bucket_name, self.s3_client)
+        if done:
+            self.queue.delete(done)
+        return len(messages)
+
+    def reconcile_due(self):
+        return self.reconcile_interval > 0 and time.monotonic() - self.last_reconcile >= self.reconcile_interval
+
+    def run(self, until_empty=False):
+        while not self.stopping.is_set():
+            try:
+                received = self.poll()
+                if self.reconcile_due():
+                    self.last_reconcile = time.monotonic()
+                    counts = reconcile(self.s3_client, self.bucket_name)
+                    logger.info(f'Reconciled key index with {self.bucket_name}: {counts}')
+                if until_empty and not received:
+                    break
+            except Exception as e:
+                logger.error(f'S3 event consumer poll failed: {str(e)}')
+                self.stopping.wait(1)
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self.stopping.set()
@@ -0,0 +1,245 @@
+import asyncio
+import functools
+import hashlib
+import threading
+import time
+import weakref
+from urllib.parse import urlencode
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from mainApp import metrics
+
+POLL_INTERVAL = 0.05
+
+
+class _Flight:
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class Group:
+    """One call per key at a time; callers arriving meanwhile wait and share its result.
+
+    A caller whose leader failed, produced None or outlasted ``timeout`` runs the call
+    itself. ``do`` returns ``(result, shared)``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func, timeout):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if flight.done.wait(timeout) and flight.result is not None:
+                return flight.result, True
+            return func(), False
+        try:
+            flight.result = func()
+            return flight.result, False
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class AsyncGroup:
+    """Group for coroutines; flights belong to the event loop they started on."""
+
+    def __init__(self):
+        self._flights = {}
+
+    async def do(self, key, func, timeout):
+        flight = self._flights.get(key)
+        if flight is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(flight), timeout)
+            except asyncio.TimeoutError:
+                result = None
+            if result is not None:
+                return result, True
+            return await func(), False
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        result = None
+        try:
+            result = await func()
+            return result, False
+        finally:
+            del self._flights[key]
+            flight.set_result(result)
+
+
+_group = Group()
+_async_groups = weakref.WeakKeyDictionary()
+
+
+def _async_group():
+    loop = asyncio.get_running_loop()
+    group = _async_groups.get(loop)
+    if group is None:
+        group = _async_groups[loop] = AsyncGroup()
+    return group
+
+
+def _freeze(response):
+    # Only successes are shared; waiters on a failed leader each make their own attempt
+    if response.streaming or not (200 <= response.status_code < 300 or response.status_code == 304):
+        return None
+    return {'status': response.status_code, 'content': response.content, 'headers': list(response.items())}
+
+
+def _thaw(frozen):
+    # Each waiter gets its own response object, since middleware adds headers to it
+    return HttpResponse(frozen['content'], status=frozen['status'], headers=dict(frozen['headers']))
+
+
+def _shared_cache():
+    alias = settings.SINGLE_FLIGHT_CACHE_ALIAS
+    return caches[alias] if alias else None
+
+
+def _across_processes(cache, key, compute):
+    """Coalesce ``compute`` with other processes through a lock and a result in ``cache``.
+
+    Returns ``(frozen response, shared)``.
+    """
+    result_key, lock_key = f'singleflight:result:{key}', f'singleflight:lock:{key}'
+    frozen = cache.get(result_key)
+    if frozen is not None:
+        return frozen, True
+    if not cache.add(lock_key, 1, settings.SINGLE_FLIGHT_TIMEOUT):
+        deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            frozen = cache.get(result_key)
+            if frozen is not None:
+                return frozen, True
+            if cache.get(lock_key) is None:
+                # The other process gave up or failed; do the work here instead
+                break
+        return compute(), False
+    try:
+        frozen = compute()
+        if frozen is not None:
+            cache.set(result_key, frozen, settings.SINGLE_FLIGHT_RESULT_TTL)
+        return frozen, False
+    finally:
+        cache.delete(lock_key)
+
+
+def _key(view, request, token):
+    query = urlencode(sorted(request.GET.lists()), doseq=True)
+    raw = f'{view.__module__}.{view.__qualname__}:{request.path}?{query}:{token}'
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _coalescable(request):
+    return settings.SINGLE_FLIGHT_ENABLED and request.method == 'GET' and 'stream' not in request.GET
+
+
+def coalesce(version_func):
+    """Let concurrent identical GETs of the view share one response.
+
+    Requests are identical when they match on view, path, query string and the
+    ``(token, last_modified)`` that ``version_func`` returns (as for conditional.versioned).
+    A write in between changes the token and starts a fresh computation, so nobody is
+    handed a result from before a write they could have seen. With
+    SINGLE_FLIGHT_CACHE_ALIAS set, the processes sharing that cache coalesce too.
+    Streamed responses and responses other than 2xx and 304 are never shared.
+    """
+    def decorator(view):
+        name = view.__name__
+
+        def record(shared, via_cache):
+            metrics.singleflight_requests.inc(name, 'shared' if via_cache else 'coalesced' if shared else 'leader')
+
+        if iscoroutinefunction(view):
+            async def wrapper(request, *args, **kwargs):
+                if not _coalescable(request):
+                    return await view(request, *args, **kwargs)
+                token, _ = await sync_to_async(version_func, thread_sensitive=False)(request, *args, **kwargs)
+                key = _key(view, request, token)
+                own = {}
+                via_cache = False
+
+                async def compute():
+                    own['response'] = await view(request, *args, **kwargs)
+                    return _freeze(own['response'])
+
+                async def run():
+                    nonlocal via_cache
+                    cache = _shared_cache()
+                    if cache is None:
+                        return await compute()
+                    # The lock and result are shared, but the computation stays on this loop
+                    frozen = await sync_to_async(cache.get, thread_sensitive=False)(f'singleflight:result:{key}')
+                    if frozen is not None:
+                        via_cache = True
+                        return frozen
+                    acquired = await sync_to_async(cache.add, thread_sensitive=False)(
+                        f'singleflight:lock:{key}', 1, settings.SINGLE_FLIGHT_TIMEOUT)
+                    if not acquired:
+                        deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+                        while time.monotonic() < deadline:
+                            await asyncio.sleep(POLL_INTERVAL)
+                            values = await sync_to_async(cache.get_many, thread_sensitive=False)(
+                                [f'singleflight:result:{key}', f'singleflight:lock:{key}'])
+                            if values.get(f'singleflight:result:{key}') is not None:
+                                via_cache = True
+                                return values[f'singleflight:result:{key}']
+                            if f'singleflight:lock:{key}' not in values:
+                                break
+                        return await compute()
+                    try:
+                        frozen = await compute()
+                        if frozen is not None:
+                            await sync_to_async(cache.set, thread_sensitive=False)(
+                                f'singleflight:result:{key}', frozen, settings.SINGLE_FLIGHT_RESULT_TTL)
+                        return frozen
+                    finally:
+                        await sync_to_async(cache.delete, thread_sensitive=False)(f'singleflight:lock:{key}')
+
+                frozen, shared = await _async_group().do(key, run, settings.SINGLE_FLIGHT_TIMEOUT)
+                record(shared, via_cache and not shared)
+                if 'response' in own:
+                    return own['response']
+                return _thaw(frozen)
+        else:
+            def wrapper(request, *args, **kwargs):
+                if not _coalescable(request):
+                    return view(request, *args, **kwargs)
+                token, _ = version_func(request, *args, **kwargs)
+                key = _key(view, request, token)
+                own = {}
+                via_cache = False
+
+                def compute():
+                    own['response'] = view(request, *args, **kwargs)
+                    return _freeze(own['response'])
+
+                def run():
+                    nonlocal via_cache
+                    cache = _shared_cache()
+                    if cache is None:
+                        return compute()
+                    frozen, via_cache = _across_processes(cache, key, compute)
+                    return frozen
+
+                frozen, shared = _group.do(key, run, settings.SINGLE_FLIGHT_TIMEOUT)
+                record(shared, via_cache and not shared)
+                if 'response' in own:
+                    return own['response']
+                return _thaw(frozen)
+        return functools.wraps(view)(wrapper)
+    return decorator
@@ -0,0 +1,170 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from mainApp import folder_stats
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_counters = {
+    'hits': 0,
+    'misses': 0,
+    'invalidations': 0,
+    'recompute_seconds_total': 0.0,
+    'recompute_seconds_last': 0.0,
+}
+
+
+def get_cache():
+    return caches[settings.FOLDER_STATS_CACHE_ALIAS]
+
+
+def _digest(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def ancestors(key):
+    # '' plus every folder prefix above the key, and the key itself when it is a folder
+    parts = key.split('/')[:-1]
+    return [''] + ['/'.join(parts[:depth]) + '/' for depth in range(1, len(parts) + 1)]
+
+
+def _epoch_key(prefix):
+    return f'folderstats:epoch:{_digest(prefix)}'
+
+
+def _version_key(prefix):
+    return f'folderstats:version:{_digest(prefix)}'
+
+
+def _stamp():
+    return f'{uuid.uuid4().hex}:{time.time():.6f}'
+
+
+def _stamp_time(value):
+    try:
+        return float(value.rpartition(':')[2])
+    except ValueError:
+        return 0.0
+
+
+def _epochs(cache, epoch_keys, values=None):
+    """The epoch stamps for ``epoch_keys``, starting a fresh one for any that is missing.
+
+    A missing epoch never reads as a default: after an eviction that would bring back the
+    token of entries cached before the invalidation that bumped it.
+    """
+    values = cache.get_many(epoch_keys) if values is None else values
+    missing = [k for k in epoch_keys if k not in values]
+    for k in missing:
+        cache.add(k, _stamp(), None)
+    if missing:
+        values.update(cache.get_many(missing))
+    return [values.get(k) or _stamp() for k in epoch_keys]
+
+
+def _entry_key(cache, kind, prefix):
+    # Entries are keyed by the epochs of their prefix and every ancestor, so bumping a
+    # folder's epoch drops every cached entry inside that folder at once
+    token = ':'.join(_epochs(cache, [_epoch_key(p) for p in ancestors(prefix)]))
+    return f'folderstats:{kind}:{_digest(prefix)}:{_digest(token)}'
+
+
+def _count(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def lookup(kind, prefix):
+    cache = get_cache()
+    cache_key = _entry_key(cache, kind, prefix)
+    value = cache.get(cache_key)
+    _count('hits' if value is not None else 'misses')
+    return cache_key, value
+
+
+def store(cache_key, value, elapsed):
+    with _lock:
+        _counters['recompute_seconds_total'] += elapsed
+        _counters['recompute_seconds_last'] = elapsed
+    get_cache().set(cache_key, value, settings.FOLDER_STATS_CACHE_TTL)
+
+
+def _get_or_compute(kind, prefix, compute):
+    cache_key, value = lookup(kind, prefix)
+    if value is not None:
+        return value
+    start = time.perf_counter()
+    value = compute()
+    store(cache_key, value, time.perf_counter() - start)
+    return value
+
+
+def get_listing(s3_client, bucket_name, prefix):
+    def compute():
+        listing = folder_stats.list_prefix(s3_client, bucket_name, prefix)
+        folder_stats.resolve_created_at(s3_client, bucket_name, listing.folders.values())
+        return listing.as_dict()
+    return _get_or_compute('listing', prefix, compute)
+
+
+def get_tree(s3_client, bucket_name, prefix):
+    def compute():
+        stats = folder_stats.collect_tree(s3_client, bucket_name, prefix)
+        folder_stats.resolve_created_at(s3_client, bucket_name, [stats])
+        return stats.as_dict()
+    return _get_or_compute('tree', prefix, compute)
+
+
+def version(prefix):
+    """Return ``(token, last_modified)`` naming the current state of everything under ``prefix``.
+
+    The token changes whenever a write below ``prefix`` invalidates it, so responses built
+    from the prefix can be revalidated without listing S3. last_modified is a Unix time.
+    """
+    cache = get_cache()
+    epoch_keys = [_epoch_key(p) for p in ancestors(prefix)]
+    version_key = _version_key(prefix)
+    values = cache.get_many(epoch_keys + [version_key])
+    if version_key not in values:
+        # First use, eviction or a restart: begin a new version instead of reusing a token
+        # a client may hold from before. It expires with the cached entries, which bounds
+        # how long writes made outside our views stay invisible.
+        cache.add(version_key, _stamp())
+        values[version_key] = cache.get(version_key) or _stamp()
+    stamps = _epochs(cache, epoch_keys, values) + [values[version_key]]
+    return _digest(':'.join(stamps)), max(_stamp_time(stamp) for stamp in stamps)
+
+
+def invalidate_key(key):
+    try:
+        cache = get_cache()
+        cache.delete_many([_entry_key(cache, kind, prefix)
+                           for prefix in ancestors(key) for kind in ('listing', 'tree')])
+        cache.set_many({_version_key(prefix): _stamp() for prefix in ancestors(key)})
+        _count('invalidations')
+    except Exception as e:
+        logger.error(f'Error invalidating folder stats for {key}: {str(e)}')
+
+
+def invalidate_prefix(prefix):
+    try:
+        cache = get_cache()
+        cache.set(_epoch_key(prefix), _stamp(), None)
+    except Exception as e:
+        logger.error(f'Error bumping folder stats epoch for {prefix}: {str(e)}')
+    invalidate_key(prefix)
+
+
+def stats():
+    with _lock:
+        result = dict(_counters)
+    lookups = result['hits'] + result['misses']
+    result['hit_ratio'] = result['hits'] / lookups if lookups else None
+    return result
@@ -0,0 +1,81 @@
+import json
+import logging
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def stream_format(request):
+    fmt = request.GET.get('stream')
+    return fmt if fmt in FORMATS else None
+
+
+def _dumps(item):
+    return json.dumps(item, cls=DjangoJSONEncoder)
+
+
+class _Encoder:
+    """Turns items into body chunks, counting them for the trailer that ends the body."""
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.counts = {}
+        self.separator = '['
+
+    def _chunk(self, item):
+        if self.fmt == 'ndjson':
+            return _dumps(item) + '\n'
+        chunk = self.separator + _dumps(item)
+        self.separator = ','
+        return chunk
+
+    def item(self, item):
+        self.counts[item['type']] = self.counts.get(item['type'], 0) + 1
+        return self._chunk(item)
+
+    def error(self, e):
+        # Headers are already sent, so the error has to travel in the body
+        logger.error(f'Error while streaming response: {str(e)}')
+        return self._chunk({'type': 'error', 'error': str(e)})
+
+    def end(self):
+        trailer = self._chunk({
+            'type': 'trailer',
+            'file_count': self.counts.get('file', 0),
+            'folder_count': self.counts.get('folder', 0),
+        })
+        return trailer if self.fmt == 'ndjson' else trailer + ']'
+
+
+def _body(items, encoder):
+    try:
+        for item in items:
+            yield encoder.item(item)
+    except Exception as e:
+        yield encoder.error(e)
+    yield encoder.end()
+
+
+async def _async_body(items, encoder):
+    try:
+        async for item in items:
+            yield encoder.item(item)
+    except Exception as e:
+        yield encoder.error(e)
+    yield encoder.end()
+
+
+def stream_response(items, fmt):
+    # Async iterators come from the async views and are streamed from the event loop
+    encoder = _Encoder(fmt)
+    body = _async_body(items, encoder) if hasattr(items, '__aiter__') else _body(items, encoder)
+    response = StreamingHttpResponse(body, content_type=FORMATS[fmt])
+    response['X-Accel-Buffering'] = 'no'
+    return response
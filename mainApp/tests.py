@@ -1,3 +1,1315 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-# Create your tests here.
+import boto3
+import requests
+from asgiref.sync import sync_to_async
+from botocore.exceptions import ClientError, ReadTimeoutError
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone as django_timezone
+
+from benchmarks.common import CLIENT_ID, TOKEN, TokenInfoStub
+from benchmarks.s3_standin import LocalQueue, S3StandIn
+from imgUploader import token_cache
+from imgUploader.token_cache import InvalidToken, TokenCache, TokenInfoUnavailable
+from mainApp import (async_s3, bulk_delete, clients, dedup, direct_uploads, executors, folder_move, folder_stats,
+                     image_metadata, jobs, key_index, ngram_index, pagination, s3_events, singleflight, thumbnails,
+                     zip_download)
+from mainApp.models import ContentBlob, ImageDerivative, ImageMetadata, Job, RemovedKey, S3Object
+from mainApp.upload_handlers import S3MultipartUploadHandler
+
+BUCKET = 'test-bucket'
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TokenCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(token_cache, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fetches = []
+
+    def fetch(self, result=None, error=None):
+        def fetch(token):
+            self.fetches.append(token)
+            if error is not None:
+                raise error
+            return dict(result or {'email': 'user@example.com'})
+        return fetch
+
+    def test_hit_until_ttl(self):
+        cache = TokenCache(ttl=60)
+        cache.verify('t', self.fetch())
+        self.clock.advance(59)
+        cache.verify('t', self.fetch())
+        self.assertEqual(len(self.fetches), 1)
+        self.clock.advance(1)
+        cache.verify('t', self.fetch())
+        self.assertEqual(len(self.fetches), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_exp_caps_ttl(self):
+        cache = TokenCache(ttl=300)
+        fetch = self.fetch({'exp': str(int(self.clock.now) + 10)})
+        cache.verify('t', fetch)
+        self.clock.advance(9)
+        self.assertIsNotNone(cache.lookup('t'))
+        self.clock.advance(1)
+        self.assertIsNone(cache.lookup('t'))
+
+    def test_expired_token_is_not_cached(self):
+        cache = TokenCache(ttl=300)
+        fetch = self.fetch({'exp': str(int(self.clock.now) - 1)})
+        cache.verify('t', fetch)
+        cache.verify('t', fetch)
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_malformed_exp_falls_back_to_ttl(self):
+        cache = TokenCache(ttl=60)
+        cache.verify('t', self.fetch({'exp': 'soon'}))
+        self.clock.advance(59)
+        self.assertIsNotNone(cache.lookup('t'))
+
+    def test_rejections_cached_for_negative_ttl(self):
+        cache = TokenCache(ttl=60, negative_ttl=5)
+        fetch = self.fetch(error=InvalidToken({'error': 'invalid_token'}))
+        for _ in range(2):
+            with self.assertRaises(InvalidToken):
+                cache.verify('t', fetch)
+        self.assertEqual(len(self.fetches), 1)
+        self.assertEqual(cache.stats()['negative_hits'], 1)
+        self.clock.advance(5)
+        with self.assertRaises(InvalidToken):
+            cache.verify('t', fetch)
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_rejections_not_cached_by_default(self):
+        cache = TokenCache(ttl=60)
+        fetch = self.fetch(error=InvalidToken('invalid'))
+        for _ in range(2):
+            with self.assertRaises(InvalidToken):
+                cache.verify('t', fetch)
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_transport_errors_never_cached(self):
+        cache = TokenCache(ttl=60, negative_ttl=60)
+        fetch = self.fetch(error=ConnectionError('down'))
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                cache.verify('t', fetch)
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_evicts_least_recently_used(self):
+        cache = TokenCache(max_size=2, ttl=60)
+        for token in ('a', 'b'):
+            cache.verify(token, self.fetch())
+        cache.lookup('a')
+        cache.verify('c', self.fetch())
+        self.assertIsNotNone(cache.lookup('a'))
+        self.assertIsNone(cache.lookup('b'))
+
+    def test_concurrent_misses_share_one_fetch(self):
+        cache = TokenCache(ttl=60)
+        release = threading.Event()
+        calls = []
+
+        def fetch(token):
+            calls.append(token)
+            release.wait(5)
+            return {'email': 'user@example.com'}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.verify('t', fetch))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        while cache.stats()['coalesced'] < 7:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 8)
+
+    def test_concurrent_misses_share_the_error(self):
+        cache = TokenCache(ttl=60)
+        release = threading.Event()
+
+        def fetch(token):
+            release.wait(5)
+            raise InvalidToken('invalid')
+
+        errors = []
+
+        def verify():
+            try:
+                cache.verify('t', fetch)
+            except InvalidToken as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=verify) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while cache.stats()['coalesced'] < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+class TokenInfoTests(SimpleTestCase):
+    def test_verifies_against_tokeninfo_once(self):
+        stub = TokenInfoStub()
+        cache = TokenCache(ttl=60)
+        with override_settings(GOOGLE_TOKENINFO_URL=stub.url):
+            first = cache.verify('t', token_cache.fetch_tokeninfo)
+            second = cache.verify('t', token_cache.fetch_tokeninfo)
+        self.assertEqual(first, second)
+        self.assertEqual(first['email'], 'bench@example.com')
+        self.assertEqual(stub.calls, 1)
+
+    def test_only_rejections_are_invalid_and_cached(self):
+        stub = TokenInfoStub()
+        cache = TokenCache(ttl=60, negative_ttl=60)
+        with override_settings(GOOGLE_TOKENINFO_URL=stub.url):
+            for status in (500, 503, 429):
+                stub.status = status
+                with self.assertRaises(TokenInfoUnavailable):
+                    cache.verify('t', token_cache.fetch_tokeninfo)
+            stub.status = 200
+            self.assertEqual(cache.verify('t', token_cache.fetch_tokeninfo)['email'], 'bench@example.com')
+
+            stub.status = 401
+            for _ in range(2):
+                with self.assertRaises(InvalidToken):
+                    cache.verify('revoked', token_cache.fetch_tokeninfo)
+        self.assertEqual(stub.calls, 5)
+
+    def test_middleware_asks_for_a_retry_while_tokeninfo_fails(self):
+        stub = TokenInfoStub()
+        stub.status = 503
+        with override_settings(GOOGLE_TOKENINFO_URL=stub.url), self.assertLogs('imgUploader.middleware', 'ERROR'):
+            response = self.client.get('/list-folders/', HTTP_AUTHORIZATION='unseen-token')
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+
+    def test_unreachable_tokeninfo_is_unavailable(self):
+        with override_settings(GOOGLE_TOKENINFO_URL='http://127.0.0.1:9/tokeninfo'), \
+                self.assertRaises(TokenInfoUnavailable):
+            token_cache.fetch_tokeninfo('t')
+
+
+class StandInTestCase(TestCase):
+    """Runs against benchmarks.s3_standin, a local S3 emulator, through a real boto3 client.
+
+    The views see the same client and bucket, and accept ``TOKEN`` through a local
+    tokeninfo stub.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.standin = S3StandIn().start()
+        cls.addClassCleanup(cls.standin.stop)
+        cls.tokeninfo = TokenInfoStub()
+        cls.s3 = boto3.session.Session().client(
+            's3', endpoint_url=cls.standin.endpoint_url, region_name='us-east-1',
+            aws_access_key_id='test', aws_secret_access_key='test')
+        for patcher in (mock.patch.object(clients, '_s3_client', cls.s3),
+                        mock.patch.dict(os.environ, {'AWS_STORAGE_BUCKET_NAME': BUCKET})):
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        overridden = override_settings(GOOGLE_TOKENINFO_URL=cls.tokeninfo.url, GOOGLE_OAUTH2_CLIENT_ID=CLIENT_ID)
+        overridden.enable()
+        cls.addClassCleanup(overridden.disable)
+
+    def setUp(self):
+        self.standin.buckets.clear()
+        self.standin.reset_calls()
+        for cache in caches.all():
+            cache.clear()
+        self.client.defaults['HTTP_AUTHORIZATION'] = TOKEN
+
+    def put(self, key, data=b'x', **kwargs):
+        return self.standin.put_object(BUCKET, key, data, **kwargs)
+
+
+@override_settings(DEDUP_ENABLED=True, DEDUP_MIN_BYTES=1)
+class DedupTests(StandInTestCase):
+    def store(self, key, data):
+        return dedup.store_file(self.s3, BUCKET, key, SimpleUploadedFile(key, data))
+
+    def test_identical_upload_is_copied(self):
+        etag, deduplicated = self.store('a/one.bin', b'same bytes')
+        self.assertEqual((etag, deduplicated), (self.standin.bucket(BUCKET).objects['a/one.bin'].etag, False))
+        self.assertEqual(ContentBlob.objects.get().etag, etag)
+
+        self.assertEqual(self.store('b/two.bin', b'same bytes'), (etag, True))
+        self.assertEqual(self.standin.calls.get('CopyObject'), 1)
+        self.assertEqual(self.standin.bucket(BUCKET).objects['b/two.bin'].data, b'same bytes')
+        self.assertEqual(ContentBlob.objects.get().hits, 1)
+
+    def test_copy_is_conditional_on_the_recorded_etag(self):
+        self.store('a/one.bin', b'same bytes')
+        self.put('a/one.bin', b'overwritten')
+
+        etag, deduplicated = self.store('b/two.bin', b'same bytes')
+        self.assertFalse(deduplicated)
+        self.assertEqual(self.standin.bucket(BUCKET).objects['b/two.bin'].data, b'same bytes')
+        blob = ContentBlob.objects.get()
+        self.assertEqual((blob.key, blob.etag, blob.hits), ('b/two.bin', etag, 0))
+
+    def test_deleted_source_falls_back_to_upload(self):
+        self.store('a/one.bin', b'same bytes')
+        self.standin.bucket(BUCKET).delete('a/one.bin')
+
+        self.assertFalse(self.store('b/two.bin', b'same bytes')[1])
+        self.assertEqual(ContentBlob.objects.get().key, 'b/two.bin')
+
+    def test_small_files_are_not_hashed(self):
+        with override_settings(DEDUP_MIN_BYTES=1024):
+            self.store('a/one.bin', b'tiny')
+            self.assertEqual(self.store('b/two.bin', b'tiny'), (mock.ANY, False))
+        self.assertFalse(ContentBlob.objects.exists())
+
+    def test_forget_overwritten_keeps_matching_etags(self):
+        etag, _ = self.store('a/one.bin', b'same bytes')
+        dedup.forget_overwritten([('a/one.bin', f'"{etag}"')])
+        self.assertEqual(ContentBlob.objects.get().key, 'a/one.bin')
+        dedup.forget_overwritten([('a/one.bin', 'other')])
+        self.assertEqual(ContentBlob.objects.get().key, '')
+
+    def test_forget_prefix_is_case_sensitive(self):
+        self.store('Photos/a.bin', b'first')
+        self.store('photos/b.bin', b'second')
+        dedup.forget_prefix('Photos/')
+        self.assertEqual(sorted(ContentBlob.objects.values_list('key', flat=True)), ['', 'photos/b.bin'])
+
+
+class PaginationTests(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.put('p/')
+        for name in 'abcde':
+            self.put(f'p/{name}.txt')
+        self.put('p/sub/inner.txt')
+        self.put('q/other.txt')
+
+    def test_list_page_fills_limit_past_the_folder_marker(self):
+        files, children, token = folder_stats.list_page(self.s3, BUCKET, 'p/', 2)
+        self.assertEqual([obj['Key'] for obj in files], ['p/a.txt', 'p/b.txt'])
+        self.assertEqual(children, [])
+        self.assertIsNotNone(token)
+
+    def test_key_count_estimate_is_case_sensitive(self):
+        for key in ('Photos/a.jpg', 'Photos/b.jpg', 'photos/c.jpg'):
+            key_index.record_object(key)
+        key_index.mark_synced(datetime.now(timezone.utc))
+        self.assertEqual(folder_stats.estimate_key_count('Photos/'), 2)
+
+    def test_list_page_walks_every_entry_once(self):
+        entries, token = [], None
+        while True:
+            files, children, token = folder_stats.list_page(self.s3, BUCKET, 'p/', 2, token)
+            self.assertLessEqual(len(files) + len(children), 2)
+            entries += [obj['Key'] for obj in files] + children
+            if not token:
+                break
+        self.assertEqual(entries, [f'p/{name}.txt' for name in 'abcde'] + ['p/sub/'])
+
+    def test_view_follows_cursors(self):
+        files, folders, cursor = [], [], None
+        while True:
+            response = self.client.get('/list-files/p/', {'limit': 4, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            payload = response.json()
+            files += [item['Key'] for item in payload['files']]
+            folders += [item['folderName'] for item in payload['folders']]
+            cursor = payload['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(sorted(files), [f'p/{name}.txt' for name in 'abcde'])
+        self.assertEqual(folders, ['p/sub/'])
+
+    def test_cursor_is_bound_to_its_folder(self):
+        cursor = self.client.get('/list-files/p/', {'limit': 2}).json()['next_cursor']
+        response = self.client.get('/list-files/q/', {'limit': 2, 'cursor': cursor})
+        self.assertEqual(response.status_code, 400)
+        with self.assertRaises(pagination.InvalidPageRequest):
+            pagination.decode_cursor('not a cursor', 'p/', 'name')
+
+    def test_limit_is_validated(self):
+        for limit in ('0', str(pagination.MAX_PAGE_SIZE + 1), 'ten'):
+            self.assertEqual(self.client.get('/list-files/p/', {'limit': limit}).status_code, 400)
+
+
+class S3EventTests(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.standin.events = self.queue = LocalQueue()
+        self.addCleanup(setattr, self.standin, 'events', None)
+
+    def event(self, action, key, sequencer, size=1):
+        return s3_events.S3Event(action, BUCKET, key, size=size, etag='e', sequencer=sequencer)
+
+    def indexed(self):
+        return dict(S3Object.objects.values_list('key', 'size'))
+
+    def test_consumer_applies_writes_and_deletes_messages(self):
+        self.s3.put_object(Bucket=BUCKET, Key='a/x.txt', Body=b'xx')
+        self.s3.put_object(Bucket=BUCKET, Key='a/y z.txt', Body=b'y')
+        self.s3.delete_object(Bucket=BUCKET, Key='a/y z.txt')
+        s3_events.Consumer(self.queue, BUCKET, self.s3, wait_seconds=0).run(until_empty=True)
+        self.assertEqual(self.indexed(), {'a/x.txt': 2})
+        self.assertTrue(RemovedKey.objects.filter(key='a/y z.txt').exists())
+        self.assertEqual(len(self.queue), 0)
+
+    def test_late_events_do_not_undo_newer_ones(self):
+        s3_events.apply([self.event(s3_events.REMOVED, 'a/x.txt', '0B')], BUCKET)
+        counts = s3_events.apply([self.event(s3_events.CREATED, 'a/x.txt', '0A')], BUCKET)
+        self.assertEqual(counts['stale'], 1)
+        self.assertEqual(self.indexed(), {})
+
+    def test_highest_sequencer_in_a_batch_wins(self):
+        # Sequencers differ in length, so they must compare as numbers, not strings
+        counts = s3_events.apply([self.event(s3_events.CREATED, 'a/x.txt', '100', size=3),
+                                  self.event(s3_events.CREATED, 'a/x.txt', 'FF', size=2)], BUCKET)
+        self.assertEqual((counts['applied'], counts['stale']), (1, 1))
+        self.assertEqual(self.indexed(), {'a/x.txt': 3})
+
+    def test_other_buckets_and_derivatives_are_ignored(self):
+        other = s3_events.S3Event(s3_events.CREATED, 'other', 'a/x.txt', sequencer='01')
+        derived = self.event(s3_events.CREATED, f'{settings.DERIVED_PREFIX}a/x.png/e/128.webp', '01')
+        self.assertEqual(s3_events.apply([other, derived], BUCKET)['ignored'], 2)
+        self.assertEqual(self.indexed(), {})
+
+    def test_malformed_sequencer_is_dropped_not_retried(self):
+        record = {'eventName': 'ObjectCreated:Put', 's3': {'bucket': {'name': BUCKET}, 'object': {'key': 'a/x.txt'}}}
+        bad = json.loads(json.dumps(record))
+        bad['s3']['object'].update(key='a/bad.txt', sequencer='not-hex')
+        self.queue.send(json.dumps({'Records': [bad, record]}))
+        with self.assertLogs('mainApp.s3_events', 'ERROR'):
+            s3_events.Consumer(self.queue, BUCKET, wait_seconds=0).poll()
+        self.assertEqual(list(self.indexed()), ['a/x.txt'])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_unreadable_message_stays_on_the_queue(self):
+        self.queue.send('not json')
+        with self.assertLogs('mainApp.s3_events', 'ERROR'):
+            s3_events.Consumer(self.queue, BUCKET, wait_seconds=0).poll()
+        self.queue.expire()
+        self.assertEqual(len(self.queue), 1)
+
+    def test_reconcile_matches_the_listing(self):
+        keys = ['a/B.txt', 'a/_x.txt', 'a/a.txt', 'a/\u00e9.txt', 'a/sub/', 'b/kept.txt']
+        for key in keys:
+            self.put(key, b'data')
+        long_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+        key_index.record_object('a/a.txt', size=1, etag='old', last_modified=long_ago)
+        key_index.record_object('a/gone.txt', size=1, last_modified=long_ago)
+        key_index.record_object('b/gone.txt', size=1, last_modified=long_ago)
+
+        counts = s3_events.reconcile(self.s3, BUCKET, 'a/')
+        self.assertEqual((counts['listed'], counts['added'], counts['updated'], counts['removed']), (5, 4, 1, 1))
+        self.assertEqual(sorted(self.indexed()), sorted(key for key in keys if key.startswith('a/')) + ['b/gone.txt'])
+        self.assertEqual(S3Object.objects.get(key='a/a.txt').etag, self.standin.bucket(BUCKET).objects['a/a.txt'].etag)
+
+    def test_reconcile_leaves_other_cases_of_the_prefix_alone(self):
+        self.put('Photos/a.jpg')
+        key_index.record_object('photos/b.jpg', last_modified=datetime.now(timezone.utc) - timedelta(hours=1))
+        self.assertEqual(s3_events.reconcile(self.s3, BUCKET, 'Photos/')['removed'], 0)
+        self.assertEqual(sorted(self.indexed()), ['Photos/a.jpg', 'photos/b.jpg'])
+
+    def test_reconcile_keeps_writes_newer_than_the_listing(self):
+        key_index.record_object('a/new.txt', size=1, last_modified=datetime.now(timezone.utc) + timedelta(minutes=1))
+        self.assertEqual(s3_events.reconcile(self.s3, BUCKET, 'a/')['removed'], 0)
+        self.assertIn('a/new.txt', self.indexed())
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.factory = RequestFactory()
+        self.calls = 0
+        self.version = 'v1'
+        self.status = 200
+        self.release = threading.Event()
+        self.release.set()
+
+    def view(self, request):
+        self.calls += 1
+        self.release.wait(5)
+        return HttpResponse(f'body {self.calls}', status=self.status)
+
+    def coalesced(self):
+        return singleflight.coalesce(lambda request: (self.version, None))(self.view)
+
+    def concurrently(self, view, count=4, request=None):
+        """Call ``view`` from ``count`` threads while the first call is held inside it."""
+        self.release.clear()
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(view(request or self.factory.get('/v/'))))
+                   for _ in range(count)]
+        threads[0].start()
+        while not self.calls:
+            threading.Event().wait(0.01)
+        for thread in threads[1:]:
+            thread.start()
+        # Let the waiters reach the flight before the leader finishes
+        threading.Event().wait(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return responses
+
+    def test_concurrent_gets_share_one_response(self):
+        responses = self.concurrently(self.coalesced())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual({response.content for response in responses}, {b'body 1'})
+        self.assertEqual(len({id(response) for response in responses}), 4)
+
+    def test_failures_are_not_shared(self):
+        self.status = 503
+        responses = self.concurrently(self.coalesced())
+        self.assertEqual(self.calls, 4)
+        self.assertEqual({response.status_code for response in responses}, {503})
+
+    def test_only_gets_are_coalesced(self):
+        self.concurrently(self.coalesced(), request=self.factory.post('/v/'))
+        self.assertEqual(self.calls, 4)
+
+    @override_settings(SINGLE_FLIGHT_CACHE_ALIAS='default')
+    def test_shared_cache_result_is_keyed_by_version(self):
+        view = self.coalesced()
+        request = self.factory.get('/v/', {'q': 'x'})
+        self.assertEqual(view(request).content, b'body 1')
+        self.assertEqual(view(request).content, b'body 1')
+        self.assertEqual(self.calls, 1)
+        self.version = 'v2'
+        self.assertEqual(view(request).content, b'body 2')
+        self.assertEqual(view(self.factory.get('/v/', {'q': 'y'})).content, b'body 3')
+
+    def test_async_views_share_one_response(self):
+        calls = []
+
+        async def view(request):
+            calls.append(request)
+            await asyncio.sleep(0.05)
+            return HttpResponse('async body')
+
+        coalesced = singleflight.coalesce(lambda request: (self.version, None))(view)
+
+        async def main():
+            return await asyncio.gather(*(coalesced(self.factory.get('/v/')) for _ in range(4)))
+
+        responses = asyncio.run(main())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({response.content for response in responses}, {b'async body'})
+
+
+class ZipDownloadTests(StandInTestCase):
+    def archive(self, folder):
+        response = self.client.get(f'/download-folder/{folder}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        return archive
+
+    def test_folder_archive(self):
+        self.put('trip/')
+        self.put('trip/notes.txt', b'notes ' * 100)
+        self.put('trip/photo.jpg', b'\xff\xd8 jpeg bytes')
+        self.put('trip/day 2/caf\u00e9.txt', b'coffee')
+        self.put('trip/empty/')
+        self.put('trip/../escape.txt', b'contained')
+        self.put(f'{settings.DERIVED_PREFIX}trip/photo.jpg/e/128.webp', b'thumb')
+        self.put('trips/other.txt', b'not in the folder')
+
+        archive = self.archive('trip')
+        self.assertEqual(sorted(archive.namelist()), [
+            'trip/', 'trip/day 2/caf\u00e9.txt', 'trip/empty/', 'trip/escape.txt', 'trip/notes.txt', 'trip/photo.jpg'])
+        self.assertEqual(archive.read('trip/notes.txt'), b'notes ' * 100)
+        self.assertEqual(archive.read('trip/day 2/caf\u00e9.txt'), b'coffee')
+        self.assertEqual(archive.getinfo('trip/notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo('trip/photo.jpg').compress_type, zipfile.ZIP_STORED)
+
+    @override_settings(ZIP_DOWNLOAD_BUFFER_BYTES=4, ZIP_DOWNLOAD_PREFETCH=1)
+    def test_streamed_bodies(self):
+        contents = {f'big/{n}.bin': os.urandom(200 * 1024) for n in range(3)}
+        for key, data in contents.items():
+            self.put(key, data)
+        archive = self.archive('big')
+        self.assertEqual({name: archive.read(name) for name in archive.namelist()}, contents)
+
+    def test_empty_folder_is_not_found(self):
+        self.assertEqual(self.client.get('/download-folder/nothing/').status_code, 404)
+
+    def test_read_error_resumes_at_the_same_version(self):
+        data = os.urandom(3 * zip_download.READ_SIZE)
+        self.put('a/file.bin', data)
+        response = self.s3.get_object(Bucket=BUCKET, Key='a/file.bin')
+        body = response['Body']
+        reads = []
+
+        def read(amount):
+            reads.append(amount)
+            if len(reads) == 2:
+                raise ReadTimeoutError(endpoint_url=self.standin.endpoint_url)
+            return body.read(amount)
+
+        response['Body'] = mock.Mock(read=read, close=body.close)
+        with self.assertLogs('mainApp.zip_download', 'ERROR'):
+            chunks = list(zip_download.body_chunks(self.s3, BUCKET, 'a/file.bin', response))
+        self.assertEqual(b''.join(chunks), data)
+
+    def test_zip64_entries(self):
+        writer = zip_download.ZipWriter()
+        chunks = list(writer.entry('big.bin', [b'abc'], size=zip_download.ZIP64_LIMIT))
+        for n in range(zip_download.ZIP_COUNT_LIMIT):
+            chunks.extend(writer.entry(f'dir{n}/'))
+        chunks.extend(writer.finish())
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        self.assertEqual(len(archive.infolist()), zip_download.ZIP_COUNT_LIMIT + 1)
+        self.assertEqual(archive.read('big.bin'), b'abc')
+
+
+class KeyIndexTests(StandInTestCase):
+    def indexed(self):
+        return sorted(S3Object.objects.values_list('key', flat=True))
+
+    def test_remove_prefix_is_case_sensitive(self):
+        for key in ('Photos/a.jpg', 'photos/b.jpg', 'Photos0.jpg'):
+            key_index.record_object(key)
+        key_index.remove_prefix('Photos/')
+        self.assertEqual(self.indexed(), ['Photos0.jpg', 'photos/b.jpg'])
+
+    def test_rebuild_prefix_is_case_sensitive(self):
+        key_index.record_object('photos/b.jpg')
+        key_index.record_object('Photos/stale.jpg')
+        self.put('Photos/a.jpg')
+        self.assertEqual(key_index.rebuild(self.s3, BUCKET, 'Photos/'), 1)
+        self.assertEqual(self.indexed(), ['Photos/a.jpg', 'photos/b.jpg'])
+
+
+class NgramIndexTests(SimpleTestCase):
+    KEYS = ['ab/', 'ab/cd.txt', 'x/Y.png', 'x/abc/', 'a', 'zz/b.jpg']
+
+    def index(self):
+        index = ngram_index.NgramIndex()
+        for key in self.KEYS:
+            index.add(key)
+        return index
+
+    def found(self, index, query):
+        result = index.search(query)
+        return sorted(result['files'] + result['folders'])
+
+    def test_short_queries_match_what_a_scan_would(self):
+        index = self.index()
+        expected = {
+            # ab/cd.txt matches too, but is inside the matching folder ab/
+            'a': ['a', 'ab/', 'x/abc/'],
+            'ab': ['ab/', 'x/abc/'],
+            'y': ['x/Y.png'],
+            'd.': ['ab/cd.txt'],
+            '/': ['ab/cd.txt', 'x/Y.png', 'zz/b.jpg'],
+            'q': [],
+        }
+        for query, keys in expected.items():
+            with self.subTest(query=query):
+                self.assertEqual(self.found(index, query), keys)
+
+    def test_snapshot_is_json_and_round_trips(self):
+        index = self.index()
+        index.remove('zz/b.jpg')
+        index.generation = 7
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.json')
+            index.save(path)
+            with open(path, encoding='utf-8') as fh:
+                self.assertEqual(json.load(fh)['version'], ngram_index.SNAPSHOT_VERSION)
+            loaded = ngram_index.NgramIndex.load(path)
+        self.assertEqual((loaded.generation, len(loaded)), (7, 5))
+        for query in ('a', 'ab', 'abc', 'png', 'b.jpg'):
+            self.assertEqual(loaded.search(query), index.search(query))
+
+    def test_pickled_snapshot_is_refused(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.pickle')
+            with open(path, 'wb') as fh:
+                pickle.dump({'version': ngram_index.SNAPSHOT_VERSION}, fh)
+            with self.assertRaises(ValueError):
+                ngram_index.NgramIndex.load(path)
+
+
+def derivative_key(source_key):
+    return f'{thumbnails.derived_prefix(source_key)}e/128.webp'
+
+
+def derivative(source_key):
+    return ImageDerivative.objects.create(source_key=source_key, etag='e', size=128, format='WEBP', width=1,
+                                          height=1, bytes=1, key=derivative_key(source_key))
+
+
+class FolderMoveTests(StandInTestCase):
+
+    def test_derivative_records_move_with_the_exact_prefix(self):
+        derivative('Photos/a.jpg')
+        derivative('photos/b.jpg')
+        folder_move._move_derivative_records('Photos/', 'Album/')
+        self.assertEqual(sorted(ImageDerivative.objects.values_list('source_key', 'key')), [
+            ('Album/a.jpg', derivative_key('Album/a.jpg')),
+            ('photos/b.jpg', derivative_key('photos/b.jpg')),
+        ])
+
+    def test_reported_errors_are_capped_but_counted(self):
+        report = folder_move.MoveReport()
+        errors = [{'Key': f'k{n}', 'Code': 'AccessDenied', 'Message': ''} for n in range(150)]
+        report.add_errors(errors[:60])
+        report.add_errors(errors[60:])
+        self.assertEqual(len(report.errors), folder_move.MAX_REPORTED_ERRORS)
+        self.assertEqual(report.as_dict()['error_count'], 150)
+        resumed = folder_move.MoveReport(0, report.errors, report.error_count)
+        resumed.add_errors(errors[:1])
+        self.assertEqual((len(resumed.errors), resumed.error_count), (folder_move.MAX_REPORTED_ERRORS, 151))
+
+    def test_interrupted_move_resumes_from_its_checkpoint(self):
+        keys = [f'src/{n}.txt' for n in range(5)]
+        for key in keys:
+            self.put(key, key.encode())
+            key_index.record_object(key)
+        saved = []
+
+        def save_then_stop(state):
+            saved.append(json.loads(json.dumps(state)))
+            raise RuntimeError('worker stopped')
+
+        with mock.patch.object(folder_move, 'BATCH_SIZE', 2):
+            with self.assertRaises(RuntimeError):
+                folder_move.move_folder(self.s3, BUCKET, 'src/', 'dst/', save=save_then_stop)
+            self.assertEqual(saved, [{'phase': 'objects', 'after': 'src/1.txt', 'moved': 2, 'errors': [], 'error_count': 0}])
+            report = folder_move.move_folder(self.s3, BUCKET, 'src/', 'dst/', checkpoint=saved[-1])
+
+        self.assertEqual((report.moved, report.error_count), (5, 0))
+        self.assertEqual(self.standin.calls.get('CopyObject'), 5)
+        self.assertEqual(self.standin.bucket(BUCKET).keys, [f'dst/{n}.txt' for n in range(5)])
+        self.assertEqual(self.s3.get_object(Bucket=BUCKET, Key='dst/3.txt')['Body'].read(), b'src/3.txt')
+        self.assertEqual(sorted(S3Object.objects.values_list('key', flat=True)), [f'dst/{n}.txt' for n in range(5)])
+
+    @override_settings(S3_COPY_MULTIPART_THRESHOLD=10, S3_COPY_PART_SIZE=4)
+    def test_large_objects_are_copied_in_parts(self):
+        self.put('src/big.txt', b'0123456789', metadata={'createdat': '2024-01-01'}, content_type='text/plain')
+        report = folder_move.move_folder(self.s3, BUCKET, 'src/', 'dst/')
+        self.assertEqual((report.moved, report.error_count), (1, 0))
+        self.assertEqual((self.standin.calls.get('UploadPartCopy'), self.standin.calls.get('CopyObject')), (3, None))
+        moved = self.s3.get_object(Bucket=BUCKET, Key='dst/big.txt')
+        self.assertEqual((moved['Body'].read(), moved['ContentType'], moved['Metadata']),
+                         (b'0123456789', 'text/plain', {'createdat': '2024-01-01'}))
+        self.assertEqual(self.standin.bucket(BUCKET).keys, ['dst/big.txt'])
+
+    @override_settings(S3_COPY_MULTIPART_THRESHOLD=10, S3_COPY_PART_SIZE=4)
+    def test_failed_part_copy_aborts_and_keeps_the_source(self):
+        self.put('src/big.txt', b'0123456789')
+        upload_part_copy = self.s3.upload_part_copy
+
+        def failing(**params):
+            if params['PartNumber'] == 2:
+                raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'changed'}}, 'UploadPartCopy')
+            return upload_part_copy(**params)
+
+        with mock.patch.object(self.s3, 'upload_part_copy', side_effect=failing):
+            report = folder_move.move_folder(self.s3, BUCKET, 'src/', 'dst/')
+        self.assertEqual((report.moved, [error['Code'] for error in report.errors]), (0, ['PreconditionFailed']))
+        self.assertEqual(self.standin.calls.get('AbortMultipartUpload'), 1)
+        self.assertEqual((self.standin.bucket(BUCKET).keys, self.standin.bucket(BUCKET).uploads), (['src/big.txt'], {}))
+
+
+class ImageMetadataTests(StandInTestCase):
+    def metadata(self, key, **fields):
+        values = {'format': 'JPEG', 'width': 100, 'height': 100, 'size': 1000}
+        values.update(fields)
+        return ImageMetadata.objects.create(key=key, parent=key_index.split_key(key)[0], **values)
+
+    def test_forget_prefix_is_case_sensitive(self):
+        self.metadata('Photos/a.jpg')
+        self.metadata('photos/b.jpg')
+        image_metadata.forget_prefix('Photos/')
+        self.assertEqual(list(ImageMetadata.objects.values_list('key', flat=True)), ['photos/b.jpg'])
+
+    def search(self, **params):
+        response = self.client.get('/api/search/', params)
+        return response.status_code, response.json()
+
+    def setup_library(self):
+        self.metadata('p/wide.jpg', width=4000, height=3000, taken_at=datetime(2024, 5, 1, tzinfo=timezone.utc))
+        self.metadata('p/tall.jpg', width=1000, height=3000, taken_at=datetime(2023, 1, 1, tzinfo=timezone.utc))
+        self.metadata('p/wide.png', format='PNG', width=5000, height=1000)
+        self.metadata('q/wide.jpg', width=3000, height=2000, size=5000)
+
+    def test_filters_combine_and_format_aliases_match(self):
+        self.setup_library()
+        status, result = self.search(min_width=2000, format='jpg')
+        self.assertEqual(status, 200)
+        self.assertEqual(result['files'], ['p/wide.jpg', 'q/wide.jpg'])
+        self.assertEqual(result['images'][0]['width'], 4000)
+        self.assertEqual(self.search(min_width=2000, q='p/')[1]['files'], ['p/wide.jpg', 'p/wide.png'])
+        self.assertEqual(self.search(min_width=2000, type='.png')[1]['files'], ['p/wide.png'])
+        self.assertEqual(sum(self.standin.calls.values()), 0)
+
+    def test_taken_range_skips_images_without_a_date(self):
+        self.setup_library()
+        status, result = self.search(taken_after='2024-01-01')
+        self.assertEqual(result['files'], ['p/wide.jpg'])
+        self.assertEqual(self.search(taken_before='2024-01-01')[1]['files'], ['p/tall.jpg'])
+
+    def test_sorts_put_missing_values_last_in_either_direction(self):
+        self.setup_library()
+        self.assertEqual(self.search(sort='taken')[1]['files'], ['p/tall.jpg', 'p/wide.jpg', 'p/wide.png', 'q/wide.jpg'])
+        self.assertEqual(self.search(sort='-taken')[1]['files'], ['p/wide.jpg', 'p/tall.jpg', 'p/wide.png', 'q/wide.jpg'])
+        self.assertEqual(self.search(sort='-size', limit=1, offset=1)[1]['files'], ['p/tall.jpg'])
+
+    def test_invalid_filters_are_400s(self):
+        status, result = self.search(min_width='wide')
+        self.assertEqual((status, result['error']), (400, 'Invalid value for min_width: wide'))
+        self.assertEqual(self.search(taken_after='last week')[0], 400)
+        self.assertEqual(self.search(min_width=1, sort='color')[0], 400)
+
+
+class ThumbnailTests(StandInTestCase):
+    def test_folder_delete_keeps_other_cases_of_the_prefix(self):
+        for source_key in ('Photos/a.jpg', 'photos/b.jpg'):
+            self.put(derivative(source_key).key, b'thumb')
+        thumbnails.delete_for(self.s3, BUCKET, 'Photos/')
+        self.assertEqual(list(ImageDerivative.objects.values_list('source_key', flat=True)), ['photos/b.jpg'])
+        self.assertEqual(list(self.standin.bucket(BUCKET).keys), [derivative_key('photos/b.jpg')])
+
+
+class BulkDeleteTests(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.keys = [f'f/{name}.jpg' for name in 'abc']
+        for key in self.keys:
+            self.put(key, key.encode())
+            key_index.record_object(key)
+            ImageMetadata.objects.create(key=key, parent='f/', format='JPEG', width=1, height=1)
+            ContentBlob.objects.create(sha256=key, size=1, key=key)
+            self.put(derivative(key).key, b'thumb')
+
+    def remembered(self):
+        return {
+            'index': sorted(S3Object.objects.values_list('key', flat=True)),
+            'metadata': sorted(ImageMetadata.objects.values_list('key', flat=True)),
+            'blobs': sorted(ContentBlob.objects.exclude(key='').values_list('key', flat=True)),
+            'derivatives': sorted(ImageDerivative.objects.values_list('source_key', flat=True)),
+        }
+
+    def refuse(self, *refused):
+        """Make DeleteObjects fail with AccessDenied for ``refused`` and delete the rest."""
+        delete_objects = self.s3.delete_objects
+
+        def partial(**params):
+            objects = params['Delete']['Objects']
+            allowed = [obj for obj in objects if obj['Key'] not in refused]
+            if allowed:
+                delete_objects(**dict(params, Delete=dict(params['Delete'], Objects=allowed)))
+            return {'Errors': [{'Key': obj['Key'], 'Code': 'AccessDenied', 'Message': 'Access Denied'}
+                               for obj in objects if obj['Key'] in refused]}
+        patcher = mock.patch.object(self.s3, 'delete_objects', side_effect=partial)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_keys_keep_their_records(self):
+        self.refuse('f/b.jpg')
+        report = bulk_delete.delete_folder(self.s3, BUCKET, 'f/')
+        self.assertEqual((report.deleted, [error['Key'] for error in report.errors]), (2, ['f/b.jpg']))
+        self.assertEqual(self.remembered(), {name: ['f/b.jpg'] for name in ('index', 'metadata', 'blobs', 'derivatives')})
+        self.assertIn(derivative_key('f/b.jpg'), self.standin.bucket(BUCKET).keys)
+
+    @override_settings(S3_DELETE_CONCURRENCY=1)
+    def test_cancelled_delete_forgets_what_it_deleted(self):
+        def progress(report):
+            raise RuntimeError('cancelled')
+
+        with mock.patch.object(bulk_delete, 'BATCH_SIZE', 1), self.assertRaises(RuntimeError):
+            bulk_delete.delete_folder(self.s3, BUCKET, 'f/', progress=progress)
+        remaining = sorted(key for key in self.standin.bucket(BUCKET).keys if key.startswith('f/'))
+        self.assertNotEqual(remaining, self.keys)
+        self.assertEqual(self.remembered(), {name: remaining for name in ('index', 'metadata', 'blobs', 'derivatives')})
+
+
+class AsyncViewTests(StandInTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        overridden = override_settings(AWS_S3_ENDPOINT_URL=cls.standin.endpoint_url, AWS_S3_REGION_NAME='us-east-1',
+                                       AWS_ACCESS_KEY_ID='test', AWS_SECRET_ACCESS_KEY='test')
+        overridden.enable()
+        cls.addClassCleanup(overridden.disable)
+
+    async def request(self, method, path):
+        """The response, with a streamed body read into ``body``; the loop's S3 client is closed after."""
+        try:
+            # Django 4.2's AsyncClient ignores default headers
+            response = await getattr(self.async_client, method)(path, headers={'Authorization': TOKEN})
+            if response.streaming:
+                response.body = b''.join([chunk async for chunk in response.streaming_content])
+            return response
+        finally:
+            await clients.close_async_s3_client()
+
+    async def test_listing_streams_from_the_loop(self):
+        self.put('trip/a.jpg')
+        self.put('trip/day1/b.jpg', b'xy')
+        response = await self.request('get', '/async/list-files/trip/?stream=ndjson')
+        items = [json.loads(line) for line in response.body.splitlines()]
+        self.assertEqual([(item['type'], item.get('Key') or item.get('folderName')) for item in items],
+                         [('file', 'trip/a.jpg'), ('folder', 'trip/day1/'), ('trailer', None)])
+        self.assertEqual(items[1]['TotalSize'], 2)
+        self.assertEqual((items[2]['file_count'], items[2]['folder_count']), (1, 1))
+
+    @override_settings(S3_DELETE_CONCURRENCY=1)
+    async def test_folder_delete_goes_page_by_page(self):
+        for key in ('f/a.jpg', 'f/b.jpg', 'f/c.jpg'):
+            self.put(key)
+            self.put(derivative_key(key), b'thumb')
+            await sync_to_async(key_index.record_object)(key)
+            await sync_to_async(derivative)(key)
+        listed_before_delete = []
+        delete_batch = async_s3.delete_batch
+
+        async def recording(s3_client, bucket_name, keys):
+            listed_before_delete.append(self.standin.calls.get('ListObjectsV2'))
+            return await delete_batch(s3_client, bucket_name, keys)
+
+        with mock.patch.object(bulk_delete, 'BATCH_SIZE', 1), mock.patch.object(async_s3, 'delete_batch', recording):
+            response = await self.request('delete', '/async/delete-folder/f/')
+        self.assertEqual(response.status_code, 200)
+        # Deleting starts while later pages are still to be listed
+        self.assertEqual(len(listed_before_delete), 3)
+        self.assertLess(listed_before_delete[0], self.standin.calls['ListObjectsV2'])
+        self.assertEqual(sorted(self.standin.bucket(BUCKET).keys), [])
+        self.assertFalse(await sync_to_async(S3Object.objects.exists)())
+        self.assertFalse(await sync_to_async(ImageDerivative.objects.exists)())
+
+
+class JobTests(TestCase):
+    def setUp(self):
+        self.run_with(lambda job: None)
+
+    def run_with(self, handler):
+        patcher = mock.patch.dict(jobs._handlers, {'test': handler})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def expire(self, job):
+        Job.objects.filter(pk=job.pk).update(
+            heartbeat_at=django_timezone.now() - timedelta(seconds=settings.JOBS_LEASE_SECONDS + 1))
+
+    def taken_over(self):
+        """A job claimed by worker 'first', whose lease then expired and went to 'second'."""
+        job, _ = jobs.enqueue('test', {})
+        [claimed] = jobs.Worker(workers=1, name='first').claim(1)
+        self.expire(job)
+        second = jobs.Worker(workers=1, name='second')
+        second.recover_expired()
+        second.claim(1)
+        return claimed
+
+    def test_progress_from_a_lost_lease_stops_the_handler(self):
+        reached = []
+
+        def handler(job):
+            jobs.update_progress(job, 1)
+            reached.append(job.pk)
+        self.run_with(handler)
+        job = self.taken_over()
+        with self.assertLogs('mainApp.jobs', 'WARNING'):
+            jobs.execute(job, 'first')
+        job.refresh_from_db()
+        self.assertEqual(reached, [])
+        self.assertEqual((job.status, job.locked_by, job.progress, job.attempts), (Job.RUNNING, 'second', 0, 2))
+
+    def test_outcome_from_a_lost_lease_is_dropped(self):
+        self.run_with(lambda job: 'done')
+        job = self.taken_over()
+        with self.assertLogs('mainApp.jobs', 'WARNING'):
+            jobs.execute(job, 'first')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by, job.result), (Job.RUNNING, 'second', None))
+
+    def test_a_job_is_claimed_once_and_only_when_due(self):
+        due, _ = jobs.enqueue('test', {'n': 1})
+        jobs.enqueue('test', {'n': 2}, run_after=django_timezone.now() + timedelta(minutes=5))
+        first, second = jobs.Worker(workers=2, name='first'), jobs.Worker(workers=2, name='second')
+        self.assertEqual([job.pk for job in first.claim(2)], [due.pk])
+        self.assertEqual(second.claim(2), [])
+        due.refresh_from_db()
+        self.assertEqual((due.status, due.locked_by, due.attempts), (Job.RUNNING, 'first', 1))
+
+    def test_expired_lease_is_retried_until_out_of_attempts(self):
+        job, _ = jobs.enqueue('test', {}, max_attempts=2)
+        worker = jobs.Worker(workers=1, name='w')
+        for status in (Job.QUEUED, Job.FAILED):
+            worker.claim(1)
+            self.expire(job)
+            worker.recover_expired()
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.locked_by), (status, ''))
+        self.assertEqual(job.error, 'Worker lost')
+
+    @override_settings(JOBS_RETRY_BACKOFF=5)
+    def test_failures_back_off_then_fail(self):
+        def handler(job):
+            raise RuntimeError(f'attempt {job.attempts}')
+        self.run_with(handler)
+        job, _ = jobs.enqueue('test', {}, max_attempts=2)
+        worker = jobs.Worker(workers=1, name='w')
+        with self.assertLogs('mainApp.jobs', 'ERROR'):
+            jobs.execute(worker.claim(1)[0], 'w')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (Job.QUEUED, 'attempt 1'))
+        self.assertGreater(job.run_after, django_timezone.now() + timedelta(seconds=4))
+        self.assertEqual(worker.claim(1), [])
+
+        Job.objects.filter(pk=job.pk).update(run_after=django_timezone.now())
+        with self.assertLogs('mainApp.jobs', 'ERROR'):
+            jobs.execute(worker.claim(1)[0], 'w')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error, job.attempts), (Job.FAILED, 'attempt 2', 2))
+
+    def test_cancel(self):
+        queued, _ = jobs.enqueue('test', {'n': 1})
+        self.assertEqual(jobs.cancel(queued).status, Job.CANCELLED)
+
+        def handler(job):
+            jobs.cancel(Job.objects.get(pk=job.pk))
+            jobs.update_progress(job, 1)
+        self.run_with(handler)
+        running, _ = jobs.enqueue('test', {'n': 2})
+        jobs.execute(jobs.Worker(workers=1, name='w').claim(1)[0], 'w')
+        running.refresh_from_db()
+        self.assertEqual((running.status, running.error, running.locked_by), (Job.CANCELLED, 'Cancelled', ''))
+
+    def test_idempotency_key_returns_the_first_job(self):
+        job, created = jobs.enqueue('test', {'folder': 'a/'}, idempotency_key='k')
+        again, created_again = jobs.enqueue('test', {'folder': 'a/'}, idempotency_key='k')
+        self.assertEqual((again.pk, created, created_again), (job.pk, True, False))
+        with self.assertRaises(jobs.IdempotencyConflict):
+            jobs.enqueue('test', {'folder': 'b/'}, idempotency_key='k')
+        self.assertEqual(Job.objects.count(), 1)
+
+
+@override_settings(S3_UPLOAD_PART_SIZE=5 * 1024 * 1024)
+class StreamingUploadTests(StandInTestCase):
+    PART = 5 * 1024 * 1024
+
+    def upload(self, data, name='big.bin'):
+        return self.client.post('/upload-file/?folder_id=up', {'file': SimpleUploadedFile(name, data)})
+
+    def test_large_file_goes_up_in_parts(self):
+        data = bytes(range(256)) * (self.PART * 2 // 256 + 4096)
+        response = self.upload(data)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual({name: self.standin.calls.get(name) for name in
+                          ('CreateMultipartUpload', 'UploadPart', 'CompleteMultipartUpload', 'PutObject')},
+                         {'CreateMultipartUpload': 1, 'UploadPart': 3, 'CompleteMultipartUpload': 1, 'PutObject': None})
+        self.assertEqual(self.s3.get_object(Bucket=BUCKET, Key='up/big.bin')['Body'].read(), data)
+        self.assertEqual(S3Object.objects.get(key='up/big.bin').size, len(data))
+
+    def test_small_file_is_one_put(self):
+        self.assertEqual(self.upload(b'small').status_code, 200)
+        self.assertEqual((self.standin.calls.get('PutObject'), self.standin.calls.get('CreateMultipartUpload')), (1, None))
+
+    def test_existing_key_is_refused_before_anything_is_sent(self):
+        self.put('up/big.bin')
+        self.standin.reset_calls()
+        response = self.upload(b'x' * (self.PART + 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(self.standin.calls), {'ListObjectsV2'})
+
+    def test_failed_part_aborts_the_upload(self):
+        upload_part = self.s3.upload_part
+
+        def failing(**params):
+            if params['PartNumber'] == 2:
+                raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'UploadPart')
+            return upload_part(**params)
+
+        with mock.patch.object(self.s3, 'upload_part', side_effect=failing), self.assertLogs('mainApp.views', 'ERROR'):
+            response = self.upload(b'x' * (self.PART * 3))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.standin.calls.get('AbortMultipartUpload'), 1)
+        self.assertIsNone(self.standin.calls.get('CompleteMultipartUpload'))
+        self.assertEqual((self.standin.bucket(BUCKET).keys, self.standin.bucket(BUCKET).uploads), ([], {}))
+        self.assertFalse(S3Object.objects.exists())
+
+    def test_interrupted_body_aborts_the_upload(self):
+        handler = S3MultipartUploadHandler(RequestFactory().post('/'), self.s3, BUCKET, 'up')
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file('file', 'big.bin', 'binary/octet-stream', None)
+        handler.receive_data_chunk(b'x' * (self.PART + 1), 0)
+        handler.upload_interrupted()
+        self.assertEqual(self.standin.calls.get('AbortMultipartUpload'), 1)
+        self.assertEqual(self.standin.bucket(BUCKET).uploads, {})
+
+
+@override_settings(S3_UPLOAD_PART_SIZE=5 * 1024 * 1024)
+class DirectUploadTests(StandInTestCase):
+    def presign(self, name, size=1):
+        response = self.client.post('/api/uploads/presign/', {'folder_id': 'up', 'file_name': name, 'size': size})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def complete(self, **body):
+        return self.client.post('/api/uploads/complete/', json.dumps(body), content_type='application/json')
+
+    def test_presigned_put_completes_with_its_token(self):
+        upload = self.presign('a.txt')
+        self.assertEqual(requests.put(upload['url'], data=b'hello').status_code, 200)
+        response = self.complete(key=upload['key'], upload_token=upload['upload_token'], folder_id='up')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(S3Object.objects.get(key='up/a.txt').size, 5)
+
+    def test_multipart_completes_with_its_token(self):
+        upload = self.presign('b.bin', size=6 * 1024 * 1024)
+        self.assertEqual(upload['method'], 'multipart')
+        parts = [{'PartNumber': part['PartNumber'], 'ETag': requests.put(part['url'], data=data).headers['ETag']}
+                 for part, data in zip(upload['parts'], (b'first-', b'second'))]
+        response = self.complete(key=upload['key'], upload_id=upload['upload_id'],
+                                 upload_token=upload['upload_token'], parts=parts)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.s3.get_object(Bucket=BUCKET, Key='up/b.bin')['Body'].read(), b'first-second')
+
+    def test_tampered_or_foreign_tokens_are_refused(self):
+        upload = self.presign('a.txt')
+        other = self.presign('other.txt')
+        requests.put(upload['url'], data=b'hello')
+        token = upload['upload_token']
+        tampered = token[:-1] + ('A' if token[-1] != 'A' else 'B')
+        for body in ({'key': 'up/a.txt', 'upload_token': tampered},
+                     {'key': 'up/a.txt', 'upload_token': other['upload_token']},
+                     {'key': 'up/a.txt'},
+                     {'key': 'up/a.txt', 'upload_token': token, 'upload_id': 'someone-elses-upload'},
+                     {'key': 'up/a.txt', 'upload_token': token, 'folder_id': 'elsewhere'}):
+            response = self.complete(**body)
+            self.assertEqual(response.status_code, 400, body)
+        self.assertEqual(self.standin.calls.get('CompleteMultipartUpload'), None)
+        self.assertFalse(S3Object.objects.exists())
+
+    def test_token_expires_after_the_grace_period(self):
+        token = direct_uploads.upload_token('up/a.txt')
+        later = time.time() + settings.S3_PRESIGNED_URL_EXPIRY + direct_uploads.COMPLETE_GRACE + 60
+        with mock.patch('django.core.signing.time.time', return_value=later), \
+                self.assertRaises(direct_uploads.InvalidUpload):
+            direct_uploads.check_token(token, 'up/a.txt')
+
+
+class BatchUploadTests(StandInTestCase):
+    def test_one_failure_does_not_sink_the_batch(self):
+        self.put('up/taken.txt')
+        put_object = self.s3.put_object
+
+        def failing(**params):
+            if params['Key'] == 'up/b.txt':
+                raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'PutObject')
+            return put_object(**params)
+
+        files = [SimpleUploadedFile(name, name.encode()) for name in ('a.txt', 'taken.txt', 'b.txt', 'a.txt', 'c.txt')]
+        with mock.patch.object(self.s3, 'put_object', side_effect=failing):
+            response = self.client.post('/upload-files/', {'folder_id': 'up', 'files': files})
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual([(result['key'], result['status']) for result in payload['results']],
+                         [('up/a.txt', 'uploaded'), ('up/taken.txt', 'exists'), ('up/b.txt', 'error'),
+                          ('up/a.txt', 'exists'), ('up/c.txt', 'uploaded')])
+        self.assertIn('AccessDenied', payload['results'][2]['error'])
+        self.assertEqual((payload['uploaded_count'], payload['failed_count']), (2, 3))
+        self.assertEqual(sorted(S3Object.objects.values_list('key', flat=True)), ['up/a.txt', 'up/c.txt'])
+        self.assertEqual(self.s3.get_object(Bucket=BUCKET, Key='up/taken.txt')['Body'].read(), b'x')
+
+
+@override_settings(S3_DELETE_MAX_ATTEMPTS=3, S3_DELETE_BACKOFF_BASE=0)
+class DeleteRetryTests(SimpleTestCase):
+    """bulk_delete.delete_batch and its async twin, against scripted DeleteObjects answers."""
+
+    def errors(self, **codes):
+        return {'Errors': [{'Key': key, 'Code': code, 'Message': code} for key, code in codes.items()]}
+
+    def throttled(self):
+        return ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Slow down'}}, 'DeleteObjects')
+
+    def run_both(self, keys, answers):
+        """``(deleted, errors, keys sent per attempt)`` from each implementation."""
+        outcomes = []
+        for client in (mock.Mock(), mock.AsyncMock()):
+            client.delete_objects.side_effect = list(answers)
+            if isinstance(client, mock.AsyncMock):
+                deleted, errors = asyncio.run(async_s3.delete_batch(client, BUCKET, keys))
+            else:
+                deleted, errors = bulk_delete.delete_batch(client, BUCKET, keys)
+            sent = [[obj['Key'] for obj in call.kwargs['Delete']['Objects']] for call in client.delete_objects.call_args_list]
+            outcomes.append((sorted(deleted), sorted((error['Key'], error['Code']) for error in errors), sent))
+        self.assertEqual(outcomes[0], outcomes[1])
+        return outcomes[0]
+
+    def test_only_retryable_keys_are_sent_again(self):
+        deleted, errors, sent = self.run_both(['a', 'b', 'c'], [self.errors(a='SlowDown', b='AccessDenied'), {}])
+        self.assertEqual((deleted, errors), (['a', 'c'], [('b', 'AccessDenied')]))
+        self.assertEqual(sent, [['a', 'b', 'c'], ['a']])
+
+    def test_gives_up_after_max_attempts(self):
+        deleted, errors, sent = self.run_both(['a', 'b'], [self.errors(a='InternalError')] * 3)
+        self.assertEqual((deleted, errors), (['b'], [('a', 'SlowDown')]))
+        self.assertEqual(sent, [['a', 'b'], ['a'], ['a']])
+
+    def test_throttled_request_is_retried_whole(self):
+        deleted, errors, sent = self.run_both(['a', 'b'], [self.throttled(), {}])
+        self.assertEqual((deleted, errors), (['a', 'b'], []))
+        self.assertEqual(len(sent), 2)
+
+    def test_non_retryable_request_error_fails_every_key(self):
+        denied = ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'DeleteObjects')
+        deleted, errors, sent = self.run_both(['a', 'b'], [denied])
+        self.assertEqual((deleted, errors), ([], [('a', 'AccessDenied'), ('b', 'AccessDenied')]))
+        self.assertEqual(len(sent), 1)
+
+    def test_throttling_on_the_last_attempt_fails_with_its_code(self):
+        deleted, errors, sent = self.run_both(['a'], [self.throttled()] * 3)
+        self.assertEqual((deleted, errors), ([], [('a', 'SlowDown')]))
+        self.assertEqual(len(sent), 3)
+
+
+class FairShareTests(SimpleTestCase):
+    """executors.FairShareExecutor scheduling and admission, with a fixed limit."""
+
+    def executor(self, limit):
+        executor = executors.FairShareExecutor(4, mock.Mock(value=limit), name='test')
+        self.addCleanup(executor.shutdown)
+        return executor
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_narrow_share_is_not_starved_by_a_wide_one(self):
+        executor = self.executor(2)
+        started, release = [], threading.Semaphore(0)
+
+        def wide():
+            started.append('wide')
+            release.acquire()
+
+        wide_share = executor.share()
+        wide_futures = [wide_share.submit(wide) for _ in range(4)]
+        self.wait_for(lambda: len(started) == 2)
+        narrow = executor.share().submit(started.append, 'narrow')
+        release.release()
+        narrow.result(timeout=5)
+        for _ in range(3):
+            release.release()
+        for future in wide_futures:
+            future.result(timeout=5)
+        self.assertEqual(started, ['wide', 'wide', 'narrow', 'wide', 'wide'])
+
+    def test_share_never_runs_more_than_its_max(self):
+        executor = self.executor(4)
+        lock, running, peak = threading.Lock(), [0], [0]
+
+        def task():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        executor.share(max_running=2).map(lambda _: task(), range(8))
+        self.assertEqual(peak[0], 2)
+
+    def fill(self, executor, queued):
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        share = executor.share()
+        share.submit(gate.wait)
+        self.wait_for(lambda: executor.stats()['running'] == 1)
+        for _ in range(queued):
+            share.submit(gate.wait)
+
+    @override_settings(S3_FANOUT_MAX_QUEUE=2, S3_FANOUT_MAX_QUEUE_WAIT=3600)
+    def test_admit_sheds_when_the_queue_is_full(self):
+        executor = self.executor(1)
+        self.fill(executor, 1)
+        executor.admit()
+        executor.share().submit(time.sleep, 0)
+        with self.assertRaises(executors.Overloaded) as raised:
+            executor.admit()
+        self.assertEqual(raised.exception.reason, 'queue')
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+
+    @override_settings(S3_FANOUT_MAX_QUEUE=100, S3_FANOUT_MAX_QUEUE_WAIT=0.05)
+    def test_admit_sheds_when_the_oldest_task_has_waited_too_long(self):
+        executor = self.executor(1)
+        executor.admit()
+        self.fill(executor, 1)
+        time.sleep(0.1)
+        with self.assertRaises(executors.Overloaded) as raised:
+            executor.admit()
+        self.assertEqual(raised.exception.reason, 'wait')
+
+    @override_settings(S3_CONCURRENCY_COOLDOWN=2.5)
+    def test_retry_after_covers_shedding_and_throttling_only(self):
+        self.assertEqual(executors.retry_after(executors.Overloaded('queue', 7)), 7)
+        throttled = ClientError({'Error': {'Code': 'SlowDown', 'Message': 'Slow down'}}, 'ListObjectsV2')
+        self.assertEqual(executors.retry_after(throttled), 3)
+        denied = ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'ListObjectsV2')
+        self.assertIsNone(executors.retry_after(denied))
+        self.assertIsNone(executors.retry_after(ValueError('boom')))
+
+
+class LoadSheddingTests(StandInTestCase):
+    def test_shed_listing_is_a_503_with_retry_after(self):
+        self.put('a/x.txt')
+        overloaded = executors.Overloaded('queue', 7)
+        with mock.patch.object(executors.FairShareExecutor, 'admit', side_effect=overloaded) as admit:
+            response = self.client.get('/list-folders/', {'limit': 10})
+        admit.assert_called()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertIn('Too busy', response.json()['error'])
+
+    def test_other_failures_stay_500s(self):
+        with mock.patch.object(folder_stats, 'list_page', side_effect=ValueError('boom')):
+            response = self.client.get('/list-folders/', {'limit': 10})
+        self.assertEqual(response.status_code, 500)
+        self.assertNotIn('Retry-After', response)
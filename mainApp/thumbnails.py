@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import os
+from collections import defaultdict
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from mainApp import executors, imaging, stats_cache
+from mainApp.models import ImageDerivative
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff')
+
+
+def is_derived(key):
+    return key.startswith(settings.DERIVED_PREFIX)
+
+
+def is_image(key):
+    return key.lower().endswith(IMAGE_EXTENSIONS) and not is_derived(key)
+
+
+def derived_prefix(key):
+    # Derivatives mirror the original's path, so deleting a folder's derivatives is one prefix
+    return f'{settings.DERIVED_PREFIX}{key}'
+
+
+def derived_key(key, etag, size):
+    extension = settings.THUMBNAIL_FORMAT.lower()
+    return f'{derived_prefix(key)}/{etag}/{size}.{extension}'
+
+
+def public_url(key):
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    bucket_region = os.getenv('AWS_DEFAULT_REGION')
+    return f'https://{bucket_name}.s3.{bucket_region}.amazonaws.com/{key}'
+
+
+def _normalize_etag(etag):
+    return etag.strip('"') if etag else etag
+
+
+def schedule(bucket_name, key, etag=None, size=None):
+    """Queue derivative rendering for a newly written object; never fails the caller."""
+    if not settings.THUMBNAILS_ENABLED or not is_image(key):
+        return None
+    if size is not None and size > settings.THUMBNAIL_MAX_SOURCE_BYTES:
+        return None
+    from mainApp import jobs
+
+    etag = _normalize_etag(etag)
+    idempotency_key = None
+    if etag:
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        idempotency_key = f'derivatives:{digest}:{etag}'
+    try:
+        job, _ = jobs.enqueue('render_derivatives', {'bucket': bucket_name, 'key': key, 'etag': etag},
+                              idempotency_key=idempotency_key)
+        return job
+    except Exception as e:
+        logger.error(f'Error scheduling derivatives for {key}: {str(e)}')
+        return None
+
+
+def _complete(key, etag):
+    found = ImageDerivative.objects.filter(
+        source_key=key, etag=etag, format=settings.THUMBNAIL_FORMAT, size__in=settings.THUMBNAIL_SIZES).count()
+    return found == len(set(settings.THUMBNAIL_SIZES))
+
+
+def render_for(s3_client, bucket_name, key, etag=None):
+    etag = _normalize_etag(etag)
+    if etag and _complete(key, etag):
+        return {'key': key, 'etag': etag, 'skipped': 'up to date'}
+
+    params = {'Bucket': bucket_name, 'Key': key}
+    if etag:
+        # Render the version the job was queued for; a later overwrite queues its own job
+        params['IfMatch'] = f'"{etag}"'
+    try:
+        response = s3_client.get_object(**params)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', '412'):
+            return {'key': key, 'etag': etag, 'skipped': 'superseded'}
+        raise
+    etag = _normalize_etag(response['ETag'])
+    if _complete(key, etag):
+        response['Body'].close()
+        return {'key': key, 'etag': etag, 'skipped': 'up to date'}
+    if response['ContentLength'] > settings.THUMBNAIL_MAX_SOURCE_BYTES:
+        response['Body'].close()
+        return {'key': key, 'etag': etag, 'skipped': 'too large'}
+    data = response['Body'].read()
+
+    # Decoding and resizing are CPU-bound, so they leave this thread for the process pool
+    future = executors.get_process_pool('imaging').submit(
+        imaging.render, data, settings.THUMBNAIL_SIZES, settings.THUMBNAIL_FORMAT, settings.THUMBNAIL_QUALITY)
+    try:
+        renders = future.result()
+    except ValueError as e:
+        return {'key': key, 'etag': etag, 'skipped': str(e)}
+
+    content_type = imaging.CONTENT_TYPES.get(settings.THUMBNAIL_FORMAT, 'binary/octet-stream')
+    for size, body, width, height in renders:
+        target = derived_key(key, etag, size)
+        # Keys embed the source ETag, so their content never changes
+        s3_client.put_object(Bucket=bucket_name, Key=target, Body=body, ContentType=content_type,
+                             CacheControl='public, max-age=31536000, immutable')
+        ImageDerivative.objects.update_or_create(
+            source_key=key, etag=etag, size=size, format=settings.THUMBNAIL_FORMAT,
+            defaults={'key': target, 'width': width, 'height': height, 'bytes': len(body)})
+
+    _prune(s3_client, bucket_name, key, etag)
+    # Listings carry the thumbnail URLs, so their cached copies and version tokens are stale
+    stats_cache.invalidate_key(key)
+    return {'key': key, 'etag': etag, 'derivatives': [derived_key(key, etag, size) for size, *_ in renders]}
+
+
+def _prune(s3_client, bucket_name, key, etag):
+    # Derivatives of earlier versions of the same key
+    stale = ImageDerivative.objects.filter(source_key=key).exclude(etag=etag)
+    keys = list(stale.values_list('key', flat=True))
+    if keys:
+        s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+        stale.delete()
+
+
+def delete_for(s3_client, bucket_name, key):
+    """Remove the derivatives of ``key``, or of everything under it when it is a folder."""
+    from mainApp import bulk_delete, key_index
+
+    try:
+        if key.endswith('/'):
+            bulk_delete.delete_prefix(s3_client, bucket_name, derived_prefix(key))
+            ImageDerivative.objects.filter(key_index.prefix_filter(key, 'source_key')).delete()
+        else:
+            delete_for_keys(s3_client, bucket_name, [key])
+    except Exception as e:
+        logger.error(f'Error deleting derivatives of {key}: {str(e)}')
+
+
+def delete_for_keys(s3_client, bucket_name, keys):
+    """Remove the derivatives of the files ``keys``."""
+    keys = [key for key in keys if is_image(key)]
+    for start in range(0, len(keys), 500):
+        rows = ImageDerivative.objects.filter(source_key__in=keys[start:start + 500])
+        derived = list(rows.values_list('key', flat=True))
+        for first in range(0, len(derived), 1000):
+            s3_client.delete_objects(Bucket=bucket_name, Delete={
+                'Objects': [{'Key': k} for k in derived[first:first + 1000]], 'Quiet': True})
+        rows.delete()
+
+
+def urls_for(objects):
+    """Map each listed image's key to ``{size: url}`` for derivatives of its current ETag."""
+    current = {obj['Key']: _normalize_etag(obj.get('ETag')) for obj in objects if is_image(obj['Key'])}
+    if not current or not settings.THUMBNAILS_ENABLED:
+        return {}
+    urls = defaultdict(dict)
+    keys = list(current)
+    for start in range(0, len(keys), 500):
+        rows = ImageDerivative.objects.filter(source_key__in=keys[start:start + 500], format=settings.THUMBNAIL_FORMAT)
+        for source_key, etag, size, key in rows.values_list('source_key', 'etag', 'size', 'key'):
+            if current.get(source_key) == etag:
+                urls[source_key][str(size)] = public_url(key)
+    return dict(urls)
@@ -0,0 +1,211 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import wait
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers, StopUpload
+
+from mainApp import dedup, executors, image_metadata
+
+logger = logging.getLogger(__name__)
+
+
+class S3UploadedFile(UploadedFile):
+    def __init__(self, key, name, content_type, size, etag, charset=None, content_type_extra=None,
+                 sha256=None, deduplicated=False, header=b''):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.key = key
+        self.etag = etag
+        self.sha256 = sha256
+        self.deduplicated = deduplicated
+        # The first bytes of the file, kept for images so their headers can be read
+        self.header = header
+
+
+class DuplicateKey(Exception):
+    pass
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """Hash each uploaded file's chunks as they arrive, passing them on to the next handler.
+
+    The file itself is built by a later handler, so ``attach(request.FILES)`` sets each
+    digest on its file as ``sha256`` once the body has been read.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.digests = {}
+        self._sha256 = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self._sha256 = hashlib.sha256()
+        self.digests.setdefault(field_name, []).append(self._sha256)
+
+    def receive_data_chunk(self, raw_data, start):
+        self._sha256.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+    def attach(self, files):
+        for field_name, digests in self.digests.items():
+            for file, digest in zip(files.getlist(field_name), digests):
+                file.sha256 = digest.hexdigest()
+        return files
+
+
+class S3MultipartUploadHandler(FileUploadHandler):
+    """Send the ``file`` field straight to S3 while the request body is still arriving.
+
+    Chunks are cut into parts of ``part_size`` bytes that are uploaded concurrently;
+    at most ``max_in_flight`` parts are buffered, so a slow S3 applies backpressure
+    to the client instead of growing memory. Files smaller than one part are sent
+    with a single PUT, or with a server-side copy when identical content is already
+    stored. Nothing is written to disk.
+    """
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, request, s3_client, bucket_name, folder_id, file_name=None,
+                 part_size=None, concurrency=None, max_in_flight=None):
+        super().__init__(request)
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.folder_id = folder_id
+        self.target_name = file_name
+        self.part_size = max(part_size or settings.S3_UPLOAD_PART_SIZE, 5 * 1024 * 1024)
+        self.concurrency = concurrency or settings.S3_UPLOAD_CONCURRENCY
+        self.max_in_flight = max_in_flight or settings.S3_UPLOAD_MAX_IN_FLIGHT_PARTS
+        self.key = None
+        self.error = None
+        self.upload_id = None
+        self.active = False
+        self.completed = False
+        self._buffer = bytearray()
+        self._sha256 = hashlib.sha256()
+        self._header = bytearray()
+        self._header_limit = 0
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._share = None
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        if field_name != 'file' or self.key is not None:
+            return
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.key = os.path.join(self.folder_id, self.target_name or file_name)
+        self._header_limit = settings.IMAGE_METADATA_HEADER_BYTES if image_metadata.wanted(self.key) else 0
+        existing_files = self.s3_client.list_objects_v2(Bucket=self.bucket_name, Prefix=self.key)
+        if 'Contents' in existing_files:
+            self.error = DuplicateKey(self.key)
+            raise StopUpload(connection_reset=False)
+        self.active = True
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        self._sha256.update(raw_data)
+        if len(self._header) < self._header_limit:
+            self._header += raw_data[:self._header_limit - len(self._header)]
+        self._buffer += raw_data
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit_part(part)
+        return None
+
+    def _submit_part(self, data):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, ContentType=self.content_type or 'binary/octet-stream')
+            self.upload_id = response['UploadId']
+            # Parts share the fan-out pool with listings, ``concurrency`` of them at a time
+            self._share = executors.get_fanout_executor().share(self.concurrency)
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        # Blocks the request thread (and so the client) while too many parts are in flight
+        self._slots.acquire()
+        part_number = len(self._futures) + 1
+        try:
+            self._futures.append(self._share.submit(self._upload_part, part_number, data))
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _upload_part(self, part_number, data):
+        try:
+            response = self.s3_client.upload_part(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self._slots.release()
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        sha256 = self._sha256.hexdigest()
+        deduplicated = False
+        try:
+            if self.upload_id is None:
+                # The whole file is still in memory, so a duplicate never has to leave this host
+                blob = dedup.find(sha256, file_size) if dedup.eligible(file_size) else None
+                etag = dedup.copy_blob(self.s3_client, blob, self.bucket_name, self.key,
+                                       self.content_type) if blob is not None else None
+                deduplicated = etag is not None
+                if not deduplicated:
+                    response = self.s3_client.put_object(
+                        Bucket=self.bucket_name, Key=self.key, Body=bytes(self._buffer),
+                        ContentType=self.content_type or 'binary/octet-stream', Metadata={'sha256': sha256})
+                    etag = response['ETag']
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                response = self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': parts})
+                etag = response['ETag']
+                self._shutdown()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+        self.completed = True
+        if not deduplicated and dedup.eligible(file_size):
+            dedup.record(sha256, file_size, self.key, etag)
+        return S3UploadedFile(self.key, self.file_name, self.content_type, file_size, etag.strip('"'),
+                              self.charset, self.content_type_extra, sha256=sha256, deduplicated=deduplicated,
+                              header=bytes(self._header))
+
+    def upload_interrupted(self):
+        self.abort()
+
+    def abort(self):
+        self.active = False
+        self._buffer = bytearray()
+        if self.upload_id is None or self.completed:
+            return
+        upload_id, self.upload_id = self.upload_id, None
+        for future in self._futures:
+            future.cancel()
+        self._shutdown()
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=upload_id)
+        except Exception as e:
+            logger.error(f'Error aborting multipart upload of {self.key}: {str(e)}')
+
+    def _shutdown(self):
+        if self._share is not None:
+            wait(self._futures)
+            self._share = None
@@ -1,23 +1,28 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout as django_logout
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
 from datetime import datetime, timezone, timedelta
-import boto3
+import bisect
+import json
 import os
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
 from django.views.decorators.csrf import csrf_exempt
+from django.utils.crypto import constant_time_compare
 from django.utils.dateparse import parse_datetime
 import pytz
 import logging
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
-import requests
 from django.conf import settings
-import time
-from concurrent.futures import ThreadPoolExecutor
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
+from imgUploader.token_cache import get_token_cache, verify_google_token
+from mainApp import bulk_delete, conditional, dedup, direct_uploads, executors, folder_move, image_metadata, jobs, folder_stats, key_index, metrics, ngram_index, pagination, s3_events, singleflight, stats_cache, streaming, thumbnails, zip_download
+from mainApp.clients import get_s3_client, get_transfer_config
+from mainApp.models import IndexState, Job
+from mainApp.upload_handlers import DuplicateKey, HashingUploadHandler, S3MultipartUploadHandler, S3UploadedFile
 
 
 from dotenv import load_dotenv
@@ -35,13 +40,7 @@ def google_login(request):
         return Response({'success': False, 'error': 'No token provided'}, status=400)
 
     try:
-        response = requests.get(f'https://www.googleapis.com/oauth2/v3/tokeninfo?access_token={token}')
-        
-        if response.status_code != 200:
-            logger.error(f'Invalid token: {response.json()}')
-            return Response({'success': False, 'error': f'Invalid token: {response.json()}'}, status=400)
-        
-        idinfo = response.json()
+        idinfo = verify_google_token(token)
         
         if idinfo['aud'] != settings.GOOGLE_OAUTH2_CLIENT_ID:
             logger.error(f'Unauthorized: {idinfo["aud"]}')
@@ -67,20 +66,65 @@ def google_login(request):
     
     
 
+def error_response(e):
+    # Shed by backpressure or throttled by S3: a 503 saying when to retry, not a 500
+    retry_after = executors.retry_after(e)
+    if retry_after is None:
+        return JsonResponse({'error': str(e)}, status=500)
+    response = JsonResponse({'error': str(e)}, status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+def cache_stats(request):
+    return JsonResponse({
+        'token_cache': get_token_cache().stats(),
+        'folder_stats_cache': stats_cache.stats(),
+    })
+
+def dedup_report(request):
+    return JsonResponse(dedup.report())
+
+def metrics_view(request):
+    # Exempt from Google auth so Prometheus can scrape it; METRICS_AUTH_TOKEN guards it instead
+    if not settings.METRICS_AUTH_TOKEN:
+        if not settings.METRICS_PUBLIC:
+            return HttpResponse(status=404)
+    elif not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_AUTH_TOKEN}'):
+        return HttpResponse(status=401)
+    gauges = {}
+    for prefix, values in (('token_cache', get_token_cache().stats()), ('folder_stats_cache', stats_cache.stats()),
+                           ('fanout', executors.stats())):
+        for name, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges[f'{prefix}_{name}'] = (f'{prefix} {name}'.replace('_', ' '), value)
+    return HttpResponse(metrics.expose(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@csrf_exempt
+def ingest_s3_events(request):
+    # Exempt from Google auth so a notification forwarder can post here; S3_EVENTS_AUTH_TOKEN guards it instead
+    if not settings.S3_EVENTS_AUTH_TOKEN:
+        return JsonResponse({'success': False, 'error': 'S3 event ingestion is not configured'}, status=404)
+    if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {settings.S3_EVENTS_AUTH_TOKEN}'):
+        return JsonResponse({'success': False, 'error': 'Unauthorized'}, status=401)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    try:
+        events = s3_events.parse(request.body)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': f'Invalid event payload: {str(e)}'}, status=400)
+    try:
+        counts = s3_events.apply(events, os.getenv('AWS_STORAGE_BUCKET_NAME'), get_s3_client())
+    except Exception as e:
+        # A 5xx makes the sender retry the batch; applying it twice is harmless
+        logger.error(f'Error applying S3 events: {str(e)}')
+        return JsonResponse({'success': False, 'error': 'Error applying events'}, status=503)
+    return JsonResponse({'success': True, **counts})
+
 @api_view(['GET'])
 def protected_view(request):
     user_info = request.user_info
     return Response({'success': True, 'user': user_info})
 
-def get_s3_client():
-    return boto3.client(
-        's3',
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        
-        region_name=os.getenv('AWS_DEFAULT_REGION')
-    )
-
 def parse_date(date_str):
     for fmt in ('%Y-%m-%d %H:%M:%S%z', '%Y-%m-%dT%H:%M:%S.%fZ'):
         try:
@@ -94,232 +138,331 @@ def parse_date(date_str):
 
 
 
-def process_folder(s3_client, bucket_name, prefix):
-    subdirectory_info = {
-        'folderName': prefix,
-        'FileCount': 0,
-        'FolderCount': 0,
-        'LastModified': None,
-        'CreatedAt': None 
-    }
-
+def search_result_items(result):
+    for key in result['folders']:
+        yield {'type': 'folder', 'key': key}
+    for key in result['files']:
+        yield {'type': 'file', 'key': key}
+
+class SearchScan:
+    # Keys must be fed in lexicographic order, so a folder marker is always seen
+    # before anything inside it and files can be filtered as they stream past
+    def __init__(self, query, file_type, limit=None, offset=0):
+        self.query = query.lower()
+        self.file_type = file_type.lower() if file_type else None
+        self.matched_folders = ngram_index.PrefixTrie()
+        self.skip = offset
+        self.remaining = limit
+
+    @property
+    def done(self):
+        return self.remaining is not None and self.remaining <= 0
+
+    def page(self, item):
+        # limit and offset count folders and files together, as the index's pages do
+        if item is None or self.done:
+            return None
+        if self.skip:
+            self.skip -= 1
+            return None
+        if self.remaining is not None:
+            self.remaining -= 1
+        return item
+
+    def match(self, key):
+        if self.query not in key.lower() or thumbnails.is_derived(key):
+            return None
+        if key.endswith('/'):
+            if self.query in key.strip('/').split('/')[-1].lower():
+                self.matched_folders.insert(key)
+                return {'type': 'folder', 'key': key}
+        elif (not self.file_type or key.lower().endswith(self.file_type)) and not self.matched_folders.covers(key):
+            return {'type': 'file', 'key': key}
+        return None
+
+def scan_search_items(s3_client, bucket_name, query, file_type, limit=None, offset=0):
+    scan = SearchScan(query, file_type, limit, offset)
     paginator = s3_client.get_paginator('list_objects_v2')
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=''):
         for obj in page.get('Contents', []):
-            if not obj['Key'].endswith('/'):
-                subdirectory_info['FileCount'] += 1
-                if (subdirectory_info['LastModified'] is None or
-                        obj['LastModified'] > subdirectory_info['LastModified']):
-                    subdirectory_info['LastModified'] = obj['LastModified']
-
-        for sub_prefix in page.get('CommonPrefixes', []):
-            subdirectory_info['FolderCount'] += 1
-
+            item = scan.page(scan.match(obj['Key']))
+            if item is not None:
+                yield item
+            if scan.done:
+                return
+
+def search_params(request):
+    limit = int(request.GET['limit']) if request.GET.get('limit') else None
+    offset = int(request.GET.get('offset') or 0)
+    return limit, offset
+
+def index_search(query, file_type, limit, offset):
+    if not key_index.is_ready():
+        return None
+    return ngram_index.get_index().search(query, file_type, limit=limit, offset=offset)
+
+def image_search_response(request, query, file_type, limit, offset, fmt=None):
+    # Filters and sorts on image metadata are answered from its table, without reading S3
     try:
-        head_response = s3_client.head_object(Bucket=bucket_name, Key=prefix)
-        created_at = head_response.get('Metadata', {}).get('createdat')
-        if created_at:
-            subdirectory_info['CreatedAt'] = parse_date(created_at)
-    except s3_client.exceptions.ClientError as e:
-        logger.error(f"Error fetching metadata for {prefix}: {e}")
-
-    if subdirectory_info['FileCount'] == 0 and subdirectory_info['FolderCount'] == 0:
-        subdirectory_info['LastModified'] = subdirectory_info['CreatedAt']
-
-    return subdirectory_info
+        rows = image_metadata.query(request, contains=query, suffix=file_type)
+    except image_metadata.InvalidQuery as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    rows = rows[offset:offset + limit] if limit is not None else rows[offset:]
+    if fmt:
+        return streaming.stream_response(
+            (dict(image_metadata.as_dict(row), type='file', key=row.key) for row in rows.iterator()), fmt)
+    rows = list(rows)
+    return JsonResponse({
+        'files': [row.key for row in rows],
+        'folders': [],
+        'images': [dict(image_metadata.as_dict(row), key=row.key) for row in rows],
+    })
+
+def search_version(request):
+    # Every write through our views bumps the root version; index rebuilds bump the generation
+    token, last_modified = stats_cache.version('')
+    generation, stale = IndexState.objects.filter(pk=1).values_list('generation', 'stale').first() or (0, True)
+    return f'{token}-{generation}-{int(stale)}', last_modified
+
+def listing_version(request, folder_id=None):
+    return stats_cache.version(folder_id.rstrip('/') + '/' if folder_id else '')
 
 
 @csrf_exempt
+@conditional.versioned(search_version)
+@singleflight.coalesce(search_version)
 def search(request):
     if request.method == 'GET':
         query = request.GET.get('q', '')
         file_type = request.GET.get('type', None) 
+        images = image_metadata.requested(request)
 
-        if not query:
+        if not query and not images:
             return JsonResponse({'error': 'Query parameter is required'}, status=400)
 
+        try:
+            limit, offset = search_params(request)
+        except ValueError:
+            return JsonResponse({'error': 'limit and offset must be integers'}, status=400)
+
+        fmt = streaming.stream_format(request)
+        if images:
+            return image_search_response(request, query, file_type, limit, offset, fmt)
+
+        try:
+            result = index_search(query, file_type, limit, offset)
+            if result is not None:
+                if fmt:
+                    return streaming.stream_response(search_result_items(result), fmt)
+                return JsonResponse(result, status=200)
+        except Exception as e:
+            logger.error(f'Error searching key index, falling back to S3: {str(e)}')
+
         s3_client = get_s3_client()
         bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
 
+        if fmt:
+            return streaming.stream_response(
+                scan_search_items(s3_client, bucket_name, query, file_type, limit, offset), fmt)
+
         try:
-            paginator = s3_client.get_paginator('list_objects_v2')
             result = {
                 'files': [],
                 'folders': []
             }
-
-            folders_set = set()
-
-            for page in paginator.paginate(Bucket=bucket_name, Prefix=''):
-                for obj in page.get('Contents', []):
-                    key = obj['Key']
-                    
-                    if query.lower() in key.lower():
-                        
-                        if key.endswith('/'):
-                            
-                            folder_parts = key.strip('/').split('/')
-                            if query.lower() in folder_parts[-1].lower():
-                                result['folders'].append(key)
-                                folders_set.add(key)
-                        else:
-                            if file_type:
-                                if key.lower().endswith(file_type.lower()):
-                                    result['files'].append(key)
-                            else:
-                                result['files'].append(key)
-
-            
-            result['files'] = [file for file in result['files'] if not any(file.startswith(folder) for folder in folders_set)]
+            for item in scan_search_items(s3_client, bucket_name, query, file_type, limit, offset):
+                result['folders' if item['type'] == 'folder' else 'files'].append(item['key'])
 
             return JsonResponse(result, status=200)
         except (NoCredentialsError, PartialCredentialsError) as e:
             return JsonResponse({'error': str(e)}, status=403)
         except Exception as e:
-            return JsonResponse({'error': str(e)}, status=500)
+            return error_response(e)
 
     return JsonResponse({'error': 'Invalid request method'}, status=400)
-def list_folders(request):
-    start = time.time()
-
-    s3_client = get_s3_client()
-    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+def by_last_modified(items):
+    return sorted(items, key=lambda x: (x['LastModified'] if x['LastModified'] is not None else datetime.min.replace(tzinfo=pytz.UTC)), reverse=True)
+
+def get_listing(request, s3_client, bucket_name, prefix):
+    if not request.GET.get('limit'):
+        listing = stats_cache.get_listing(s3_client, bucket_name, prefix)
+        return listing['files'], by_last_modified(listing['folders']), None, True
+
+    limit, sort, token = pagination.page_params(request, prefix)
+    files, children, next_token = folder_stats.list_page(s3_client, bucket_name, prefix, limit, token)
+    folders = folder_stats.map_children(lambda child: stats_cache.get_tree(s3_client, bucket_name, child), children)
+    next_cursor = pagination.encode_cursor(prefix, next_token, sort) if next_token else None
+    return files, folders, next_cursor, False
+
+def listing_items(s3_client, bucket_name, prefix, file_item):
+    for files, children in folder_stats.iter_pages(s3_client, bucket_name, prefix):
+        for obj in files:
+            yield dict(file_item(obj), type='file')
+        for stats in folder_stats.map_children(lambda child: stats_cache.get_tree(s3_client, bucket_name, child), children):
+            yield dict(stats, type='folder')
+
+def root_file_item(obj):
+    return {
+        'fileName': obj['Key'],
+        'LastModified': obj['LastModified']
+    }
 
-    try:
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Delimiter='/')
+def folders_payload(file_objects, folders, next_cursor, complete):
+    files = [root_file_item(obj) for obj in file_objects]
 
-        folders = []
-        files = []
+    if complete:
+        files = by_last_modified(files)
 
-        common_prefixes = response.get('CommonPrefixes', [])
-        with ThreadPoolExecutor() as executor:
-            folder_futures = [executor.submit(process_folder, s3_client, bucket_name, cp['Prefix']) for cp in common_prefixes]
-            for future in folder_futures:
-                folders.append(future.result())
+    folders_count = len(folders)
+    files_count = len(files)
 
-        for obj in response.get('Contents', []):
-            file_info = {
-                'fileName': obj['Key'],
-                'LastModified': obj['LastModified']
-            }
-            files.append(file_info)
+    response = {
+        'folders': folders,
+        'files': files,
+        'folder_count': folders_count,
+        'files_count': files_count
+    }
+    if not complete:
+        response['next_cursor'] = next_cursor
+    return response
 
-        folders = sorted(folders, key=lambda x: (x['LastModified'] if x['LastModified'] is not None else datetime.min.replace(tzinfo=pytz.UTC)), reverse=True)
-        files = sorted(files, key=lambda x: (x['LastModified'] if x['LastModified'] is not None else datetime.min.replace(tzinfo=pytz.UTC)), reverse=True)
+@conditional.versioned(listing_version)
+@singleflight.coalesce(listing_version)
+def list_folders(request):
+    s3_client = get_s3_client()
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
 
-        folders_count = len(folders)
-        files_count = len(files)
+    fmt = streaming.stream_format(request)
+    if fmt:
+        return streaming.stream_response(listing_items(s3_client, bucket_name, '', root_file_item), fmt)
 
-        return JsonResponse({
-            'folders': folders,
-            'files': files,
-            'folder_count': folders_count,
-            'files_count': files_count
-        })
+    try:
+        file_objects, folders, next_cursor, complete = get_listing(request, s3_client, bucket_name, '')
+        return JsonResponse(folders_payload(file_objects, folders, next_cursor, complete))
+    except pagination.InvalidPageRequest as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return error_response(e)
+
+def folder_file_item(obj):
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    bucket_region = os.getenv('AWS_DEFAULT_REGION')
+    return {
+        'Key': obj['Key'],
+        'LastModified': obj['LastModified'],
+        'URL': f'https://{bucket_name}.s3.{bucket_region}.amazonaws.com/{obj["Key"]}'
+    }
 
-def process_subfolder_page(page):
-    file_count = 0
-    folder_count = 0
-    last_modified = None
+def files_payload(folder_id, file_objects, folders, next_cursor, complete, thumbnail_urls=None):
+    files = [folder_file_item(obj) for obj in file_objects]
+    if thumbnail_urls is not None:
+        for item in files:
+            item['Thumbnails'] = thumbnail_urls.get(item['Key'], {})
 
-    for obj in page.get('Contents', []):
-        if not obj['Key'].endswith('/'):
-            file_count += 1
-            if last_modified is None or obj['LastModified'] > last_modified:
-                last_modified = obj['LastModified']
+    if complete:
+        files = by_last_modified(files)
 
-    for sub_prefix in page.get('CommonPrefixes', []):
-        folder_count += 1
+    file_count = len(files)
+    folder_count = len(folders)
 
-    return file_count, folder_count, last_modified
+    response = {
+        'folder_id': folder_id,
+        'files': files,
+        'folders': folders,
+        'file_count': file_count,
+        'folder_count': folder_count
+    }
+    if not complete:
+        response['next_cursor'] = next_cursor
+    return response
 
+def image_files_response(request, folder_id, folder_key, fmt=None):
+    # The folder's images, filtered or sorted on their metadata from its table alone
+    try:
+        rows, next_cursor = image_metadata.page(request, image_metadata.query(request, parent=folder_key), folder_key)
+    except (image_metadata.InvalidQuery, pagination.InvalidPageRequest) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    file_objects = [image_metadata.as_object(row) for row in rows]
+    if fmt:
+        return streaming.stream_response((dict(folder_file_item(obj), type='file', Image=image_metadata.as_dict(row))
+                                          for obj, row in zip(file_objects, rows)), fmt)
+    payload = files_payload(folder_id, file_objects, [], next_cursor, False, thumbnails.urls_for(file_objects))
+    for item, row in zip(payload['files'], rows):
+        item['Image'] = image_metadata.as_dict(row)
+    return JsonResponse(payload)
+
+@conditional.versioned(listing_version)
+@singleflight.coalesce(listing_version)
 def list_files(request, folder_id):
     s3_client = get_s3_client()
     bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
-    bucket_region = os.getenv('AWS_DEFAULT_REGION')
 
-    try:
-        folder_key = folder_id.rstrip('/') + '/'
-        
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=folder_key, Delimiter='/')
-        
-        files = []
-        folders = []
-
-        for obj in response.get('Contents', []):
-            if obj['Key'] != folder_key:
-                file_info = {
-                    'Key': obj['Key'],
-                    'LastModified': obj['LastModified'],
-                    'URL': f'https://{bucket_name}.s3.{bucket_region}.amazonaws.com/{obj["Key"]}'
-                }
-                files.append(file_info)
-
-        def process_common_prefix(common_prefix):
-            subfolder_key = common_prefix['Prefix']
-            paginator = s3_client.get_paginator('list_objects_v2')
-            subfolder_pages = paginator.paginate(Bucket=bucket_name, Prefix=subfolder_key, Delimiter='/')
-            file_count = 0
-            folder_count = 0
-            last_modified = None
-            created_at = None  
-            for page in subfolder_pages:
-                page_file_count, page_folder_count, page_last_modified = process_subfolder_page(page)
-                file_count += page_file_count
-                folder_count += page_folder_count
-                if last_modified is None or (page_last_modified is not None and page_last_modified > last_modified):
-                    last_modified = page_last_modified
-            
-            try:
-                head_response = s3_client.head_object(Bucket=bucket_name, Key=subfolder_key)
-                created_at = head_response.get('Metadata', {}).get('createdat')
-                if created_at:
-                    created_at = parse_date(created_at)
-            except s3_client.exceptions.ClientError as e:
-                logger.error(f"Error fetching metadata for {subfolder_key}: {e}")
-
-            if file_count == 0 and folder_count == 0:
-                last_modified = created_at
-
-            return {
-                'folderName': subfolder_key,
-                'FileCount': file_count,
-                'FolderCount': folder_count,
-                'LastModified': last_modified
-            }
+    folder_key = folder_id.rstrip('/') + '/'
 
-        with ThreadPoolExecutor() as executor:
-            subfolder_results = list(executor.map(process_common_prefix, response.get('CommonPrefixes', [])))
+    fmt = streaming.stream_format(request)
+    if image_metadata.requested(request):
+        return image_files_response(request, folder_id, folder_key, fmt)
+    if fmt:
+        return streaming.stream_response(listing_items(s3_client, bucket_name, folder_key, folder_file_item), fmt)
 
-        folders.extend(subfolder_results)
-        
-        files = sorted(files, key=lambda x: (x['LastModified'] if x['LastModified'] is not None else datetime.min.replace(tzinfo=pytz.UTC)), reverse=True)
-        folders = sorted(folders, key=lambda x: (x['LastModified'] if x['LastModified'] is not None else datetime.min.replace(tzinfo=pytz.UTC)), reverse=True)
-
-        file_count = len(files)
-        folder_count = len(folders)
-
-        return JsonResponse({
-            'folder_id': folder_id,
-            'files': files,
-            'folders': folders,
-            'file_count': file_count,
-            'folder_count': folder_count
-        })
+    try:
+        file_objects, folders, next_cursor, complete = get_listing(request, s3_client, bucket_name, folder_key)
+        return JsonResponse(files_payload(folder_id, file_objects, folders, next_cursor, complete,
+                                          thumbnails.urls_for(file_objects)))
 
+    except pagination.InvalidPageRequest as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return error_response(e)
 
 
 
 
+def streaming_upload(request):
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    handler = S3MultipartUploadHandler(request, get_s3_client(), bucket_name,
+                                       request.GET['folder_id'], request.GET.get('file_name'))
+    request.upload_handlers.insert(0, handler)
+    try:
+        file = request.FILES.get('file')
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        handler.abort()
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        # Includes the client going away mid-body: never leave a dangling multipart upload
+        handler.abort()
+        logger.error(f'Streaming upload of {handler.key} failed: {str(e)}')
+        return error_response(e)
+
+    if isinstance(handler.error, DuplicateKey):
+        return JsonResponse({'error': 'A file with the same name already exists'}, status=400)
+    if not isinstance(file, S3UploadedFile):
+        handler.abort()
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+
+    key_index.record_object(file.key, size=file.size, etag=file.etag)
+    image_metadata.record(bucket_name, file.key, file.header, file.size, file.etag)
+    stats_cache.invalidate_key(file.key)
+    thumbnails.schedule(bucket_name, file.key, etag=file.etag, size=file.size)
+    return JsonResponse({'message': 'File uploaded successfully', 'deduplicated': file.deduplicated}, status=200)
+
+def hashed_files(request):
+    # Uploads are hashed while the body arrives, so dedup never reads them a second time
+    if settings.DEDUP_ENABLED:
+        handler = HashingUploadHandler(request)
+        request.upload_handlers.insert(0, handler)
+        return handler.attach(request.FILES)
+    return request.FILES
+
 @csrf_exempt
 def upload_file(request):
-    if request.method == 'POST' and request.FILES['file']:
-        folder_id = request.POST.get('folder_id')
-        file = request.FILES['file']
+    # Streaming straight to S3 needs the key before the body is read, so it is only used
+    # when folder_id comes in the query string; a form field arrives too late for that
+    if request.method == 'POST' and 'folder_id' in request.GET:
+        return streaming_upload(request)
+    file = hashed_files(request).get('file') if request.method == 'POST' else None
+    folder_id = request.POST.get('folder_id')
+    if file is not None and folder_id is not None:
         file_name=request.POST.get('file_name',file.name)
         file_key = os.path.join(folder_id, file_name)
         try:
@@ -331,14 +474,287 @@ def upload_file(request):
                 return JsonResponse({'error': 'A file with the same name already exists'}, status=400)
 
 
-            s3_client.upload_fileobj(file, bucket_name, file_key)
-            return JsonResponse({'message': 'File uploaded successfully'}, status=200)
+            header = image_metadata.read_header(file_key, file)
+            etag, deduplicated = dedup.store_file(s3_client, bucket_name, file_key, file, config=get_transfer_config())
+            key_index.record_object(file_key, size=file.size, etag=etag or '')
+            image_metadata.record(bucket_name, file_key, header, file.size, etag)
+            stats_cache.invalidate_key(file_key)
+            thumbnails.schedule(bucket_name, file_key, etag=etag, size=file.size)
+            return JsonResponse({'message': 'File uploaded successfully', 'deduplicated': deduplicated}, status=200)
         except (NoCredentialsError, PartialCredentialsError) as e:
             return JsonResponse({'error': str(e)}, status=403)
         except Exception as e:
-            return JsonResponse({'error': str(e)}, status=500)
+            return error_response(e)
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
+def existing_names(s3_client, bucket_name, folder_key):
+    names = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=folder_key, Delimiter='/'):
+        names.extend(obj['Key'] for obj in page.get('Contents', []))
+        names.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+    return sorted(names)
+
+def name_taken(names, key):
+    # Same rule as upload_file: any existing key starting with the new key blocks it
+    i = bisect.bisect_left(names, key)
+    return i < len(names) and names[i].startswith(key)
+
+@csrf_exempt
+def upload_files(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    files = hashed_files(request).getlist('files') or request.FILES.getlist('file')
+    folder_id = request.POST.get('folder_id')
+    if folder_id is None or not files:
+        return JsonResponse({'error': 'folder_id and at least one file are required'}, status=400)
+
+    folder_key = folder_id.rstrip('/') + '/' if folder_id else ''
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    s3_client = get_s3_client()
+    try:
+        names = existing_names(s3_client, bucket_name, folder_key)
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        return error_response(e)
+
+    def upload(file, file_key):
+        return dedup.store_file(s3_client, bucket_name, file_key, file, config=get_transfer_config())
+
+    results = []
+    futures = []
+    seen = set()
+    executor = executors.get_executor('transfers')
+    for file in files:
+        file_key = os.path.join(folder_id, file.name)
+        result = {'file_name': file.name, 'key': file_key}
+        results.append(result)
+        if file_key in seen or name_taken(names, file_key):
+            result.update(status='exists', error='A file with the same name already exists')
+            continue
+        seen.add(file_key)
+        header = image_metadata.read_header(file_key, file)
+        futures.append((result, file, header, executor.submit(upload, file, file_key)))
+
+    for result, file, header, future in futures:
+        try:
+            etag, result['deduplicated'] = future.result()
+            result['status'] = 'uploaded'
+            key_index.record_object(result['key'], size=file.size, etag=etag or '')
+            image_metadata.record(bucket_name, result['key'], header, file.size, etag)
+            thumbnails.schedule(bucket_name, result['key'], etag=etag, size=file.size)
+        except Exception as e:
+            result.update(status='error', error=str(e))
+
+    uploaded = sum(1 for result in results if result['status'] == 'uploaded')
+    if uploaded:
+        stats_cache.invalidate_key(folder_key)
+    return JsonResponse({
+        'results': results,
+        'uploaded_count': uploaded,
+        'failed_count': len(results) - uploaded
+    }, status=200)
+
+def key_exists(s3_client, bucket_name, key):
+    existing_files = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=key)
+    return 'Contents' in existing_files
+
+@csrf_exempt
+def presign_upload(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    folder_id = request.POST.get('folder_id')
+    file_name = request.POST.get('file_name')
+    content_type = request.POST.get('content_type')
+    if folder_id is None or not file_name:
+        return JsonResponse({'error': 'folder_id and file_name are required'}, status=400)
+    try:
+        size = int(request.POST.get('size') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'size must be an integer'}, status=400)
+
+    file_key = os.path.join(folder_id, file_name)
+    sha256 = (request.POST.get('sha256') or '').lower()
+    try:
+        bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+        s3_client = get_s3_client()
+        if key_exists(s3_client, bucket_name, file_key):
+            return JsonResponse({'error': 'A file with the same name already exists'}, status=400)
+
+        # A client that sends its file's hash can skip the transfer altogether. The hash is
+        # only used to look content up, never recorded, so a wrong one cannot poison the index.
+        blob = dedup.find(sha256, size) if sha256 and dedup.eligible(size) else None
+        etag = dedup.copy_blob(s3_client, blob, bucket_name, file_key, content_type) if blob else None
+        if etag is not None:
+            key_index.record_object(file_key, size=size, etag=etag)
+            stats_cache.invalidate_key(file_key)
+            thumbnails.schedule(bucket_name, file_key, etag=etag, size=size)
+            image_metadata.schedule(bucket_name, file_key, etag=etag, size=size)
+            return JsonResponse({'key': file_key, 'method': 'copy', 'deduplicated': True}, status=200)
+
+        if size <= settings.S3_UPLOAD_PART_SIZE:
+            return JsonResponse({
+                'key': file_key,
+                'method': 'PUT',
+                'url': direct_uploads.presign_put(s3_client, bucket_name, file_key, content_type),
+                'upload_token': direct_uploads.upload_token(file_key),
+                'expires_in': settings.S3_PRESIGNED_URL_EXPIRY
+            }, status=200)
+        upload = direct_uploads.start_multipart(s3_client, bucket_name, file_key, size, content_type)
+        return JsonResponse(dict(upload, key=file_key, method='multipart',
+                                 upload_token=direct_uploads.upload_token(file_key, upload['upload_id']),
+                                 expires_in=settings.S3_PRESIGNED_URL_EXPIRY), status=200)
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        return error_response(e)
+
+def json_body(request):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+@csrf_exempt
+def complete_upload(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    data = json_body(request)
+    if data is None or not data.get('key'):
+        return JsonResponse({'error': 'A JSON body with key is required'}, status=400)
+
+    file_key = data['key']
+    upload_id = data.get('upload_id') or ''
+    try:
+        # Only uploads this server presigned can be completed, and only in their own folder
+        direct_uploads.check_token(data.get('upload_token'), file_key, upload_id)
+        folder_key = (data.get('folder_id') or '').rstrip('/')
+        if folder_key and not file_key.startswith(folder_key + '/'):
+            raise direct_uploads.InvalidUpload('key is not in folder_id')
+        parts = direct_uploads.parse_parts(data.get('parts')) if upload_id else None
+    except direct_uploads.InvalidUpload as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+        s3_client = get_s3_client()
+        if upload_id:
+            direct_uploads.complete_multipart(s3_client, bucket_name, file_key, upload_id, parts)
+        head = s3_client.head_object(Bucket=bucket_name, Key=file_key)
+        key_index.record_object(file_key, size=head['ContentLength'], last_modified=head['LastModified'], etag=head['ETag'])
+        stats_cache.invalidate_key(file_key)
+        thumbnails.schedule(bucket_name, file_key, etag=head['ETag'], size=head['ContentLength'])
+        image_metadata.schedule(bucket_name, file_key, etag=head['ETag'], size=head['ContentLength'])
+        return JsonResponse({'message': 'File uploaded successfully', 'key': file_key}, status=200)
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except ClientError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return error_response(e)
+
+@csrf_exempt
+def abort_upload(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    data = json_body(request)
+    if data is None or not data.get('key') or not data.get('upload_id'):
+        return JsonResponse({'error': 'A JSON body with key and upload_id is required'}, status=400)
+    try:
+        direct_uploads.check_token(data.get('upload_token'), data['key'], data['upload_id'])
+    except direct_uploads.InvalidUpload as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        s3_client = get_s3_client()
+        s3_client.abort_multipart_upload(Bucket=os.getenv('AWS_STORAGE_BUCKET_NAME'), Key=data['key'], UploadId=data['upload_id'])
+        return JsonResponse({'message': 'Upload aborted'}, status=200)
+    except ClientError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return error_response(e)
+
+def job_accepted(job, created, message):
+    return JsonResponse({
+        'message': message if created else 'Job already exists for this idempotency key',
+        'job_id': job.pk,
+        'status': job.status,
+        'status_url': reverse('job-status', args=[job.pk]),
+        'cancel_url': reverse('job-cancel', args=[job.pk]),
+    }, status=202)
+
+
+def enqueue_job(request, kind, params, message):
+    try:
+        job, created = jobs.enqueue(kind, params, idempotency_key=request.headers.get('Idempotency-Key'))
+    except jobs.IdempotencyConflict as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    return job_accepted(job, created, message)
+
+
+def start_folder_delete(request, bucket_name, folder_key):
+    return enqueue_job(request, 'delete_folder', {'bucket': bucket_name, 'prefix': folder_key},
+                       'Folder delete started')
+
+
+def folder_deleted(report):
+    if report['errors']:
+        return JsonResponse({'error': 'Some objects could not be deleted', **report}, status=207)
+    return JsonResponse({'message': 'Folder and all its contents deleted successfully', **report}, status=200)
+
+
+def job_status(request, job_id):
+    try:
+        job = Job.objects.get(pk=job_id)
+    except Job.DoesNotExist:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+    return JsonResponse(job.as_dict())
+
+
+def list_jobs(request):
+    queryset = Job.objects.order_by('-pk')
+    if request.GET.get('status'):
+        queryset = queryset.filter(status=request.GET['status'])
+    if request.GET.get('kind'):
+        queryset = queryset.filter(kind=request.GET['kind'])
+    try:
+        limit = min(int(request.GET.get('limit') or 100), 1000)
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer'}, status=400)
+    return JsonResponse({'jobs': [job.as_dict() for job in queryset[:limit]]})
+
+
+@csrf_exempt
+def cancel_job(request, job_id):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    try:
+        job = Job.objects.get(pk=job_id)
+    except Job.DoesNotExist:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+    if job.status in Job.FINISHED:
+        return JsonResponse({'error': f'Job already {job.status}', **job.as_dict()}, status=409)
+    return JsonResponse(jobs.cancel(job).as_dict(), status=202)
+
+
+@csrf_exempt
+def rebuild_index(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    return enqueue_job(request, 'rebuild_index', {'bucket': os.getenv('AWS_STORAGE_BUCKET_NAME')},
+                       'Search index rebuild started')
+
+
+@csrf_exempt
+def folder_stats_job(request, folder_id):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    folder_key = folder_id.rstrip('/') + '/'
+    return enqueue_job(request, 'folder_tree_stats',
+                       {'bucket': os.getenv('AWS_STORAGE_BUCKET_NAME'), 'prefix': folder_key},
+                       'Folder stats started')
+
+
 @csrf_exempt
 def delete_file(request, folder_id, file_name=None):
     s3_client = get_s3_client()
@@ -348,21 +764,39 @@ def delete_file(request, folder_id, file_name=None):
         if file_name:
             file_key = os.path.join(folder_id, file_name)
             s3_client.delete_object(Bucket=bucket_name, Key=file_key)
+            key_index.remove_object(file_key)
+            stats_cache.invalidate_key(file_key)
+            thumbnails.delete_for(s3_client, bucket_name, file_key)
+            dedup.forget(file_key)
+            image_metadata.forget(file_key)
             return JsonResponse({'message': 'File deleted successfully'}, status=200)
         else:
             folder_key = folder_id.rstrip('/') + '/'
-            objects_to_delete = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=folder_key)
-            
-            if 'Contents' in objects_to_delete:
-                delete_keys = [{'Key': obj['Key']} for obj in objects_to_delete['Contents']]
-                s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': delete_keys})
-                return JsonResponse({'message': 'Folder and all its contents deleted successfully'}, status=200)
-            else:
+            key_count, truncated = bulk_delete.probe_size(
+                s3_client, bucket_name, folder_key, settings.S3_DELETE_INLINE_MAX_KEYS)
+            if not key_count:
                 return JsonResponse({'error': 'Folder not found or empty'}, status=404)
+            if truncated:
+                return start_folder_delete(request, bucket_name, folder_key)
+            return folder_deleted(bulk_delete.delete_folder(s3_client, bucket_name, folder_key).as_dict())
     except (NoCredentialsError, PartialCredentialsError) as e:
         return JsonResponse({'error': str(e)}, status=403)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return error_response(e)
+
+
+def download_folder(request, folder_id):
+    s3_client = get_s3_client()
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    folder_key = folder_id.rstrip('/') + '/'
+    try:
+        if not bulk_delete.probe_size(s3_client, bucket_name, folder_key, 1)[0]:
+            return JsonResponse({'error': 'Folder not found or empty'}, status=404)
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        return error_response(e)
+    return zip_download.zip_response(s3_client, bucket_name, folder_key)
 
 
 @csrf_exempt
@@ -385,10 +819,50 @@ def create_folder(request):
             created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S%z')
             created_at = created_at[:-2] + ':' + created_at[-2:]
             s3_client.put_object(Bucket=os.getenv('AWS_STORAGE_BUCKET_NAME'), Key=folder_key, Metadata={'createdAt': created_at})
+            key_index.record_object(folder_key, created_at=parse_date(created_at))
+            stats_cache.invalidate_key(folder_key)
             return JsonResponse({'message': 'Folder created successfully'}, status=200)
         except (NoCredentialsError, PartialCredentialsError) as e:
             return JsonResponse({'error': str(e)}, status=403)
         except Exception as e:
-            return JsonResponse({'error': str(e)}, status=500)
+            return error_response(e)
     return JsonResponse({'error': 'Invalid request'}, status=400)
        
+
+
+def folder_moved(report):
+    if report['errors']:
+        return JsonResponse({'error': 'Some objects could not be moved', **report}, status=207)
+    return JsonResponse({'message': 'Folder moved successfully', **report}, status=200)
+
+
+@csrf_exempt
+def move_folder(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+    source = (request.POST.get('source_folder') or '').strip('/')
+    destination = (request.POST.get('destination_folder') or '').strip('/')
+    if not source or not destination:
+        return JsonResponse({'error': 'source_folder and destination_folder are required'}, status=400)
+    source_key, destination_key = source + '/', destination + '/'
+    if destination_key.startswith(source_key):
+        return JsonResponse({'error': 'A folder cannot be moved into itself'}, status=400)
+
+    s3_client = get_s3_client()
+    bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
+    try:
+        key_count, truncated = bulk_delete.probe_size(
+            s3_client, bucket_name, source_key, settings.S3_MOVE_INLINE_MAX_KEYS)
+        if not key_count:
+            return JsonResponse({'error': 'Folder not found or empty'}, status=404)
+        if bulk_delete.probe_size(s3_client, bucket_name, destination_key, 1)[0]:
+            return JsonResponse({'error': 'Destination folder already exists'}, status=409)
+        if truncated:
+            return enqueue_job(request, 'move_folder',
+                               {'bucket': bucket_name, 'source': source_key, 'destination': destination_key},
+                               'Folder move started')
+        return folder_moved(folder_move.move_folder(s3_client, bucket_name, source_key, destination_key).as_dict())
+    except (NoCredentialsError, PartialCredentialsError) as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except Exception as e:
+        return error_response(e)
@@ -0,0 +1,268 @@
+import logging
+import struct
+import tempfile
+import zlib
+from collections import deque
+from datetime import timezone
+
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.http import content_disposition_header
+
+from mainApp import executors, thumbnails
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+RESUME_ATTEMPTS = 3
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_COUNT_LIMIT = 0xFFFF
+STORED = 0
+DEFLATED = 8
+# Sizes and CRC follow the data; names are UTF-8
+FLAGS = 0x08 | 0x800
+VERSION = 20
+VERSION_ZIP64 = 45
+# Already compressed, so deflating them again costs CPU and saves nothing
+STORED_EXTENSIONS = {
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'heif', 'avif', 'jxl', 'tif', 'tiff',
+    'mp4', 'mov', 'm4v', 'webm', 'mkv', 'avi', 'mp3', 'm4a', 'aac', 'ogg', 'opus', 'flac',
+    'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', '7z', 'rar', 'pdf', 'docx', 'xlsx', 'pptx',
+}
+
+
+def _dos_datetime(when):
+    if when is None or when.year < 1980:
+        return 0, (1 << 5) | 1
+    when = when.astimezone(timezone.utc)
+    return ((when.hour << 11) | (when.minute << 5) | (when.second // 2),
+            ((when.year - 1980) << 9) | (when.month << 5) | when.day)
+
+
+class ZipWriter:
+    """Produces a ZIP archive as byte chunks, one entry at a time.
+
+    Each entry's CRC and sizes go in a data descriptor after its data, so nothing has to
+    be known or buffered up front. Central directory records are spilled to a temporary
+    file as entries finish, which keeps memory flat however many entries there are.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.count = 0
+        self.directory = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.directory_size = 0
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def entry(self, name, chunks=(), size=0, modified=None, compress=False):
+        """Yield the bytes of one entry whose content ``chunks`` yields; ``size`` is a hint."""
+        is_dir = name.endswith('/')
+        method = DEFLATED if compress and not is_dir else STORED
+        # The local header has to announce 64-bit descriptor sizes before the data is seen;
+        # the margin covers deflate's worst-case growth
+        zip64 = size + size // 1000 + 1024 >= ZIP64_LIMIT
+        version = VERSION_ZIP64 if zip64 else VERSION
+        name_bytes = name.encode('utf-8')
+        dos_time, dos_date = _dos_datetime(modified)
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        placeholder = ZIP64_LIMIT if zip64 else 0
+        header_offset = self.offset
+        yield self._emit(struct.pack('<IHHHHHIIIHH', 0x04034b50, version, FLAGS, method, dos_time, dos_date,
+                                     0, placeholder, placeholder, len(name_bytes), len(extra)) + name_bytes + extra)
+
+        crc = raw_size = stored_size = 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if method == DEFLATED else None
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            raw_size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                stored_size += len(chunk)
+                yield self._emit(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            stored_size += len(chunk)
+            yield self._emit(chunk)
+        if not zip64 and max(raw_size, stored_size) >= ZIP64_LIMIT:
+            raise ValueError(f'{name} grew past 4 GiB while it was being written')
+
+        descriptor = '<IIQQ' if zip64 else '<IIII'
+        yield self._emit(struct.pack(descriptor, 0x08074b50, crc, stored_size, raw_size))
+        self._record(name_bytes, version, method, dos_time, dos_date, crc, stored_size, raw_size,
+                     header_offset, is_dir)
+
+    def _record(self, name_bytes, version, method, dos_time, dos_date, crc, stored_size, raw_size,
+                header_offset, is_dir):
+        # The zip64 extra holds, in this order, whichever fields overflowed
+        overflow = [value for value in (raw_size, stored_size, header_offset) if value >= ZIP64_LIMIT]
+        extra = struct.pack(f'<HH{len(overflow)}Q', 1, 8 * len(overflow), *overflow) if overflow else b''
+        if overflow:
+            version = VERSION_ZIP64
+        external = (0o40755 << 16) | 0x10 if is_dir else 0o100644 << 16
+        record = struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | VERSION_ZIP64, version, FLAGS, method, dos_time,
+            dos_date, crc, min(stored_size, ZIP64_LIMIT), min(raw_size, ZIP64_LIMIT), len(name_bytes),
+            len(extra), 0, 0, 0, external, min(header_offset, ZIP64_LIMIT)) + name_bytes + extra
+        self.directory.write(record)
+        self.directory_size += len(record)
+        self.count += 1
+
+    def finish(self):
+        directory_offset = self.offset
+        self.directory.seek(0)
+        for chunk in iter(lambda: self.directory.read(READ_SIZE), b''):
+            yield self._emit(chunk)
+        self.directory.close()
+
+        count, size = self.count, self.directory_size
+        if count >= ZIP_COUNT_LIMIT or size >= ZIP64_LIMIT or directory_offset >= ZIP64_LIMIT:
+            end64_offset = self.offset
+            yield self._emit(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, VERSION_ZIP64, VERSION_ZIP64, 0, 0,
+                                         count, count, size, directory_offset))
+            yield self._emit(struct.pack('<IIQI', 0x07064b50, 0, end64_offset, 1))
+        yield self._emit(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, ZIP_COUNT_LIMIT),
+                                     min(count, ZIP_COUNT_LIMIT), min(size, ZIP64_LIMIT),
+                                     min(directory_offset, ZIP64_LIMIT), 0))
+
+    def close(self):
+        self.directory.close()
+
+
+def entry_name(root, folder_key, key):
+    # S3 keys may hold '..' or empty segments; none of them may escape the archive's root
+    parts = [part for part in key[len(folder_key):].split('/') if part not in ('', '.', '..')]
+    name = '/'.join([root] + parts)
+    return name + '/' if key.endswith('/') else name
+
+
+def compressible(key):
+    return key.rsplit('.', 1)[-1].lower() not in STORED_EXTENSIONS if '.' in key else True
+
+
+class Fetched:
+    __slots__ = ('response', 'data')
+
+    def __init__(self, response, data=None):
+        self.response = response
+        self.data = data
+
+    def close(self):
+        if self.data is None:
+            self.response['Body'].close()
+
+
+def fetch(s3_client, bucket_name, key):
+    """GetObject ahead of time; small bodies are read whole, so their transfer overlaps too."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+    if response['ContentLength'] <= settings.ZIP_DOWNLOAD_BUFFER_BYTES:
+        with response['Body'] as body:
+            return Fetched(response, body.read())
+    return Fetched(response)
+
+
+def body_chunks(s3_client, bucket_name, key, response):
+    body = response['Body']
+    position = 0
+    attempts = 0
+    try:
+        while True:
+            try:
+                chunk = body.read(READ_SIZE)
+            except BotoCoreError as e:
+                attempts += 1
+                if attempts > RESUME_ATTEMPTS:
+                    raise
+                logger.error(f'Resuming {key} at byte {position} after read error: {str(e)}')
+                body.close()
+                # Same version of the object, from where the connection dropped
+                body = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f'bytes={position}-',
+                                            IfMatch=response['ETag'])['Body']
+                continue
+            if not chunk:
+                return
+            position += len(chunk)
+            yield chunk
+    finally:
+        body.close()
+
+
+def iter_objects(s3_client, bucket_name, folder_key):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=folder_key):
+        for obj in page.get('Contents', []):
+            if not thumbnails.is_derived(obj['Key']):
+                yield obj
+
+
+def _close_fetched(future):
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        future.result().close()
+
+
+def _discard(future):
+    if not future.cancel():
+        future.add_done_callback(_close_fetched)
+
+
+def stream_folder(s3_client, bucket_name, folder_key):
+    """Yield a ZIP of everything under ``folder_key``, fetching ZIP_DOWNLOAD_PREFETCH objects ahead."""
+    root = folder_key.rstrip('/').rsplit('/', 1)[-1]
+    writer = ZipWriter()
+    executor = executors.get_executor('transfers')
+    window = deque()
+
+    def write_next():
+        obj, future = window.popleft()
+        name = entry_name(root, folder_key, obj['Key'])
+        if future is None:
+            return writer.entry(name, modified=obj.get('LastModified'))
+        fetched = future.result()
+        if fetched is None:
+            # Deleted since it was listed
+            return ()
+        response = fetched.response
+        chunks = (fetched.data,) if fetched.data is not None else body_chunks(
+            s3_client, bucket_name, obj['Key'], response)
+        return writer.entry(name, chunks, size=response['ContentLength'], modified=response.get('LastModified'),
+                            compress=compressible(obj['Key']))
+
+    try:
+        for obj in iter_objects(s3_client, bucket_name, folder_key):
+            is_folder = obj['Key'].endswith('/')
+            if not is_folder and entry_name(root, folder_key, obj['Key']) == root:
+                continue
+            future = None if is_folder else executor.submit(fetch, s3_client, bucket_name, obj['Key'])
+            window.append((obj, future))
+            if len(window) > settings.ZIP_DOWNLOAD_PREFETCH:
+                yield from write_next()
+        while window:
+            yield from write_next()
+        yield from writer.finish()
+    except Exception as e:
+        # Headers are already sent; all the client can see is a truncated archive
+        logger.error(f'Error streaming ZIP of {folder_key}: {str(e)}')
+        raise
+    finally:
+        # Also when the client disconnects: close the bodies fetched ahead
+        for _, future in window:
+            if future is not None:
+                _discard(future)
+        writer.close()
+
+
+def zip_response(s3_client, bucket_name, folder_key):
+    root = folder_key.rstrip('/').rsplit('/', 1)[-1]
+    response = StreamingHttpResponse(stream_folder(s3_client, bucket_name, folder_key), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, f'{root}.zip')
+    response['X-Accel-Buffering'] = 'no'
+    return response